@@ -6,25 +6,45 @@ from loguru import logger
 __version__ = "0.1.3"
 
 import asyncio
+import contextlib
+import glob
+import hashlib
 import json
+import operator
+import os
+import queue
+import random
 import re
 import threading
 import time
 import traceback
 import uuid
-from copy import copy, deepcopy
+from collections import OrderedDict
+from copy import deepcopy
+import dataclasses
 from dataclasses import dataclass, field
 from datetime import timedelta
 from enum import Enum
 import functools
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from comfy_tweaker.plugins import PluginType
 
-from jinja2 import Environment, Template
+from appdirs import user_data_dir
+from jinja2 import Environment, FileSystemBytecodeCache, Template, nodes
 from PIL import Image
 from yaml import safe_dump, safe_load
 
-from comfy_tweaker.plugins import Plugin
-from comfy_tweaker.comfyui import run_job_on_server
+from comfy_tweaker.plugins import LazyPlugin, Plugin, import_plugin, imported_plugins, load_manifest
+from comfy_tweaker.comfyui import OutputDownloader, OutputProcessor, run_job_on_server
+from comfy_tweaker.cache_order import expected_cache_hit_rate, node_signatures, order_for_cache
+from comfy_tweaker.cycles import cycle_store
+from comfy_tweaker.file_cache import file_cache
+from comfy_tweaker.png import InvalidPngError, read_png_text
+from comfy_tweaker.profiling import SamplingProfiler, profile_path
+from comfy_tweaker.results import ResultIndex, ReuseMode, hash_workflow, reuse_outputs
+from comfy_tweaker.routing import ServerRouter, model_inputs
+from comfy_tweaker.scheduler import DEFAULT_AGING_RATE, JobScheduler
 from comfy_tweaker.exceptions import (IncompleteImageWorkflowError,
                                       InvalidSelectorError, NodeFieldNotFound,
                                       NodeNotFoundError,
@@ -42,6 +62,8 @@ class JobStatus(Enum):
 class Job:
     """
     A job is a workflow with specified tweaks that is sent to the server for processing. It has a status that is updated as the job progresses.
+
+    A job covers a range of iterations, starting from the iteration of its tweaks. Only counters are kept for the range, and outputs are stored for the iterations that produced them, so a job's size doesn't grow with its amount.
     """
     workflow: Workflow
     tweaks: Tweaks
@@ -51,28 +73,191 @@ class Job:
     preview_image: Image = field(default=None, init=False)
     amount: int = field(default=1)
     progress: int = field(default=0, init=False)
+    priority: int = field(default=0)
+    problem: str = field(default=None, init=False)
     client_id: str = field(default_factory=uuid.uuid4, init=False)
+    results: dict[int, list[str]] = field(default_factory=dict, init=False, repr=False)
 
     @property
     def remaining(self):
         return self.amount - self.progress
 
+    @property
+    def iterations(self):
+        """The range of iterations this job runs."""
+        return range(self.first_iteration, self.first_iteration + self.amount)
+
+    def record_result(self, iteration, outputs):
+        """Stores the output paths of an iteration. Iterations without outputs take no space."""
+        if outputs:
+            self.results[iteration] = list(outputs)
+            self.output_location = outputs[-1]
+
     def __post_init__(self):
-        self.original_workflow = deepcopy(self.workflow)
+        # apply_tweaks never modifies the workflow, so jobs from the same image can share it
+        self.original_workflow = self.workflow
+        self.first_iteration = self.tweaks._iteration
+
+@dataclass
+class IterationRun:
+    """The parts of a job that one iteration reads and writes while it runs on a server. Iterations dispatched to other servers run alongside the job's next iterations, so each gets its own instead of sharing the job's."""
+    workflow: Workflow
+    tweaks: Tweaks
+    client_id: str
+    output_location: str = ""
+    preview_image: bytes = None
+
+    @classmethod
+    def from_job(cls, job):
+        return cls(job.workflow, job.tweaks, job.client_id)
+
+@dataclass
+class RenderedIteration:
+    """A workflow with tweaks applied for one iteration of a job, along with the regenerated tweaks for the iteration after it."""
+    job_id: uuid.UUID
+    iteration: int
+    workflow: Workflow
+    next_tweaks: Tweaks
+    # the cycles moved while regenerating the tweaks, rewound if this iteration is thrown away
+    cycle_journal: list = field(default_factory=list, repr=False)
+
+
+class RenderAhead:
+    """
+    Renders upcoming iterations of a job in a background thread so the next workflow is ready as soon as the server finishes the current one. At most `depth` rendered iterations are held at a time.
+
+    A render ahead belongs to a single job. Cancel it when the job leaves the front of the queue so stale renders are thrown away. The cycles moved by thrown away renders are moved back, so the job's next real iteration picks up where the last used one left off. Images as_image copied or uploaded for them are kept, since they are named by their contents.
+    """
+    def __init__(self, job, depth=2):
+        self.job = job
+        self._rendered = queue.Queue(maxsize=depth)
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._render, daemon=True)
+        self._thread.start()
+
+    def _render(self):
+        tweaks = self.job.tweaks
+        for _ in range(self.job.remaining):
+            with Tweaks.journal_cycles() as journal:
+                try:
+                    workflow = self.job.original_workflow.apply_tweaks(tweaks)
+                    next_tweaks = tweaks.regenerate()
+                    result = RenderedIteration(self.job.id, tweaks._iteration, workflow, next_tweaks, journal)
+                except Exception as e:
+                    # handed to the consumer so the job fails the same way it would without rendering ahead
+                    result = e
+            delivered = False
+            while not self._cancelled.is_set():
+                try:
+                    self._rendered.put(result, timeout=0.1)
+                    delivered = True
+                    break
+                except queue.Full:
+                    continue
+            if not delivered:
+                cycle_store.rewind(journal)
+            if self._cancelled.is_set():
+                # cancel can empty the queue just before a waiting put goes through
+                self._discard()
+                return
+            if isinstance(result, Exception):
+                return
+            tweaks = next_tweaks
+
+    def _get(self):
+        while not self._cancelled.is_set():
+            try:
+                return self._rendered.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    async def next(self):
+        """Waits for the next rendered iteration of the job. Raises the rendering error if the iteration failed to render.
+
+        Returns:
+            RenderedIteration: the rendered iteration, or None if the render ahead was cancelled
+        """
+        result = await asyncio.get_running_loop().run_in_executor(None, self._get)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def cancel(self):
+        """Stops rendering and throws away any iterations that were rendered but not used, moving back the cycles they moved."""
+        self._cancelled.set()
+        self._discard()
+
+    def _discard(self):
+        discarded = []
+        while True:
+            try:
+                discarded.append(self._rendered.get_nowait())
+            except queue.Empty:
+                break
+        for result in reversed(discarded):
+            if isinstance(result, RenderedIteration):
+                cycle_store.rewind(result.cycle_journal)
+
 
 @dataclass
 class JobQueue:
     """
     A job queue manages a list of jobs. Starting the queue sends the next job to the server. Stopping the queue will stop further processing after the current job has been completed.
+
+    If render_ahead is greater than 0, that many upcoming iterations of the job at the front of the queue are rendered in the background while the server is busy.
+
+    If the OUTPUT_DOWNLOAD_FOLDER environment variable is set, output images are downloaded from the server into that folder.
+
+    If output_workers is greater than 0, metadata is written into output images by that many background threads while the next prompt runs.
+
+    If reuse_results is not ReuseMode.OFF, iterations whose final API workflow was already generated reuse the recorded outputs from the result index instead of being sent to the server.
+
+    Jobs run in order of priority, highest first, and waiting jobs gain aging_rate priority per second so low priority jobs still get their turn. A job with a higher priority takes over between iterations of the running job.
+
+    If cache_aware_order is True, waiting jobs with the same priority are reordered when the queue starts so that consecutive jobs share as many nodes as possible, letting ComfyUI reuse cached checkpoint loads and prompt encodes.
+
+    If validate_ahead is True, a BackgroundValidator checks upcoming jobs while the queue runs, and jobs it finds problems with are skipped instead of stopping the queue.
+
+    If more than one server address is given in servers, iterations run on all of them at once. Each iteration goes to a server that last ran the same checkpoints and loras where possible, trading that off against how busy the servers are with affinity_weight and load_weight, see ServerRouter. Since an iteration can run on any of them, OUTPUT_DOWNLOAD_FOLDER has to be set so outputs are downloaded from whichever server made them, into a subfolder per server, and the COMFYUI_SERVERS environment variable has to list the same servers so as_image uploads images to all of them.
+
+    If profile_directory is set, each run of the queue is profiled with a SamplingProfiler and written to that directory as collapsed stacks for flamegraph tools. Nothing is sampled when it isn't set.
     """
-    queue: list[Job] = field(default_factory=list)
+    queue: JobScheduler = field(default_factory=JobScheduler)
     _stop_event: asyncio.Event = field(default_factory=asyncio.Event, init=False)
     history: list[Job] = field(default_factory=list)
+    render_ahead: int = field(default=0)
+    reuse_results: ReuseMode = field(default=ReuseMode.OFF)
+    result_index: ResultIndex = field(default=None)
+    output_workers: int = field(default=0)
+    aging_rate: float = field(default=DEFAULT_AGING_RATE)
+    cache_aware_order: bool = field(default=False)
+    servers: list[str] = field(default_factory=list)
+    affinity_weight: float = field(default=1.0)
+    load_weight: float = field(default=1.0)
+    validate_ahead: bool = field(default=False)
+    profile_directory: str = field(default=None)
 
     def __post_init__(self):
         self._running_thread_lock = threading.Lock()
+        if not isinstance(self.queue, JobScheduler):
+            # a list of jobs is still accepted, in order
+            self.queue = JobScheduler(self.queue, aging_rate=self.aging_rate)
+        elif not self.queue:
+            # no job has a heap key yet, so the rate can still change
+            self.queue.aging_rate = self.aging_rate
+        self.validator = None
+        if self.validate_ahead:
+            # validation imports this module for Tweaks and JobStatus
+            from comfy_tweaker.validation import BackgroundValidator
+            self.validator = BackgroundValidator(self)
+        self.router = None
+        if len(self.servers) > 1:
+            self.router = ServerRouter(self.servers, self.affinity_weight, self.load_weight)
+        if self.reuse_results != ReuseMode.OFF and self.result_index is None:
+            self.result_index = ResultIndex()
 
-    def add(self, workflow, tweaks, amount=1, validate=True):
+    def add(self, workflow, tweaks, amount=1, validate=True, priority=0):
         """Add a job to the queue with the provided workflows and tweaks. If validate is set to True, the workflow will be validated before it is added to the queue.
 
         Args:
@@ -80,10 +265,42 @@ class JobQueue:
             tweaks (Tweaks): the tweaks that will be applied to the workflow at runtime
             validate (bool, optional): Whether or not the workflow should be validated before adding to the queue. Defaults to True.
             amount (int, optional): The amount of times the job should be run. Defaults to 1.
+            priority (int, optional): Jobs with a higher priority run first. Defaults to 0.
+
+        Returns:
+            Job: the job that was added
         """
         if validate:
             workflow.validate(tweaks)
-        self.queue.append(Job(workflow, tweaks, amount=amount))
+        job = Job(workflow, tweaks, amount=amount, priority=priority)
+        self.queue.append(job)
+        return job
+
+    def _find_queued(self, job_id):
+        for job in self.queue:
+            if job.id == job_id:
+                return job
+        raise KeyError("Job not found in queue: id" + str(job_id))
+
+    def set_priority(self, job_id, priority):
+        """Changes the priority of a queued job.
+
+        Args:
+            job_id (UUID): the id of the job
+            priority (int): the new priority, higher runs first
+
+        Raises:
+            KeyError: If the job is not found in the queue
+        """
+        self.queue.reprioritize(self._find_queued(job_id), priority)
+
+    def move_to_front(self, job_id):
+        """Moves a queued job ahead of every other job.
+
+        Raises:
+            KeyError: If the job is not found in the queue
+        """
+        self.queue.move_to_front(self._find_queued(job_id))
 
     @property
     def running(self):
@@ -99,9 +316,9 @@ class JobQueue:
         Raises:
             KeyError: If the job is not found in the queue
         """
-        for i, job in enumerate(self.queue):
+        for job in self.queue:
             if job.id == job_id:
-                self.queue.pop(i)
+                self.queue.remove(job)
                 return
         for i, job in enumerate(self.history):
             if job.id == job_id:
@@ -113,7 +330,7 @@ class JobQueue:
         """
         Clears the queue and history.
         """
-        self.queue = []
+        self.queue.clear()
         self.history = []
 
     @property
@@ -129,7 +346,7 @@ class JobQueue:
     @property
     def all_jobs(self):
         """Returns all jobs, including those that have already been completed."""
-        return self.queue + self.history
+        return list(self.queue) + self.history
 
     def position_of(self, job_id):
         """Returns the positiong of the job with the specified id in the queue. If the job is not found, returns None.
@@ -140,10 +357,41 @@ class JobQueue:
         Returns:
             int, None: the position of the job in the queue
         """
-        for i, job in enumerate(self.queue):
-            if job.id == job_id:
-                return i + 1
-        return None
+        position = self.queue.position_of(job_id)
+        return position + 1 if position is not None else None
+
+    def reorder_for_cache(self):
+        """
+        Reorders waiting jobs so that each one shares as many nodes with the job before it as possible, using the API workflow of each job's next iteration. Jobs only move among jobs with the same priority, and jobs whose tweaks can't be applied stay where they are.
+
+        Returns:
+            tuple[float, float]: the expected share of cached nodes between jobs before and after reordering
+        """
+        jobs = []
+        signature_sets = []
+        for job in self.queue:
+            if job.status == JobStatus.IN_PROGRESS:
+                continue
+            try:
+                api_workflow = job.original_workflow.apply_tweaks(job.tweaks).api_workflow
+            except Exception as e:
+                logger.warning(f"Not reordering {job.original_workflow.name} with {job.tweaks.name}: {e}")
+                continue
+            jobs.append(job)
+            signature_sets.append(set(node_signatures(api_workflow).values()))
+        before = expected_cache_hit_rate(signature_sets)
+        new_order = []
+        start = 0
+        # reorder runs of jobs with the same priority so priorities keep their meaning
+        for end in range(1, len(jobs) + 1):
+            if end == len(jobs) or jobs[end].priority != jobs[start].priority:
+                run = list(range(start, end))
+                new_order.extend(run[i] for i in order_for_cache([signature_sets[j] for j in run]))
+                start = end
+        self.queue.reorder([jobs[i] for i in new_order])
+        after = expected_cache_hit_rate([signature_sets[i] for i in new_order])
+        logger.info(f"Reordered {len(jobs)} jobs for the node cache, expected hit rate {before:.0%} -> {after:.0%}.")
+        return before, after
 
     def restart(self):
         """Restarts an active queue."""
@@ -156,18 +404,115 @@ class JobQueue:
     async def start(self):
         """Starts a queue that is not currently in progress."""
         with self._running_thread_lock:
-            logger.info("Starting queue...")
-            self._stop_event.clear()
-            while self.queue:
-                logger.info("Starting next job in queue...")
+            if self.router:
+                self.check_servers()
+            output_processor = OutputProcessor(self.output_workers) if self.output_workers > 0 else None
+            # by server address, None being COMFYUI_SERVER_ADDRESS
+            downloaders = {}
+            if os.getenv("OUTPUT_DOWNLOAD_FOLDER"):
+                # the server is remote, so its outputs are downloaded instead of read from its output folder
+                for server in self.router.servers if self.router else [None]:
+                    destination = os.getenv("OUTPUT_DOWNLOAD_FOLDER")
+                    if server:
+                        # every server numbers its outputs from the same names, so they can't share a folder
+                        destination = os.path.join(destination, re.sub(r"[^\w.-]", "_", server))
+                    downloaders[server] = OutputDownloader(server or os.getenv("COMFYUI_SERVER_ADDRESS"), destination)
+            # the GUI keeps its validator running between queue runs
+            started_validator = self.validator is not None and not self.validator.running
+            if started_validator:
+                self.validator.start()
+            profiler = SamplingProfiler() if self.profile_directory else None
+            if profiler:
+                profiler.start()
+            try:
+                await self._process_queue(output_processor, downloaders)
+            finally:
+                if profiler:
+                    profiler.stop()
+                    self._write_profile(profiler)
+                if started_validator:
+                    self.validator.stop()
+                if output_processor:
+                    # a finished queue should mean finished files
+                    await asyncio.get_running_loop().run_in_executor(None, output_processor.shutdown)
+                for downloader in downloaders.values():
+                    await downloader.close()
+
+    def _write_profile(self, profiler):
+        file_path = profile_path(self.profile_directory)
+        try:
+            profiler.write(file_path)
+        except OSError as e:
+            logger.warning(f"Failed to write the queue profile: {e}")
+            return
+        logger.info(f"Wrote the queue profile to {file_path}")
+        for frame, count in profiler.hotspots():
+            logger.debug(f"{count} samples in {frame}")
+
+    def check_servers(self):
+        """
+        Checks that iterations can run on any of the queue's servers.
+
+        Raises:
+            ValueError: If OUTPUT_DOWNLOAD_FOLDER isn't set, since outputs can't be read from a single local ComfyUI folder, or if COMFYUI_SERVERS doesn't list the queue's servers, since as_image would only upload images to some of them
+        """
+        if not os.getenv("OUTPUT_DOWNLOAD_FOLDER"):
+            raise ValueError("Running iterations on several servers requires OUTPUT_DOWNLOAD_FOLDER to be set")
+        upload_servers = {server for server in os.getenv("COMFYUI_SERVERS", "").split(",") if server}
+        if upload_servers != set(self.router.servers):
+            raise ValueError(f"COMFYUI_SERVERS must list the queue's servers {self.router.servers} so images are uploaded to all of them")
+
+    async def _dispatch(self, job, iteration, workflow_hash, output_processor, downloaders):
+        """Waits for the router to choose a server for an iteration, then starts it there and returns its task. The iteration runs from its own IterationRun, so the job can move on to its next iteration while this one runs."""
+        models = model_inputs(job.workflow.api_workflow)
+        run_state = IterationRun.from_job(job)
+        server = await self.router.reserve(models)
+
+        async def run():
+            logger.info(f"Running iteration {iteration} of {job.original_workflow.name} on {server}...")
+            succeeded = False
+            try:
+                outputs = await run_job_on_server(
+                    run_state, output_processor=output_processor, downloader=downloaders.get(server), server_address=server
+                )
+                succeeded = True
+            finally:
+                # a failed prompt may not have loaded its models, so only a successful one changes the server's affinity
+                await self.router.release(server, models if succeeded else None)
+            if workflow_hash:
+                self.result_index.record(workflow_hash, outputs)
+            job.record_result(iteration, outputs)
+            job.progress += 1
+
+        return asyncio.ensure_future(run())
+
+    async def _process_queue(self, output_processor=None, downloaders=None):
+        downloaders = downloaders or {}
+        logger.info("Starting queue...")
+        self._stop_event.clear()
+        if self.cache_aware_order:
+            await asyncio.get_running_loop().run_in_executor(None, self.reorder_for_cache)
+        while self.queue:
+            logger.info("Starting next job in queue...")
+            try:
+                job = self.queue[0]
+                if self._stop_event.is_set():
+                    logger.info("The queue is paused. Waiting for resume.")
+                    return
+                # check again in case the problem was fixed since the last pass
+                if job.problem and self.validator and self.validator.check(job):
+                    logger.warning(f"Skipping {job.original_workflow.name} with {job.tweaks.name}: {job.problem}")
+                    job.status = JobStatus.FAILED
+                    self.queue.remove(job)
+                    self.history.append(job)
+                    continue
+                # run the workflow
+                logger.info("Sending workflow to server...")
+                renderer = RenderAhead(job, self.render_ahead) if self.render_ahead > 0 else None
+                # iterations running on other servers when there is a router
+                dispatched = []
                 try:
-                    job = self.queue[0]
-                    if self._stop_event.is_set():
-                        logger.info("The queue is paused. Waiting for resume.")
-                        return
-                    # run the workflow
-                    logger.info("Sending workflow to server...")
-                    for i in range(job.remaining):
+                    for _ in range(job.remaining):
                         if not self.queue:
                             break
                         if self._stop_event.is_set():
@@ -175,62 +520,158 @@ class JobQueue:
                             job.status = JobStatus.PENDING
                             while self._stop_event.is_set():
                                 await asyncio.sleep(1)
-                        if self.queue[0] != job:
+                        if self.queue[0] is not job:
                             logger.info("Job no longer at front of queue. Breaking out of loop...")
                             job.status = JobStatus.PENDING
                             break
                         job.status = JobStatus.IN_PROGRESS
                         start_time = time.time()
-                        job.workflow = job.original_workflow.apply_tweaks(job.tweaks)
-                        # regenerate the tweaks for new random values and to add one to iteration
-                        job.tweaks = job.tweaks.regenerate()
-                        logger.info(f"Running job ({job.progress + 1}/{job.amount})...")
-                        await run_job_on_server(job)
-                        job.progress = i + 1
+                        iteration = job.tweaks._iteration
+                        if renderer:
+                            rendered = await renderer.next()
+                            if rendered.iteration != job.tweaks._iteration:
+                                raise RuntimeError(f"Rendered iteration {rendered.iteration} does not match job iteration {job.tweaks._iteration}")
+                            job.workflow = rendered.workflow
+                            job.tweaks = rendered.next_tweaks
+                        else:
+                            job.workflow = job.original_workflow.apply_tweaks(job.tweaks)
+                            # regenerate the tweaks for new random values and to add one to iteration
+                            job.tweaks = job.tweaks.regenerate()
+                        workflow_hash = None
+                        previous_outputs = None
+                        if self.reuse_results != ReuseMode.OFF:
+                            workflow_hash = hash_workflow(job.workflow.api_workflow)
+                            previous_outputs = self.result_index.lookup(workflow_hash)
+                        if previous_outputs:
+                            logger.info(f"Reusing previous results for job ({job.progress + 1}/{job.amount})...")
+                            outputs = reuse_outputs(previous_outputs, self.reuse_results)
+                        elif self.router:
+                            # don't keep dispatching iterations of a job that is already failing
+                            for task in dispatched:
+                                if task.done() and task.exception():
+                                    raise task.exception()
+                            dispatched.append(await self._dispatch(job, iteration, workflow_hash, output_processor, downloaders))
+                            continue
+                        else:
+                            logger.info(f"Running job ({job.progress + 1}/{job.amount})...")
+                            outputs = await run_job_on_server(job, output_processor=output_processor, downloader=downloaders.get(None))
+                            if workflow_hash:
+                                self.result_index.record(workflow_hash, outputs)
+                        job.record_result(iteration, outputs)
+                        job.progress += 1
                         end_time = time.time()
                         elapsed_time = timedelta(seconds=end_time - start_time)
                         logger.info(f"Total time taken: {elapsed_time}")
                     else:
+                        await asyncio.gather(*dispatched)
                         job.progress = job.amount
                         job.status = JobStatus.COMPLETED
-                        self.history.append(self.queue.pop(0))
-                except Exception as e:
-                    traceback.print_exc()
-                    job.status = JobStatus.FAILED
-                    logger.info(f"Job failed with error: {e}")
-                    logger.info("Stopping the queue...")
-                    traceback.print_exc()
-                    self.history.append(self.queue.pop(0))
-                    self.stop()
-                    return
-            logger.info("Queue completed.")
+                        self.queue.remove(job)
+                        self.history.append(job)
+                finally:
+                    # renders for a job that was reordered, removed or finished are stale
+                    if renderer:
+                        renderer.cancel()
+                    # a job only leaves the front once its iterations are done, so its progress stays accurate
+                    await asyncio.gather(*dispatched)
+            except Exception as e:
+                traceback.print_exc()
+                job.status = JobStatus.FAILED
+                logger.info(f"Job failed with error: {e}")
+                logger.info("Stopping the queue...")
+                traceback.print_exc()
+                if job in self.queue:
+                    self.queue.remove(job)
+                self.history.append(job)
+                self.stop()
+                return
+        logger.info("Queue completed.")
+        if self.result_index is not None:
+            logger.info(self.result_index.summary())
+        logger.info(str(file_cache.stats()))
 
     def stop(self):
         """Stops the queue, preventing further processing after the current job has been completed."""
         self._stop_event.set()
 
 
+# (workflow fingerprint, tweaks structure) of every successful validation, least recently used first
+VALIDATION_CACHE_SIZE = 4096
+_validation_cache = OrderedDict()
+_validation_cache_lock = threading.Lock()
+
+
 @dataclass
 class Workflow:
     gui_workflow: dict[str, str] = field(default_factory=dict)
     api_workflow: dict[str, str] = field(default_factory=dict)
     name: str = "Default Workflow"
 
+    @functools.cached_property
+    def fingerprint(self):
+        """A hash of the GUI and API workflows. Workflows are treated as immutable once loaded, so it is only computed once."""
+        return hash_workflow({"gui": self.gui_workflow, "api": self.api_workflow})
+
     @classmethod
     def from_image(cls, image_path, name="Default Workflow"):
         """Creates a workflow from the "workflow" and "prompt" metadata on an image. The image requires both metadata to be present, otherwise an IncompleteImageWorkflowError is raised.
 
-        The workflow metadata is needed to reconstruct the GUI after generation, and the prompt metadata is needed to repopulate the GUI workflow with any dynamically determined values (e.g. wildcards)."""
-        with Image.open(image_path) as image:
-            try:
+        The workflow metadata is needed to reconstruct the GUI after generation, and the prompt metadata is needed to repopulate the GUI workflow with any dynamically determined values (e.g. wildcards).
+
+        PNG metadata is read straight from the text chunks without decoding the image. Other formats are opened with PIL.
+
+        Parsed workflows are cached by path, size and modification time, so loading the same unchanged image again costs a single stat and returns a workflow sharing the same data. Treat workflows as read only."""
+        image_path = os.path.abspath(str(image_path))
+        stat = os.stat(image_path)
+        workflow = _load_image_workflow(image_path, stat.st_size, stat.st_mtime_ns)
+        if workflow.name == name:
+            return workflow
+        named_workflow = dataclasses.replace(workflow, name=name)
+        if "fingerprint" in workflow.__dict__:
+            # the data is shared, so the fingerprint doesn't need to be computed again
+            named_workflow.__dict__["fingerprint"] = workflow.fingerprint
+        return named_workflow
+
+    @classmethod
+    def _parse_image(cls, image_path, name="Default Workflow"):
+        try:
+            metadata = read_png_text(image_path, keys=("workflow", "prompt"))
+        except InvalidPngError:
+            with Image.open(image_path) as image:
                 metadata = image.info
-                gui_workflow = json.loads(metadata["workflow"])
-                api_workflow = json.loads(metadata["prompt"])
-            except KeyError as e:
-                traceback.print_exc()
-                missing_key = re.search(r"'(.+)'", str(e)).group(1)
-                raise IncompleteImageWorkflowError(f"The provided image does not have the required metadata: \"{missing_key}\"")
-            return cls(gui_workflow, api_workflow, name=name)
+        try:
+            gui_workflow = json.loads(metadata["workflow"])
+            api_workflow = json.loads(metadata["prompt"])
+        except KeyError as e:
+            traceback.print_exc()
+            missing_key = re.search(r"'(.+)'", str(e)).group(1)
+            raise IncompleteImageWorkflowError(f"The provided image does not have the required metadata: \"{missing_key}\"")
+        return cls(gui_workflow, api_workflow, name=name)
+
+    @classmethod
+    def from_folder(cls, folder, file_glob="*.png", max_workers=None):
+        """Creates workflows from every image in a folder and its subdirectories that matches the glob pattern. The metadata of the images is read in parallel. Images without a complete workflow are skipped.
+
+        Args:
+            folder (str): the folder to search in
+            file_glob (str, optional): the glob pattern to match. Defaults to "*.png".
+            max_workers (int, optional): the amount of threads reading images. Defaults to the ThreadPoolExecutor default.
+
+        Returns:
+            dict[str, Workflow]: the workflows by image path, named after the image
+        """
+        image_paths = sorted(glob.glob(os.path.join(folder, "**", file_glob), recursive=True))
+
+        def load(image_path):
+            try:
+                return cls.from_image(image_path, name=os.path.basename(image_path))
+            except (IncompleteImageWorkflowError, json.JSONDecodeError, OSError) as e:
+                logger.debug(f"Skipping {image_path}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            workflows = executor.map(load, image_paths)
+            return {path: workflow for path, workflow in zip(image_paths, workflows) if workflow is not None}
 
     def save(self, gui_workflow_path, api_workflow_path=None):
         """Saves the GUI workflow and optionally an API workflow to the specified paths."""
@@ -299,7 +740,14 @@ class Workflow:
             return nodes[0]
 
     def validate(self, tweaks: Tweaks):
-        """This function simply applies tweaks, and passes up an error if it fails."""
+        """This function simply applies tweaks, and passes up an error if it fails.
+
+        Whether tweaks apply only depends on their selectors and field names, so successful validations are cached by the workflow fingerprint and the structure of the tweaks. Validating structurally identical tweaks again is a dictionary lookup."""
+        cache_key = (self.fingerprint, tweaks.structure)
+        with _validation_cache_lock:
+            if cache_key in _validation_cache:
+                _validation_cache.move_to_end(cache_key)
+                return
         try:
             # print("Validating tweaks by applying them to the workflow...")
             self.apply_tweaks(tweaks)
@@ -308,13 +756,18 @@ class Workflow:
             traceback.print_exc()
             logger.error(f"Error validating tweaks: {type(e).__name__} {e}")
             raise e
+        with _validation_cache_lock:
+            _validation_cache[cache_key] = True
+            if len(_validation_cache) > VALIDATION_CACHE_SIZE:
+                _validation_cache.popitem(last=False)
 
     def apply_tweaks(self, tweaks):
         """Creates a new workflow with the tweaks applied. The original workflow is not modified."""
         # look for the nodes in the gui_workflow using the selector
 
-        # copy is required here otherwise we end up mutating that state of our original workflow
-        resulting_workflow = Workflow(copy(self.gui_workflow), copy(self.api_workflow))
+        # a deep copy is required here otherwise we end up mutating the nodes of our original workflow,
+        # which matters once iterations are rendered ahead while an earlier one is still running
+        resulting_workflow = Workflow(deepcopy(self.gui_workflow), deepcopy(self.api_workflow))
 
         for tweak in tweaks.tweaks:
             # use the selector in the tweak to find the node in the gui_workflow
@@ -343,6 +796,15 @@ class Workflow:
                 resulting_workflow.api_workflow.update({gui_node["id"]: api_node})
         return resulting_workflow
 
+WORKFLOW_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=WORKFLOW_CACHE_SIZE)
+def _load_image_workflow(image_path, size, mtime_ns):
+    # size and mtime are only part of the cache key, so edited images are parsed again
+    return Workflow._parse_image(image_path, name=os.path.basename(image_path))
+
+
 @dataclass(frozen=True)
 class Tweak:
     selector: dict[str, str] = field(default_factory=dict)
@@ -366,12 +828,22 @@ class Tweaks:
     name: str = "Default Tweaks"
     _original_yaml: str = field(default="")
     _iteration: int = field(default=0)
+    # the amount of iterations the tweaks file asks for, e.g. the size of a sweep
+    amount: int = field(default=None, compare=False, repr=False)
 
     _plugins_initialized: ClassVar[bool] = field(default=False, init=False)
 
     def __len__(self):
         return len(self.tweaks)
 
+    @property
+    def structure(self):
+        """The selectors and field names of the tweaks, without their values. Two tweaks with the same structure either both apply to a workflow or both fail."""
+        return tuple(
+            (tuple(sorted(tweak.selector.items())), tuple(tweak.changes.keys()))
+            for tweak in self.tweaks
+        )
+
     def initialize_plugins():
         # runs all the registered tweaks plugins inside of filters
         if Tweaks._plugins_initialized:
@@ -401,13 +873,13 @@ class Tweaks:
         return Tweaks(self.tweaks + [tweak])
 
     @classmethod
-    def register(cls, plugin_name=None, plugin_type=PluginType.GLOBALS):
-        """Registers a function for use as a Jinja filter. If plugin name is not provided, defaults to the function name."""
+    def register(cls, plugin_name=None, plugin_type=PluginType.GLOBALS, stateful=False):
+        """Registers a function for use as a Jinja filter. If plugin name is not provided, defaults to the function name. Mark plugins that keep state between renders, like the position of a cycle, as stateful so templates using them are always rendered in this process."""
         def decorator(func):
-            if not plugin_name:
-                _plugin_name = func.__name__
-            plugin = Plugin(_plugin_name, func, plugin_type)
+            _plugin_name = plugin_name or func.__name__
+            plugin = Plugin(_plugin_name, func, plugin_type, stateful)
             cls.plugins.append(plugin)
+            cls.invalidate_environment()
             @functools.wraps(func)
             def wrapper(*args, **kwargs):
                 return func(*args, **kwargs)
@@ -416,24 +888,181 @@ class Tweaks:
 
     @classmethod
     def environment(cls):
-        env = Environment()
-        for plugin in cls.plugins:
-            if plugin.plugin_type == PluginType.GLOBALS:
-                env.globals[plugin.name] = plugin.func
-            elif plugin.plugin_type == PluginType.FILTERS:
-                env.filters[plugin.name] = plugin.func
-        return env
+        """
+        Returns the jinja environment shared by every render. It is built on first use and again whenever the registered or discovered plugins change.
+
+        The environment is safe to use from several threads at once. Its globals and filters are never changed after it is built, since a plugin registered later gets a new environment instead, and the iteration is passed to each render rather than stored on it. Compiled templates are cached in memory and, if bytecode_cache_directory is set, on disk so they survive restarts.
+        """
+        env = cls._cached_environment()
+        if env is not None:
+            return env
+        with cls._environment_lock:
+            env = cls._cached_environment()
+            if env is not None:
+                return env
+            env = Environment(bytecode_cache=cls._bytecode_cache())
+            for plugin in cls.plugins:
+                if plugin.plugin_type == PluginType.GLOBALS:
+                    env.globals[plugin.name] = plugin.func
+                elif plugin.plugin_type == PluginType.FILTERS:
+                    env.filters[plugin.name] = plugin.func
+            # plugins that haven't been imported yet stand in until a template calls them
+            for entry in cls.lazy_plugins.values():
+                target = env.filters if entry.plugin_type == PluginType.FILTERS.value else env.globals
+                target.setdefault(entry.name, LazyPlugin(entry))
+            env.stateful_plugins = frozenset(
+                [plugin.name for plugin in cls.plugins if plugin.stateful]
+                + [entry.name for entry in cls.lazy_plugins.values() if entry.stateful]
+            )
+            # the plugin set is stored with the environment, so plugins assigned directly still get a new one
+            cls._environment = (tuple(cls.plugins), cls.lazy_plugins, env)
+            return env
+
+    @classmethod
+    def _cached_environment(cls):
+        cached = cls._environment
+        # plugins are compared by identity, so replacing one is noticed even when the count stays the same
+        if (
+            cached
+            and cached[1] is cls.lazy_plugins
+            and len(cached[0]) == len(cls.plugins)
+            and all(map(operator.is_, cached[0], cls.plugins))
+        ):
+            return cached[2]
+        return None
+
+    @classmethod
+    def invalidate_environment(cls):
+        """Drops the shared jinja environment, so the next render builds one with the current plugins."""
+        with cls._environment_lock:
+            cls._environment = None
+
+    @classmethod
+    def _bytecode_cache(cls):
+        if not cls.bytecode_cache_directory:
+            return None
+        try:
+            os.makedirs(cls.bytecode_cache_directory, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"Not caching compiled tweaks templates: {e}")
+            return None
+        return FileSystemBytecodeCache(cls.bytecode_cache_directory)
+
+    @classmethod
+    def template(cls, yaml_string):
+        """
+        Compiles a tweaks template with the shared environment. Templates are looked up by their source, first in memory and then in the bytecode cache, so the same tweaks are only compiled once.
+
+        Returns:
+            jinja2.Template: the compiled template, which can be rendered from several threads at once
+        """
+        env = cls.environment()
+        name = hashlib.sha1(yaml_string.encode("utf-8")).hexdigest()
+        # env.cache only holds templates from a loader, which the environment doesn't have, so the names can't clash
+        template = env.cache.get(name)
+        if template is not None:
+            return template
+        bucket = None
+        if env.bytecode_cache is not None:
+            bucket = env.bytecode_cache.get_bucket(env, name, None, yaml_string)
+        code = bucket.code if bucket else None
+        if code is None:
+            code = env.compile(yaml_string)
+            if bucket:
+                bucket.code = code
+                env.bytecode_cache.set_bucket(bucket)
+        template = env.template_class.from_code(env, code, env.make_globals(None))
+        env.cache[name] = template
+        return template
+
+    @classmethod
+    def discover_plugins(cls, directory=None):
+        """
+        Finds the plugins in a plugin directory without importing them. Each plugin's module is imported the first time a template uses one of its functions.
+
+        Args:
+            directory (str, optional): the plugin directory. Defaults to the plugins folder in the user data directory.
+
+        Returns:
+            dict[str, ManifestEntry]: the plugins that were found, by name
+        """
+        cls.lazy_plugins = load_manifest(directory)
+        cls.invalidate_environment()
+        return cls.lazy_plugins
+
+    @classmethod
+    def plugins_used_by(cls, yaml_string):
+        """Returns the names of the globals and filters a tweaks template uses. Results are cached with the environment's templates."""
+        env = cls.environment()
+        key = ("plugins used by", hashlib.sha1(yaml_string.encode("utf-8")).hexdigest())
+        used = env.cache.get(key)
+        if used is None:
+            tree = env.parse(yaml_string)
+            used = frozenset(
+                [node.name for node in tree.find_all(nodes.Name) if node.ctx == "load"]
+                + [node.name for node in tree.find_all(nodes.Filter)]
+            )
+            env.cache[key] = used
+        return used
+
+    @classmethod
+    def is_stateful(cls, yaml_string):
+        """Whether a tweaks template uses a stateful plugin, so rendering it in another process would lose or fork that state."""
+        return not cls.environment().stateful_plugins.isdisjoint(cls.plugins_used_by(yaml_string))
+
+    @classmethod
+    def render_yaml(cls, yaml_string, iteration=0):
+        """Renders a tweaks template with jinja and parses the resulting yaml. The result is made of plain python objects so it can be sent between processes."""
+        cls.initialize_plugins()
+        template = cls.template(yaml_string)
+        # passed to render instead of set on the environment, so other threads can render at the same time
+        return safe_load(template.render(iteration=iteration))
+
+    @classmethod
+    def use_render_pool(cls, render_pool):
+        """Renders all tweaks templates in the given RenderPool from now on. Pass None to render in the calling thread again."""
+        cls.render_pool = render_pool
+
+    @classmethod
+    @contextlib.contextmanager
+    def dry_run(cls):
+        """Renders tweaks in the calling thread without side effects while the context is active. Plugins that cycle through items or copy and upload files check is_dry_run and skip those steps."""
+        previous = getattr(cls._render_state, "dry_run", False)
+        cls._render_state.dry_run = True
+        try:
+            yield
+        finally:
+            cls._render_state.dry_run = previous
+
+    @classmethod
+    def is_dry_run(cls):
+        return getattr(cls._render_state, "dry_run", False)
+
+    @classmethod
+    @contextlib.contextmanager
+    def journal_cycles(cls):
+        """Records every cycle moved by renders in the calling thread while the context is active. Pass the journal to `cycle_store.rewind` to undo the moves if the renders are thrown away."""
+        previous = getattr(cls._render_state, "cycle_journal", None)
+        journal = cls._render_state.cycle_journal = []
+        try:
+            yield journal
+        finally:
+            cls._render_state.cycle_journal = previous
+
+    @classmethod
+    def cycle_journal(cls):
+        return getattr(cls._render_state, "cycle_journal", None)
 
     @classmethod
     def from_yaml(cls, yaml_string, name="Default Tweaks", iteration=0):
         """Import tweaks from a yaml string. The iteration key argument is a custom variable passed into the yaml. This way people can use jinja to modify their workflows."""
-        cls.initialize_plugins()
-        env = Tweaks.environment()
-        env.globals["iteration"] = iteration
         if yaml_string:
-            template = env.from_string(yaml_string)
-            rendered_yaml = safe_load(template.render())
-            result = cls([Tweak(tweak["selector"], tweak["changes"]) for tweak in rendered_yaml["tweaks"]], name=name, _original_yaml=yaml_string, _iteration=iteration)
+            # dry runs are flagged per thread, and stateful plugins keep their state in this process, so neither can be sent to the render pool
+            if cls.render_pool and not cls.is_dry_run() and not cls.is_stateful(yaml_string):
+                rendered_yaml = cls.render_pool.render(yaml_string, iteration)
+            else:
+                rendered_yaml = cls.render_yaml(yaml_string, iteration)
+            result = cls([Tweak(tweak["selector"], tweak["changes"]) for tweak in rendered_yaml["tweaks"]], name=name, _original_yaml=yaml_string, _iteration=iteration, amount=rendered_yaml.get("amount"))
         else:
             result = cls(name=name)
         return result
@@ -444,4 +1073,80 @@ class Tweaks:
         with open(tweaks_file_path) as file:
             return cls.from_yaml(file.read(), name=name)
 
-Tweaks.plugins = []
\ No newline at end of file
+Tweaks.plugins = []
+Tweaks.lazy_plugins = {}
+Tweaks.render_pool = None
+Tweaks._render_state = threading.local()
+# (plugins, lazy plugins, environment), replaced as a whole so readers never see half of it
+Tweaks._environment = None
+Tweaks._environment_lock = threading.Lock()
+# compiled templates are kept here between runs, set it to None to only cache them in memory
+Tweaks.bytecode_cache_directory = os.path.join(user_data_dir("ComfyTweaker", "ComfyTweaker", roaming=True), "template_cache")
+
+
+def _initialize_render_worker(plugin_paths, lazy_plugins):
+    # forked workers inherit the parent's random state, so every worker would draw the same values
+    random.seed()
+    Tweaks.initialize_plugins()
+    Tweaks.lazy_plugins = lazy_plugins
+    for module_name, plugin_path in plugin_paths.items():
+        # spawned workers start without any plugins, forked ones already have them registered
+        if module_name not in sys.modules:
+            import_plugin(module_name, plugin_path)
+
+
+def _render_in_worker(yaml_string, iteration, environ):
+    # the filters read their folders from environment variables, which may have changed since the worker started
+    os.environ.update(environ)
+    return Tweaks.render_yaml(yaml_string, iteration)
+
+
+def _warm_render_worker(yaml_string):
+    if yaml_string:
+        Tweaks.template(yaml_string)
+        # import the lazy plugins the template calls now, instead of during its first render
+        env = Tweaks.environment()
+        for name in Tweaks.plugins_used_by(yaml_string):
+            plugin = env.globals.get(name) or env.filters.get(name)
+            if isinstance(plugin, LazyPlugin):
+                plugin.load()
+    return os.getpid()
+
+
+class RenderPool:
+    """
+    Renders tweaks templates in a pool of worker processes, so CPU heavy templates are not limited to one core by the GIL. Enable it for all tweaks with `Tweaks.use_render_pool(RenderPool())`.
+
+    Workers import the built in filters and every plugin loaded with `import_plugin` when they start, and know about the plugins found by `Tweaks.discover_plugins`. Plugins imported or discovered after the pool is created are not available to it.
+
+    Templates that use stateful plugins, like the folder filters that can cycle, are always rendered in the calling process instead, so cycles advance in the same order as a serial render.
+    """
+    def __init__(self, max_workers=None, mp_context=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(
+            self.max_workers,
+            mp_context=mp_context,
+            initializer=_initialize_render_worker,
+            initargs=(dict(imported_plugins), dict(Tweaks.lazy_plugins)),
+        )
+
+    def warm_up(self, yaml_string=None):
+        """Starts every worker process and waits until they have finished initializing. If a tweaks template is given, it is compiled and the plugins it uses are imported, so its first renders are not slower than the rest. The compiled template is shared through the bytecode cache."""
+        futures = [self._executor.submit(_warm_render_worker, yaml_string) for _ in range(self.max_workers)]
+        for future in futures:
+            future.result()
+
+    def submit(self, yaml_string, iteration=0):
+        """Renders a tweaks template in a worker process.
+
+        Returns:
+            concurrent.futures.Future: resolves to the rendered yaml as plain python objects
+        """
+        return self._executor.submit(_render_in_worker, yaml_string, iteration, dict(os.environ))
+
+    def render(self, yaml_string, iteration=0):
+        """Renders a tweaks template in a worker process and waits for the result."""
+        return self.submit(yaml_string, iteration).result()
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
@@ -0,0 +1,93 @@
+import hashlib
+import json
+
+from comfy_tweaker.results import canonicalize
+
+
+def _is_link(value, api_workflow):
+    # links in API workflows are [node id, output index]
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and isinstance(value[1], int)
+        and str(value[0]) in api_workflow
+    )
+
+
+def node_signatures(api_workflow):
+    """
+    Hashes every node of an API workflow together with everything upstream of it, the same way ComfyUI decides whether a node's cached output can be reused. Two nodes have the same signature only if they have the same class, the same inputs and identical upstream subgraphs.
+
+    Args:
+        api_workflow (dict): the API workflow after tweaks have been applied
+
+    Returns:
+        dict[str, str]: the signature of each node by node id
+    """
+    api_workflow = {str(node_id): node for node_id, node in api_workflow.items()}
+    signatures = {}
+
+    def signature(node_id, visiting=()):
+        if node_id in signatures:
+            return signatures[node_id]
+        if node_id in visiting:
+            raise ValueError(f"Workflow has a cycle through node {node_id}")
+        node = api_workflow[node_id]
+        inputs = {}
+        for name, value in node.get("inputs", {}).items():
+            if _is_link(value, api_workflow):
+                inputs[name] = ["link", signature(str(value[0]), visiting + (node_id,)), value[1]]
+            else:
+                inputs[name] = canonicalize(value)
+        canonical = json.dumps({"class_type": node.get("class_type"), "inputs": inputs}, sort_keys=True, separators=(",", ":"))
+        signatures[node_id] = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+        return signatures[node_id]
+
+    for node_id in api_workflow:
+        signature(node_id)
+    return signatures
+
+
+def expected_cache_hit_rate(signature_sets):
+    """
+    Estimates the share of nodes ComfyUI would take from its cache when prompts run in the given order, assuming it keeps the outputs of the previous prompt and starts out empty.
+
+    Args:
+        signature_sets (list[set[str]]): the node signatures of each prompt, in run order
+
+    Returns:
+        float: cached nodes divided by all nodes, 0 if there are no nodes
+    """
+    hits = 0
+    total = 0
+    previous = set()
+    for signatures in signature_sets:
+        hits += len(signatures & previous)
+        total += len(signatures)
+        previous = signatures
+    return hits / total if total else 0.0
+
+
+def order_for_cache(signature_sets):
+    """
+    Orders prompts so that each one shares as many nodes as possible with the one before it. Prompts with identical graphs are kept together in their original order, and the first prompt stays first. Ties go to the prompt that came first.
+
+    Args:
+        signature_sets (list[set[str]]): the node signatures of each prompt
+
+    Returns:
+        list[int]: indexes into signature_sets in the new order
+    """
+    groups = {}
+    for index, signatures in enumerate(signature_sets):
+        groups.setdefault(frozenset(signatures), []).append(index)
+    # dicts keep insertion order, so groups are ordered by their first prompt
+    remaining = list(groups.items())
+    order = []
+    current, indexes = remaining.pop(0) if remaining else (None, [])
+    order.extend(indexes)
+    while remaining:
+        best = max(range(len(remaining)), key=lambda i: (len(current & remaining[i][0]), -i))
+        current, indexes = remaining.pop(best)
+        order.extend(indexes)
+    return order
@@ -1,5 +1,5 @@
 #This is an example that uses the websockets api to know when a prompt execution is done
-#Once the prompt execution is done it downloads the images using the /history endpoint
+#Output images are collected from the executed messages, using the /history endpoint only after reconnecting
 
 from loguru import logger
 import websockets
@@ -7,142 +7,276 @@ import websockets
 import asyncio
 import json
 import os
+import queue
+import threading
 import time
 import urllib.parse
 import urllib.request
 import uuid
+from dataclasses import dataclass, field
 from io import BytesIO
 
-from filelock import FileLock, Timeout
 import websocket  # NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
 from PIL import Image, PngImagePlugin
 
-def queue_prompt(prompt, client_id):
-    server_address = os.getenv("COMFYUI_SERVER_ADDRESS")
+from comfy_tweaker.png import PngTextInjector
+
+def queue_prompt(prompt, client_id, server_address=None):
+    server_address = server_address or os.getenv("COMFYUI_SERVER_ADDRESS")
     p = {"prompt": prompt, "client_id": str(client_id)}
     data = json.dumps(p).encode('utf-8')
     req =  urllib.request.Request("http://{}/prompt".format(server_address), data=data)
     return json.loads(urllib.request.urlopen(req).read())
 
-def get_image(filename, subfolder, folder_type):
-    server_address = os.getenv("COMFYUI_SERVER_ADDRESS")
+def get_image(filename, subfolder, folder_type, server_address=None):
+    server_address = server_address or os.getenv("COMFYUI_SERVER_ADDRESS")
     data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
     url_values = urllib.parse.urlencode(data)
     with urllib.request.urlopen("http://{}/view?{}".format(server_address, url_values)) as response:
         return response.read()
 
-def get_history(prompt_id):
-    server_address = os.getenv("COMFYUI_SERVER_ADDRESS")
+def get_history(prompt_id, server_address=None):
+    server_address = server_address or os.getenv("COMFYUI_SERVER_ADDRESS")
     with urllib.request.urlopen("http://{}/history/{}".format(server_address, prompt_id)) as response:
         return json.loads(response.read())
 
+PNG_TRAILER = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+
+def wait_for_complete_file(image_path, timeout=20, interval=0.05):
+    """
+    Waits until ComfyUI has finished writing an output image. ComfyUI reports a node as executed once its save returns, but on slow or network disks the file can still be settling, so the file must keep the same size and modification time between two checks. PNGs must also end with their IEND chunk.
+
+    Args:
+        image_path (str): the path of the output image
+        timeout (float, optional): seconds to wait before giving up. Defaults to 20.
+        interval (float, optional): seconds between checks. Defaults to 0.05.
+
+    Returns:
+        bool: True if the file is complete, False if it timed out
+    """
+    deadline = time.monotonic() + timeout
+    last_stat = None
+    while time.monotonic() < deadline:
+        try:
+            stat = os.stat(image_path)
+        except FileNotFoundError:
+            stat = None
+        if stat and stat.st_size > 0 and last_stat and (stat.st_size, stat.st_mtime_ns) == (last_stat.st_size, last_stat.st_mtime_ns):
+            if not image_path.lower().endswith(".png"):
+                return True
+            with open(image_path, "rb") as file:
+                file.seek(-len(PNG_TRAILER), os.SEEK_END)
+                if file.read() == PNG_TRAILER:
+                    return True
+        last_stat = stat
+        time.sleep(interval)
+    return False
+
+
+def write_image_metadata(image_path, gui_workflow, tweaks_yaml, timeout=20):
+    if not wait_for_complete_file(image_path, timeout=timeout):
+        logger.error(f"{image_path} was not completely written after {timeout} seconds. Image taking too long to write from ComfyUI?")
+        return False
+    with Image.open(image_path) as img:
+        img.load()
+        info = dict(img.info)
+        info['workflow'] = json.dumps(gui_workflow)
+        info['tweaks'] = json.dumps(tweaks_yaml)
+        metadata = PngImagePlugin.PngInfo()
+        for k, v in info.items():
+            metadata.add_text(k, v)
+        # write next to the image and swap it in, so nobody sees a half written file
+        temporary_path = f"{image_path}.tmp"
+        img.save(temporary_path, "PNG", pnginfo=metadata)
+    os.replace(temporary_path, image_path)
+    return True
+
 def add_job_metadata_to_image(image_path, job):
-    lock_path = f"{image_path}.lock"
-    lock = FileLock(lock_path, timeout=20)
-    try:
-        with lock:
-            img = Image.open(image_path)
-            img.info['workflow'] = json.dumps(job.workflow.gui_workflow)
-            img.info['tweaks'] = json.dumps(job.tweaks._original_yaml)
-            metadata = PngImagePlugin.PngInfo()
-            for k, v in img.info.items():
-                metadata.add_text(k, v)
-            img.save(image_path, "PNG", pnginfo=metadata)
-    except Timeout:
-        logger.error(f"Failed to acquire lock for {image_path}. Image taking too long to write from ComfyUI?")
-
-async def generate_images(ws, job):
+    write_image_metadata(image_path, job.workflow.gui_workflow, job.tweaks._original_yaml)
+
+
+@dataclass
+class OutputRecord:
+    """The outputs of one iteration of a job. The workflow and tweaks are captured when the record is made, since the job moves on to its next iteration while the outputs are processed."""
+    job: object
+    gui_workflow: dict
+    tweaks_yaml: str
+    image_paths: list[str] = field(default_factory=list)
+
+    @classmethod
+    def from_job(cls, job, image_paths):
+        return cls(job, job.workflow.gui_workflow, job.tweaks._original_yaml, list(image_paths))
+
+
+class OutputProcessor:
     """
-    Generate the images, and write the GUI workflow into the resulting file.
+    Writes job metadata into output images on worker threads, so the next prompt can be queued as soon as the current one finishes executing.
+
+    At most max_pending records wait to be processed. Submitting more blocks until a worker catches up, which holds the queue back when the disk falls behind.
+    """
+    def __init__(self, workers=2, max_pending=8):
+        self._records = queue.Queue(maxsize=max_pending)
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            record = self._records.get()
+            try:
+                if record is None:
+                    return
+                process_output_record(record)
+            except Exception as e:
+                logger.error(f"Failed to process outputs of {record.image_paths}: {e}")
+            finally:
+                self._records.task_done()
+
+    def submit(self, record):
+        """Hands a record to the workers. Blocks while max_pending records are already waiting."""
+        self._records.put(record)
+
+    def join(self):
+        """Waits until every submitted record has been processed."""
+        self._records.join()
+
+    def shutdown(self):
+        """Processes the remaining records and stops the workers."""
+        for _ in self._threads:
+            self._records.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def process_output_record(record):
+    for image_path in record.image_paths:
+        # when comfyUI is working quickly, it can say a job is done but still be writing to a file,
+        # so this waits for the file to settle first
+        if write_image_metadata(image_path, record.gui_workflow, record.tweaks_yaml):
+            logger.info(f"Successfully saved gui workflow to {os.path.basename(image_path)}...")
+
+def websocket_uri(client_id, server_address=None):
+    server_address = server_address or os.getenv("COMFYUI_SERVER_ADDRESS")
+    return f"ws://{server_address}/ws?clientId={client_id}"
+
+def output_image_path(image):
+    """Reconstructs the local path of an output image reported by ComfyUI."""
+    comfyui_output_folder = os.getenv("COMFYUI_OUTPUT_FOLDER")
+    image_path = os.path.join(comfyui_output_folder, image['subfolder'], image['filename'])
+    if os.path.dirname(image_path) == os.path.join(comfyui_output_folder, "output"):
+        # this is a special case, when saved to root output folder
+        # if the subfolder is the root comfyui output folder, we don't need to re add the subfolder
+        image_path = os.path.join(comfyui_output_folder, image['filename'])
+    return image_path
+
+async def generate_images(ws, job, output_processor=None, downloader=None, server_address=None):
+    """
+    Generate the images, and write the GUI workflow into the resulting file. Returns the paths of the output images.
+
+    Outputs are collected from the "executed" messages ComfyUI sends as each node finishes, so metadata for early outputs is written while later nodes are still running. The prompt history is only fetched if the websocket had to reconnect and may have missed messages.
+
+    If an output processor is given, the GUI workflow is written by its workers after this returns. If a downloader is given, the images are downloaded from the server instead of being read from COMFYUI_OUTPUT_FOLDER.
+
+    The prompt runs on server_address, defaulting to COMFYUI_SERVER_ADDRESS.
     """
     workflow = job.workflow
     prompt = workflow.api_workflow
-    prompt_id = queue_prompt(prompt, job.client_id)['prompt_id']
+    prompt_id = queue_prompt(prompt, job.client_id, server_address)['prompt_id']
 
-    if not os.environ.get("COMFYUI_OUTPUT_FOLDER"):
+    if not downloader and not os.environ.get("COMFYUI_OUTPUT_FOLDER"):
         raise ValueError("COMFYUI_OUTPUT_FOLDER is not set. This is required to save the images.")
 
-    history_check_timer = time.time()
-    while True:
-        # if time.time() - history_check_timer > 15:  # Check every 5 seconds
-        #     try:
-        #         get_history(prompt_id)[prompt_id]
-        #         break
-        #     except KeyError:
-        #         history_check_timer = time.time()
+    output_paths = []
+    downloads = []
 
-        out = await ws.recv()
-        try:
-            message = json.loads(out)
+    async def handle_output_images(images):
+        new_images = []
+        new_paths = []
+        for image in images:
+            # we have to use the comfyui output folder to reconstruct the path of the image and apply our metadata
+            if "ComfyUI_temp" in image["filename"] or image.get("type") == "temp":
+                # Comfyui writes these files for things like image previews, which we don't want to write GUI data too
+                # as far as I can tell, comfy deletes them after the workflow is done
+                continue
+            image_path = downloader.destination_path(image) if downloader else output_image_path(image)
+            if image_path in output_paths:
+                continue
+            logger.info(f"Found an output image named {image['filename']}...")
+            # this feels naughty in the ComfyUI module, but im not sure how
+            # else to store this information
+            job.output_location = image_path
+            output_paths.append(image_path)
+            new_images.append(image)
+            new_paths.append(image_path)
+        if not new_paths:
+            return
+        if downloader:
+            # the metadata is written into the stream while downloading
+            texts = {"workflow": json.dumps(job.workflow.gui_workflow), "tweaks": json.dumps(job.tweaks._original_yaml)}
+            downloads.extend(asyncio.ensure_future(downloader.download(image, texts)) for image in new_images)
+            return
+        # the API workflow is already written in 'prompt', we just have to write 'workflow'
+        # this wave of writing out the metadata requires loading the image into memory
+        # this takes a long time with 4096x4096 images, so it can be left to an output processor
+        record = OutputRecord.from_job(job, new_paths)
+        # both wait on blocking calls, which would freeze the event loop the gui runs on
+        work = output_processor.submit if output_processor else process_output_record
+        await asyncio.get_running_loop().run_in_executor(None, work, record)
 
-            if message['type'] == 'executing':
-                data = message['data']
-                if data['node'] is None and data['prompt_id'] == prompt_id:
+    reconnected_ws = None
+    missed_messages = False
+    try:
+        while True:
+            try:
+                out = await ws.recv()
+            except websockets.ConnectionClosed:
+                logger.warning("Lost the connection to ComfyUI, reconnecting...")
+                ws = reconnected_ws = await websockets.connect(websocket_uri(job.client_id, server_address))
+                missed_messages = True
+                # the prompt may have finished while we were disconnected
+                if prompt_id in get_history(prompt_id, server_address):
+                    break
+                continue
+
+            if isinstance(out, str):
+                try:
+                    message = json.loads(out)
+                except json.JSONDecodeError:
+                    continue
+                data = message.get('data') or {}
+                if data.get('prompt_id') != prompt_id:
+                    continue
+                if message['type'] == 'executed':
+                    await handle_output_images((data.get('output') or {}).get('images', []))
+                elif message['type'] == 'executing' and data['node'] is None:
                     logger.info("Prompt is done executing.")
                     break #Execution is done
-                else:
-                    continue
-        except:
-            pass
+                continue
 
-        try:
-            bytesIO = BytesIO(out[8:])
+            # previews are binary data
             # If you want to be able to decode the binary stream for latent previews, here is how you can do it:
-            # preview_image = Image.open(bytesIO).resize((512, 512)) # This is your preview in PIL image format, store it in a global
-
+            # preview_image = Image.open(BytesIO(out[8:])).resize((512, 512)) # This is your preview in PIL image format, store it in a global
             # we shouldm monitor if this bogs down systems with huge image workflows
-            job.preview_image = bytesIO.getvalue()
-            continue #previews are binary data
-        except:
-            continue
-
-    # this code is executed after the workflow is done executing
-    logger.info("Getting outputs from prompt history...")
-    history = get_history(prompt_id)[prompt_id]
-    for node_id in history['outputs']:
-        node_output = history['outputs'][node_id]
-        if 'images' in node_output:
-            for image in node_output['images']:
-                # we have to use the comfyui output folder to reconstruct the path of the image and apply our metadata
-                if "ComfyUI_temp" in image["filename"]:
-                    # Comfyui writes these files for things like image previews, which we don't want to write GUI data too
-                    # as far as I can tell, comfy deletes them after the workflow is done
-                    continue
-                logger.info(f"Found an output image named {image['filename']}...")
-                comfyui_output_folder = os.getenv("COMFYUI_OUTPUT_FOLDER")
-
-                image_path = os.path.join(comfyui_output_folder, image['subfolder'], image['filename'])
-                if os.path.dirname(image_path) == os.path.join(comfyui_output_folder, "output"):
-                    # this is a special case, when saved to root output folder
-                    # if the subfolder is the root comfyui output folder, we don't need to re add the subfolder
-                    image_path = os.path.join(comfyui_output_folder, image['filename'])
-
-                # the API workflow is already written in 'prompt', we just have to write 'workflow'
-                # this wave of writing out the metadata requires loading the image into memory
-                # this takes a long time with 4096x4096 images but is fine for general use
-                gui_workflow_data = json.dumps(workflow.gui_workflow)
-
-                # we need a lock on the file because when comfyUI is working quickly,
-                # it can say a job is done but still be writing to a file
-                try:
-                    add_job_metadata_to_image(image_path, job)
-                except Timeout:
-                    logger.info(f"Failed to acquire lock for {image_path}. Image taking too long to write?")
-                    break
-                logger.info(f"Successfully saved gui workflow to {image['filename']}...")
+            job.preview_image = out[8:]
 
-                # this feels naughty in the ComfyUI module, but im not sure how
-                # else to store this information
-                job.output_location = image_path
+        if missed_messages:
+            logger.info("Getting outputs missed while reconnecting from prompt history...")
+            history = get_history(prompt_id, server_address)[prompt_id]
+            for node_id in history['outputs']:
+                await handle_output_images(history['outputs'][node_id].get('images', []))
+        await asyncio.gather(*downloads)
+    finally:
+        if reconnected_ws:
+            await reconnected_ws.close()
+    return output_paths
 
-async def run_job_on_server(job):
-    server_address = os.getenv("COMFYUI_SERVER_ADDRESS")
-    uri = f"ws://{server_address}/ws?clientId={job.client_id}"
-
-    async with websockets.connect(uri) as ws:
+async def run_job_on_server(job, output_processor=None, downloader=None, server_address=None):
+    async with websockets.connect(websocket_uri(job.client_id, server_address)) as ws:
         # turn the prompt into a string
-        images = await generate_images(ws, job)
+        images = await generate_images(ws, job, output_processor, downloader, server_address)
         # The connection will be automatically closed when exiting the async with block
+    return images
 
 import aiohttp
 
@@ -158,6 +292,55 @@ async def check_if_connected():
         except asyncio.TimeoutError:
             return False
 
+class OutputDownloader:
+    """
+    Downloads output images from a remote ComfyUI server's /view endpoint into a local folder, for servers that don't share a filesystem with Comfy Tweaker.
+
+    Images are streamed to disk in chunks, and the workflow metadata is inserted into the PNG during the same pass. Downloads share one pooled connection to the server, with at most max_parallel running at a time.
+    """
+    def __init__(self, server_address, destination, max_parallel=4, chunk_size=64 * 1024):
+        self.server_address = server_address
+        self.destination = destination
+        self.chunk_size = chunk_size
+        self._max_parallel = max_parallel
+        self._semaphore = asyncio.Semaphore(max_parallel)
+        self._session = None
+
+    def destination_path(self, image):
+        return os.path.join(self.destination, image['subfolder'], image['filename'])
+
+    async def download(self, image, texts=None):
+        """Downloads an output image, writing the given text chunks into it if it is a PNG.
+
+        Returns:
+            str: the local path of the image
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit_per_host=self._max_parallel)
+            self._session = aiohttp.ClientSession(connector=connector)
+        image_path = self.destination_path(image)
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        params = {"filename": image['filename'], "subfolder": image['subfolder'], "type": image.get('type', "output")}
+        injector = PngTextInjector(texts or {})
+        async with self._semaphore:
+            async with self._session.get(f"http://{self.server_address}/view", params=params) as response:
+                response.raise_for_status()
+                # download next to the image and swap it in, so nobody sees a half written file
+                partial_path = f"{image_path}.part"
+                with open(partial_path, "wb") as file:
+                    async for data in response.content.iter_chunked(self.chunk_size):
+                        file.write(injector.feed(data))
+                    file.write(injector.close())
+        os.replace(partial_path, image_path)
+        logger.info(f"Downloaded {image['filename']} to {image_path}...")
+        return image_path
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
 # for in case this example is used in an environment where it will be repeatedly called, like in a Gradio app. otherwise, you'll randomly receive connection timeouts
 #Commented out code to display the output images:
 
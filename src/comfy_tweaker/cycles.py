@@ -0,0 +1,163 @@
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_CYCLES = 1024
+# seconds a folder listing is trusted while the folder's modification time is unchanged
+LISTING_TTL = 30
+
+
+class AffinePermutation:
+    """
+    A shuffled order of range(length) stored as two numbers, mapping position i to `(step * i + offset) % length`. step is coprime with length, so every index appears exactly once per pass. This isn't every possible shuffle, but it takes the same memory for ten files or ten million.
+    """
+
+    def __init__(self, length, rng=random):
+        self.length = length
+        self.offset = rng.randrange(length) if length else 0
+        self.step = 1
+        if length > 2:
+            # coprime steps are common, so this finds one in a few tries
+            while True:
+                self.step = rng.randrange(1, length)
+                if math.gcd(self.step, length) == 1:
+                    break
+
+    def __getitem__(self, position):
+        return (self.step * position + self.offset) % self.length
+
+
+class CycleStore:
+    """
+    The position of every cycle used by the cycling filters, keyed by the arguments the filter was called with. Only an index is stored per cycle, the items themselves come from the caller each time, so a cycle never holds its own copy of a file listing.
+
+    The store is locked so render threads can share it, and holds at most max_size cycles, forgetting the least recently used ones first. Render worker processes each have their own store.
+
+    Args:
+        max_size (int, optional): the most cycles to remember. Defaults to DEFAULT_MAX_CYCLES.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_CYCLES):
+        self.max_size = max_size
+        # key -> [position, permutation or None]
+        self._cycles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cycles)
+
+    def _item(self, state, items, shuffle):
+        permutation = state[1]
+        if shuffle and (permutation is None or permutation.length != len(items)):
+            # the listing changed size, so the old order no longer covers it
+            permutation = state[1] = AffinePermutation(len(items))
+        position = state[0] % len(items)
+        return items[permutation[position] if shuffle else position]
+
+    def _state(self, key):
+        state = self._cycles.get(key)
+        if state is None:
+            state = self._cycles[key] = [0, None]
+            if len(self._cycles) > self.max_size:
+                self._cycles.popitem(last=False)
+        else:
+            self._cycles.move_to_end(key)
+        return state
+
+    def next(self, key, items, shuffle=False, journal=None):
+        """
+        Returns the next item of a cycle and moves the cycle along.
+
+        Args:
+            key (Hashable): identifies the cycle
+            items (Sequence): the items to cycle through, which should be in the same order each time
+            shuffle (bool, optional): go through the items in a random order instead, using each once before a new order is picked. Defaults to False.
+            journal (list, optional): records the move, so rewind can undo it if the render is thrown away. Defaults to None.
+
+        Raises:
+            ValueError: If there are no items
+        """
+        if not items:
+            raise ValueError(f"Nothing to cycle through for {key}")
+        with self._lock:
+            state = self._state(key)
+            item = self._item(state, items, shuffle)
+            if journal is not None:
+                journal.append((key, state[1]))
+            state[0] += 1
+            if shuffle and state[0] % len(items) == 0:
+                # a new pass gets a new order
+                state[1] = None
+            return item
+
+    def peek(self, key, items, shuffle=False):
+        """Returns the item next would return, without moving the cycle along. A shuffled cycle without an order for the items draws one and keeps it, so next uses the same order."""
+        if not items:
+            raise ValueError(f"Nothing to cycle through for {key}")
+        with self._lock:
+            if shuffle:
+                return self._item(self._state(key), items, shuffle)
+            state = self._cycles.get(key)
+            return items[state[0] % len(items) if state else 0]
+
+    def rewind(self, journal):
+        """Moves back the cycles a journal recorded, for renders that were thrown away. Cycles that were forgotten since are left alone."""
+        with self._lock:
+            for key, permutation in reversed(journal):
+                state = self._cycles.get(key)
+                if state is None or state[0] == 0:
+                    continue
+                state[0] -= 1
+                # a later move may have started a new shuffled pass, so the order this move drew from is put back
+                state[1] = permutation
+        journal.clear()
+
+    def clear(self):
+        with self._lock:
+            self._cycles.clear()
+
+
+class ListingCache:
+    """
+    Caches sorted folder listings by folder, glob and whether paths are relative. A listing is reused while the folder's modification time is unchanged, for at most ttl seconds so changes in subfolders are still picked up.
+
+    Args:
+        ttl (float, optional): the longest a listing is reused for. Defaults to LISTING_TTL.
+    """
+
+    def __init__(self, ttl=LISTING_TTL, max_size=DEFAULT_MAX_CYCLES):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (folder mtime, time listed, files)
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, folder, list_files):
+        """Returns the cached listing for key, calling list_files to make a new one if it is missing or stale. Listings are tuples so they can be shared."""
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            cached = self._listings.get(key)
+            if cached and cached[0] == mtime and time.monotonic() - cached[1] < self.ttl:
+                self._listings.move_to_end(key)
+                return cached[2]
+        files = tuple(sorted(list_files()))
+        with self._lock:
+            self._listings[key] = (mtime, time.monotonic(), files)
+            self._listings.move_to_end(key)
+            if len(self._listings) > self.max_size:
+                self._listings.popitem(last=False)
+        return files
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+
+# the cycles of the cycling filters, shared by every render in this process
+cycle_store = CycleStore()
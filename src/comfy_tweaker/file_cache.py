@@ -0,0 +1,102 @@
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+
+DEFAULT_FILE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+@dataclass
+class FileCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    # files that changed since they were cached
+    invalidations: int = 0
+    entries: int = 0
+    bytes: int = 0
+    max_bytes: int = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return (
+            f"File cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate), "
+            f"{self.evictions} evictions, {self.entries} files using {self.bytes / 1024 / 1024:.1f} of "
+            f"{self.max_bytes / 1024 / 1024:.1f} MB."
+        )
+
+
+class FileCache:
+    """
+    A least recently used cache of text file contents with a limit on the total size of the cached files. Every read checks the file's modification time and size, so a changed file is read again, but an unchanged file costs a stat instead of a read. Files larger than the whole budget are never cached.
+
+    Args:
+        max_bytes (int, optional): the most bytes of files to keep, measured by their size on disk. Defaults to DEFAULT_FILE_CACHE_BYTES.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_FILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        # (path, encoding) -> (mtime, size, text)
+        self._files = OrderedDict()
+        self._bytes = 0
+        self._stats = FileCacheStats()
+        self._lock = threading.Lock()
+
+    def read_text(self, file_path, encoding=None):
+        """Returns the text of a file, from the cache if it hasn't changed."""
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), encoding)
+        with self._lock:
+            cached = self._files.get(key)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                self._files.move_to_end(key)
+                self._stats.hits += 1
+                return cached[2]
+            self._stats.misses += 1
+            if cached:
+                self._stats.invalidations += 1
+                self._remove(key)
+        with open(file_path, encoding=encoding) as file:
+            text = file.read()
+        if stat.st_size <= self.max_bytes:
+            with self._lock:
+                if key in self._files:
+                    self._remove(key)
+                self._files[key] = (stat.st_mtime_ns, stat.st_size, text)
+                self._bytes += stat.st_size
+                self._shrink()
+        return text
+
+    def _remove(self, key):
+        self._bytes -= self._files.pop(key)[1]
+
+    def _shrink(self):
+        while self._bytes > self.max_bytes and self._files:
+            self._bytes -= self._files.popitem(last=False)[1][1]
+            self._stats.evictions += 1
+
+    def resize(self, max_bytes):
+        """Changes the budget, evicting files if the cache is now over it."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._shrink()
+
+    def stats(self):
+        """Returns a snapshot of the cache statistics."""
+        with self._lock:
+            return FileCacheStats(**{
+                **asdict(self._stats), "entries": len(self._files), "bytes": self._bytes, "max_bytes": self.max_bytes,
+            })
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._bytes = 0
+
+
+# shared by every filter that reads text files
+file_cache = FileCache()
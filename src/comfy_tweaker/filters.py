@@ -1,13 +1,17 @@
 import glob
 import hashlib
-import itertools
 import os
 import random
 import re
-import json
 
+from jinja2 import pass_context
 from PIL import Image
 
+from comfy_tweaker.cycles import ListingCache, cycle_store
+from comfy_tweaker.file_cache import file_cache
+from comfy_tweaker.json_cache import JsonCache
+from comfy_tweaker.sweep import Sweep
+from comfy_tweaker.uploads import upload_image
 from comfy_tweaker.utils import filter_collection
 from comfy_tweaker.utils import match as match_
 from comfy_tweaker.utils import regex_match as regex_match_
@@ -58,11 +62,12 @@ def from_file(file_path):
     Args:
         file_path (str): The path to the file.
 
+    Files are cached until they change, see `file_cache`.
+
     Returns:
         str: The contents of the file.
     """
-    with open(file_path) as file:
-        return file.read()
+    return file_cache.read_text(file_path)
 
 @Tweaks.register(plugin_type=PluginType.FILTERS)
 def regex_match(text, pattern):
@@ -98,12 +103,15 @@ def in_folder_absolute(folder, file_glob="*.safetensors"):
     Returns:
         list: A list of files with their full paths.
     """
-    return [
-        file
-        for file in glob.glob(os.path.join(folder, "**", file_glob), recursive=True)
-    ]
+    return list(
+        listing_cache.get(
+            ("absolute", folder, file_glob),
+            folder,
+            lambda: glob.glob(os.path.join(folder, "**", file_glob), recursive=True),
+        )
+    )
 
-@Tweaks.register()
+@Tweaks.register(stateful=True)
 def from_folder_absolute(
     folder, file_glob="*.safetensors", match=None, regex_match=None, cycle=False
 ):
@@ -115,7 +123,7 @@ def from_folder_absolute(
         file_glob (str, optional): The glob pattern to match. Defaults to "*.safetensors".
         match (str, optional): The substring pattern to match. Defaults to None.
         regex_match (str, optional): The regex pattern to match. Defaults to None.
-        cycle (bool, optional): Cycle through the files in the folder instead of making a random selection. Defaults to False.
+        cycle (bool | str, optional): Cycle through the files in the folder instead of making a random selection. Pass "shuffle" to cycle in a random order that uses every file once per pass. Defaults to False.
 
     Returns:
         str: The absolute path to the randomly chosen file.
@@ -124,7 +132,7 @@ def from_folder_absolute(
         in_folder_absolute, folder, file_glob, match, regex_match, cycle
     )
 
-@Tweaks.register()
+@Tweaks.register(stateful=True)
 def from_file_in_folder(
     folder, file_glob="*.txt", match=None, regex_match=None, cycle=False
 ):
@@ -143,7 +151,7 @@ def from_file_in_folder(
         file_glob (str, optional): The glob pattern to match. Defaults to "*.txt".
         match (str, optional): The substring pattern to match. Defaults to None.
         regex_match (str, optional): The regex pattern to match. Defaults to None.
-        cycle (bool, optional): Cycle through the files in the folder instead of making a random selection. Defaults to False.
+        cycle (bool | str, optional): Cycle through the files in the folder instead of making a random selection. Pass "shuffle" to cycle in a random order that uses every file once per pass. Defaults to False.
 
     Returns:
         str: The contents of the randomly chosen file.
@@ -173,12 +181,16 @@ def in_models_folder(folder, file_glob="*.safetensors"):
     return in_folder(folder, file_glob)
 
 
-def get_cycled_item(key, items):
-    if not hasattr(get_cycled_item, "_cycle_iter"):
-        get_cycled_item._cycle_iter = {}
-    if key not in get_cycled_item._cycle_iter:
-        get_cycled_item._cycle_iter[key] = itertools.cycle(items)
-    return next(get_cycled_item._cycle_iter[key])
+json_cache = JsonCache()
+# folder listings are sorted and shared between calls, and cycles only keep an index into them
+listing_cache = ListingCache()
+
+
+def get_cycled_item(key, items, shuffle=False):
+    if Tweaks.is_dry_run():
+        # a dry run must not advance the cycle
+        return cycle_store.peek(key, items, shuffle)
+    return cycle_store.next(key, items, shuffle, journal=Tweaks.cycle_journal())
 
 
 def _fetch_cycleable_file(
@@ -186,12 +198,14 @@ def _fetch_cycleable_file(
 ):
     files = filter_collection(fetching_function(folder, file_glob), match, regex_match)
     if cycle:
-        key = (folder, file_glob, match, regex_match)
-        return get_cycled_item(key, files)
+        if not files:
+            raise ValueError(f"No files in {folder} match {file_glob}")
+        key = (fetching_function.__name__, folder, file_glob, match, regex_match)
+        return get_cycled_item(key, files, shuffle=cycle == "shuffle")
     else:
         return random.choice(files)
 
-@Tweaks.register()
+@Tweaks.register(stateful=True)
 def from_models_folder(
     folder, file_glob="*.safetensors", match=None, regex_match=None, cycle=False
 ):
@@ -211,7 +225,7 @@ def from_models_folder(
         file_glob (str, optional): The glob pattern to match. Defaults to "*.safetensors".
         match (str, optional): The substring pattern to match. Defaults to None.
         regex_match (str, optional): The regex pattern to match. Defaults to None.
-        cycle (bool, optional): Cycle through the files in the folder instead of making a random selection. Defaults to False.
+        cycle (bool | str, optional): Cycle through the files in the folder instead of making a random selection. Pass "shuffle" to cycle in a random order that uses every file once per pass. Defaults to False.
 
     Returns:
         str: The base name of the randomly chosen file.
@@ -232,16 +246,24 @@ def in_folder(folder, file_glob="*.safetensors"):
     Returns:
         list: A list of files with their base names.
     """
-    return [
-        os.path.relpath(file, folder)
-        for file in glob.glob(os.path.join(folder, "**", file_glob), recursive=True)
-    ]
+    return list(
+        listing_cache.get(
+            ("relative", folder, file_glob),
+            folder,
+            lambda: [
+                os.path.relpath(file, folder)
+                for file in glob.glob(os.path.join(folder, "**", file_glob), recursive=True)
+            ],
+        )
+    )
 
 @Tweaks.register(plugin_type=PluginType.FILTERS)
 def as_image(absolute_file_path):
     """
     Moves an image into the comfyui input folder and returns its final name. This is useful for providing image inputs like depth maps and canny outlines. In the input folder, the image will have its original filename appended with an MD5 hash so it is easily referenced.
 
+    If the COMFYUI_INPUT_FOLDER environment variable is not set, the server is treated as remote and the image is uploaded to it instead. Uploads are keyed by a hash of the file, so an image is only uploaded once per server. If the COMFYUI_SERVERS environment variable lists more than one server, the image is uploaded to every one of them, since the iteration can run on any of them.
+
     Example:
     ```yaml
     tweaks:
@@ -255,14 +277,28 @@ def as_image(absolute_file_path):
         absolute_file_path (str): The absolute file path to an image (e.g. *.png, *.webp).
 
     Raises:
-        ValueError: If the COMFYUI_INPUT_FOLDER environment variable is not set.
+        ValueError: If neither the COMFYUI_INPUT_FOLDER nor the COMFYUI_SERVER_ADDRESS environment variable is set.
 
     Returns:
         str: The name of the image in the top level of the comfyui inputs directory.
     """
+    if Tweaks.is_dry_run():
+        if not os.path.isfile(absolute_file_path):
+            raise FileNotFoundError(f"Image not found: {absolute_file_path}")
+        return os.path.basename(absolute_file_path)
+    servers = [server for server in os.getenv("COMFYUI_SERVERS", "").split(",") if server]
+    if len(servers) > 1:
+        # uploads are named after the file's hash, so every server gives the image the same name
+        names = {upload_image(server, absolute_file_path) for server in servers}
+        if len(names) > 1:
+            raise ValueError(f"{absolute_file_path} was uploaded under different names: {sorted(names)}")
+        return names.pop()
     comfyui_input_folder = os.getenv("COMFYUI_INPUT_FOLDER")
     if not comfyui_input_folder:
-        raise ValueError("COMFYUI_INPUT_FOLDER environment variable is not set")
+        server_address = os.getenv("COMFYUI_SERVER_ADDRESS")
+        if not server_address:
+            raise ValueError("COMFYUI_INPUT_FOLDER environment variable is not set")
+        return upload_image(server_address, absolute_file_path)
 
     image_folder = os.path.join(comfyui_input_folder)
     os.makedirs(image_folder, exist_ok=True)
@@ -302,7 +338,7 @@ def from_folder(
         file_glob (str, optional): The glob pattern to match. Defaults to "*.safetensors".
         match (str, optional): The substring pattern to match. Defaults to None.
         regex_match (str, optional): The regex pattern to match. Defaults to None.
-        cycle (bool, optional): Cycle through the files in the folder instead of making a random selection. Defaults to False.
+        cycle (bool | str, optional): Cycle through the files in the folder instead of making a random selection. Pass "shuffle" to cycle in a random order that uses every file once per pass. Defaults to False.
 
     Returns:
         str: The base name of the randomly chosen file.
@@ -371,11 +407,63 @@ def random_choice(choices):
     """
     return random.choice(choices)
 
+@Tweaks.register()
+@pass_context
+def sweep(context, **axes):
+    """
+    Sweeps over every combination of the given axes, one combination per iteration. Combinations are computed from the iteration, so even grids with millions of combinations use no extra memory. The last axis changes fastest. Once every combination has been used, the sweep starts over.
+
+    Set `amount` at the top of the tweaks file to the total number of combinations so the job runs the whole grid.
+
+    Example:
+    ```yaml
+    {% set grid = sweep(checkpoint=in_models_folder("checkpoints"), lora=in_models_folder("loras"), cfg=[4, 6, 8]) %}
+    amount: {{ grid.total }}
+    tweaks:
+    - selector:
+        name: "Load Checkpoint"
+      changes:
+        ckpt_name: {{ grid.checkpoint }}
+    - selector:
+        name: "Load LoRA"
+      changes:
+        lora_name: {{ grid.lora }}
+    - selector:
+        name: "KSampler"
+      changes:
+        cfg: {{ grid.cfg }}
+    ```
+
+    Args:
+        **axes (list): The values of each axis, by name.
+
+    Returns:
+        dict: The values of each axis for the current iteration, with the combination's `index` and the `total` number of combinations as attributes.
+    """
+    return Sweep(axes).at(context["iteration"])
+
 @Tweaks.register(plugin_type=PluginType.FILTERS)
-def as_json_property(file_path, *keys):
-    """Grabs a JSON property from the given absolute file path. Pass in as many strings as you need accessors."""
-    with open(file_path) as file:
-        data = json.load(file)
-        for key in keys:
-            data = data[key]
-        return data
\ No newline at end of file
+def as_json_property(file_path, *keys, lazy=None):
+    """
+    Grabs a JSON property from the given absolute file path. Pass in as many strings as you need accessors, or a single JSON pointer like "/models/0/name".
+
+    Files are parsed once and kept until they change, and each lookup is remembered, so using the same catalog in every iteration doesn't read it again. Very large files are memory mapped and only the requested values are parsed.
+
+    Example:
+    ```yaml
+    tweaks:
+    - selector:
+        id: "12"
+      changes:
+        text: {{ "/path/to/catalog.json" | as_json_property("/styles/3/prompt") }}
+    ```
+
+    Args:
+        file_path (str): The path to the JSON file.
+        *keys (str | int): The keys and indexes to follow, or one JSON pointer.
+        lazy (bool, optional): Memory map the file and parse only the requested values. Defaults to doing so for files over 64 MB.
+
+    Returns:
+        Any: The value at the keys.
+    """
+    return json_cache.get(file_path, keys, lazy)
\ No newline at end of file
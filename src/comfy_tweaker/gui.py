@@ -1,7 +1,10 @@
+import argparse
 import asyncio
+import collections
 import functools
 import itertools
 import logging
+import multiprocessing
 import os
 import platform
 import subprocess
@@ -9,7 +12,6 @@ import sys
 import threading
 import traceback
 from concurrent.futures import ThreadPoolExecutor
-from copy import copy
 
 # import faulthandler
 # faulthandler.enable()
@@ -24,7 +26,11 @@ from PySide6.QtWidgets import QFileDialog, QMessageBox, QTableWidgetItem, QInput
 from qasync import QEventLoop, asyncSlot, QApplication
 
 import comfy_tweaker
-from comfy_tweaker import JobQueue, JobStatus, Tweaks, Workflow
+from comfy_tweaker import JobQueue, JobStatus, RenderPool, Tweaks, Workflow
+from comfy_tweaker.file_cache import file_cache
+from comfy_tweaker.profiling import get_logs_directory
+from comfy_tweaker.results import ReuseMode
+from comfy_tweaker.scheduler import DEFAULT_AGING_RATE
 from comfy_tweaker.settings import load_settings, save_settings
 from comfy_tweaker.ui.main_ui import Ui_MainWindow
 from comfy_tweaker.ui.preferences_ui import Ui_PreferencesDialog
@@ -45,24 +51,70 @@ class JobQueueTask(QtCore.QRunnable):
         else:
             asyncio.run(self.job_queue.start())
 
+def pair_dropped_files(yaml_files, image_files):
+    """Pairs each tweaks file with the workflow image of the same name. If there is only one image, it is used for every tweaks file without a match.
+
+    Returns:
+        list[tuple[str, str | None]]: (tweaks file, workflow image) pairs in the order the tweaks files were given
+    """
+    images_by_name = {os.path.splitext(os.path.basename(path))[0]: path for path in image_files}
+    fallback_image = image_files[0] if len(image_files) == 1 else None
+    return [
+        (yaml_file, images_by_name.get(os.path.splitext(os.path.basename(yaml_file))[0], fallback_image))
+        for yaml_file in yaml_files
+    ]
+
+
+def load_job_files(yaml_file, workflow):
+    """Loads a tweaks file and validates it against a workflow, which may be a Workflow or the path of a workflow image. Safe to run in a worker thread."""
+    if workflow is None:
+        raise ValueError("No workflow image was dropped or loaded for these tweaks.")
+    if isinstance(workflow, str):
+        workflow = Workflow.from_image(workflow, name=os.path.basename(workflow))
+    tweaks = Tweaks.from_file(yaml_file, name=os.path.basename(yaml_file))
+    workflow.validate(tweaks)
+    return workflow, tweaks
+
+
 class QTextEditLogger(logging.Handler):
-    """Custom logging handler to redirect logs to a QTextEdit."""
+    """Custom logging handler to redirect logs to a QTextEdit.
+
+    Records can be emitted from any thread. They are buffered in a bounded ring
+    and flushed to the widget in batches by a timer on the GUI thread, and the
+    document is capped at `max_lines` so memory stays flat over long sessions.
+    """
 
-    def __init__(self, text_edit):
+    def __init__(self, text_edit, max_lines=5000, flush_interval=250):
         super().__init__()
         self.text_edit = text_edit
+        self.text_edit.document().setMaximumBlockCount(max_lines)
+        # anything older than max_lines would be trimmed from the document anyway
+        self._buffer = collections.deque(maxlen=max_lines)
+        self.flush_timer = QTimer(text_edit)
+        self.flush_timer.timeout.connect(self.flush_to_widget)
+        self.flush_timer.start(flush_interval)
 
     def emit(self, record):
         # msg = self.format(record)
-        msg = record.getMessage()
+        # handle() already holds self.lock here, so appending is thread safe
+        self._buffer.append(record.getMessage())
+
+    def flush_to_widget(self):
+        """Writes all buffered messages to the text edit. Must run on the GUI thread."""
+        with self.lock:
+            if not self._buffer:
+                return
+            messages = list(self._buffer)
+            self._buffer.clear()
         cursor = self.text_edit.textCursor()
         cursor.movePosition(QtGui.QTextCursor.End)
-        cursor.insertText(msg + "\n")
+        cursor.insertText("\n".join(messages) + "\n")
         self.text_edit.setTextCursor(cursor)
         self.text_edit.ensureCursorVisible()
 
 
 SUPPORTERS = ["tohoco", "sourjck"]
+JOB_OUTPUTS_MENU_SIZE = 20
 
 
 class SupportersDialog(QtWidgets.QDialog):
@@ -122,6 +174,7 @@ class PreferencesDialog(QtWidgets.QDialog):
         self.ui.comfyUIServerAddressLineEdit.setText(
             self.settings.get("comfy_ui_server_address", "")
         )
+        self.ui.profileQueueRunsCheckBox.setChecked(self.settings.get("profile_queue", False))
 
         models_browse_handler = functools.partial(
             self.browse_for_folder, self.ui.modelsDirectoryLineEdit, "models_directory"
@@ -146,9 +199,14 @@ class PreferencesDialog(QtWidgets.QDialog):
         self.ui.comfyUIServerAddressLineEdit.textChanged.connect(
             comfy_ui_server_address_handler
         )
+        self.ui.profileQueueRunsCheckBox.toggled.connect(self.set_profile_queue)
 
         self.ui.closeButton.clicked.connect(self.reject)
 
+    def set_profile_queue(self, checked):
+        self.settings["profile_queue"] = checked
+        save_settings(self.settings)
+
     def browse_for_folder(self, line_edit, settings_key):
         logger.info(f"Browsing for f{settings_key} folder..")
         folder_path = QFileDialog.getExistingDirectory(
@@ -170,7 +228,7 @@ class JobTableModel(QAbstractTableModel):
         return len(self.jobs)
 
     def columnCount(self, parent=None):
-        return 6  # Updated to 6 columns: Icon, Position, Amount, Progress, Workflow Name, Tweaks Name
+        return 7  # Position, Icon, Amount, Remaining, Workflow Name, Tweaks Name, Priority
 
     def headerData(self, section, orientation, role):
         if role == Qt.DisplayRole:
@@ -187,6 +245,8 @@ class JobTableModel(QAbstractTableModel):
                     return "Workflow"
                 elif section == 5:
                     return "Tweaks"
+                elif section == 6:
+                    return "Priority"
         return None
 
     def data(self, index, role):
@@ -211,10 +271,26 @@ class JobTableModel(QAbstractTableModel):
                 return job.original_workflow.name
             elif index.column() == 5:
                 return job.tweaks.name
+            elif index.column() == 6:
+                return job.priority
 
         if role == Qt.DecorationRole and index.column() == 1:
+            if job.problem and job.status == JobStatus.PENDING:
+                return QtWidgets.QApplication.style().standardIcon(
+                    QtWidgets.QStyle.SP_MessageBoxWarning
+                )
             return self.create_job_icon(job)
 
+        if role == Qt.ToolTipRole:
+            iterations = job.iterations
+            tooltip = (
+                f"Iterations {iterations.start}-{iterations.stop - 1}, "
+                f"{job.progress} done, {len(job.results)} with outputs"
+            )
+            if job.problem:
+                tooltip += f"\n{job.problem}"
+            return tooltip
+
         return None
 
     def create_job_icon(self, job):
@@ -244,13 +320,36 @@ class JobTableModel(QAbstractTableModel):
 
 
 class TweakerApp(QtWidgets.QMainWindow):
-    def __init__(self):
+    def __init__(self, profile=False):
         super().__init__()
+        # set by --profile, which profiles queue runs whatever the preferences say
+        self.profile = profile
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
         self.settings = load_settings()
         self.update_environment_variables()
-        self.job_queue = JobQueue()
+        # rendering ahead, background output writing and background validation are opt in through settings
+        self.job_queue = JobQueue(
+            render_ahead=self.settings.get("render_ahead", 0),
+            reuse_results=ReuseMode(self.settings.get("reuse_results", "off")),
+            output_workers=self.settings.get("output_workers", 0),
+            aging_rate=self.settings.get("aging_rate", DEFAULT_AGING_RATE),
+            cache_aware_order=self.settings.get("cache_aware_order", False),
+            servers=self.settings.get("comfyui_servers", []),
+            affinity_weight=self.settings.get("server_affinity_weight", 1.0),
+            load_weight=self.settings.get("server_load_weight", 1.0),
+            validate_ahead=self.settings.get("background_validation", False),
+        )
+        if self.job_queue.validator:
+            self.job_queue.validator.start()
+        # plugins are imported the first time a tweaks file uses them
+        Tweaks.discover_plugins()
+        self.render_pool = None
+        if self.settings.get("render_processes", 0) > 0:
+            # opt in, rendering in worker processes only pays off for CPU heavy tweaks files
+            self.render_pool = RenderPool(self.settings["render_processes"])
+            Tweaks.use_render_pool(self.render_pool)
+            executor.submit(self.render_pool.warm_up)
         self.setAcceptDrops(True)
         self.current_tweaks = Tweaks(name="No Tweaks")
         # self.ui.queueStopButton.setEnabled(False)
@@ -296,6 +395,8 @@ class TweakerApp(QtWidgets.QMainWindow):
         self.ui.actionExit.triggered.connect(self.close)
         self.ui.actionPreferences.triggered.connect(self.open_preferences)
 
+        # sweeps can ask for far more iterations than the designer's limit
+        self.ui.amountSpinBox.setMaximum(2**31 - 1)
         self.ui.jobTable.setEditTriggers(
             QtWidgets.QTableWidget.EditTrigger.NoEditTriggers
         )
@@ -324,6 +425,7 @@ class TweakerApp(QtWidgets.QMainWindow):
         # Create and set the model
         self.jobTableModel = JobTableModel(job_queue=self.job_queue)
         self._last_length = 0
+        self._last_queue_version = None
         self.ui.jobTable.setModel(self.jobTableModel)
         self.ui.jobTable.setColumnWidth(0, 25)
         self.ui.jobTable.setColumnWidth(1, 40)
@@ -361,24 +463,52 @@ class TweakerApp(QtWidgets.QMainWindow):
 
     def dropEvent(self, event):
         self.drop_label.hide()
+        image_files = []
         yaml_files = []
         for url in event.mimeData().urls():
             file_path = url.toLocalFile()
             if file_path.lower().endswith(".png"):
-                self.load_image(file_path)
-                return
+                image_files.append(file_path)
             if file_path.lower().endswith(".yaml"):
                 yaml_files.append(file_path)
-        
-        if len(yaml_files) == 1:
+
+        if not yaml_files and image_files:
+            self.load_image(image_files[0])
+        elif len(yaml_files) == 1 and not image_files:
             self.load_tweaks_file(yaml_files[0])
-        elif len(yaml_files) > 1:
-            self.load_yaml_batch(yaml_files)
+        elif yaml_files:
+            asyncio.ensure_future(self.load_yaml_batch(yaml_files, image_files))
 
-    def load_yaml_batch(self, yaml_files):
-        for yaml_file in yaml_files:
-            self.load_tweaks_file(yaml_file)
-            self.add_job()
+    async def load_yaml_batch(self, yaml_files, image_files=()):
+        """Loads and validates dropped tweaks files in the background, adding a job for each one in the order they were dropped.
+
+        Each tweaks file is paired with the dropped image of the same name, or the only dropped image if there is one, otherwise the current workflow.
+        """
+        pairs = pair_dropped_files(yaml_files, image_files)
+        current_workflow = getattr(self, "current_workflow", None)
+        amount = self.ui.amountSpinBox.value()
+        futures = [
+            executor.submit(load_job_files, yaml_file, image_file or current_workflow)
+            for yaml_file, image_file in pairs
+        ]
+        errors = []
+        for count, ((yaml_file, _), future) in enumerate(zip(pairs, futures), start=1):
+            self.ui.statusbar.showMessage(f"Loading tweaks files ({count}/{len(futures)})...")
+            try:
+                workflow, tweaks = await asyncio.wrap_future(future)
+            except Exception as e:
+                logger.error(f"Failed to load {yaml_file}: {e}")
+                errors.append(f"{os.path.basename(yaml_file)}: {e}")
+                continue
+            # already validated in the worker
+            self.job_queue.add(workflow, tweaks, tweaks.amount or amount, validate=False)
+            logger.info(f"{workflow.name} with {tweaks.name} added to the queue.")
+            self.update_job_table()
+        self.ui.statusbar.showMessage(
+            f"Added {len(futures) - len(errors)} of {len(futures)} tweaks files to the queue.", 5000
+        )
+        if errors:
+            QMessageBox.critical(self, "Tweaks Error", "\n".join(errors))
 
     def clear_tweaks_file(self):
         self.ui.tweaksFileLineEdit.setText("")
@@ -401,15 +531,37 @@ class TweakerApp(QtWidgets.QMainWindow):
                             self.go_to_folder, os.path.dirname(job.output_location)
                         )
                     )
+                if job.results:
+                    outputs_menu = menu.addMenu("Outputs")
+                    # only the latest iterations, a job can have thousands
+                    for iteration in sorted(job.results)[-JOB_OUTPUTS_MENU_SIZE:]:
+                        outputs = job.results[iteration]
+                        action = outputs_menu.addAction(
+                            f"Iteration {iteration}: {os.path.basename(outputs[-1])}"
+                        )
+                        action.triggered.connect(
+                            functools.partial(self.go_to_folder, os.path.dirname(outputs[-1]))
+                        )
             remove_action = menu.addAction("Remove")
             remove_action.triggered.connect(self.remove_selected_jobs)
             duplicate_action = menu.addAction("Duplicate")
             duplicate_action.triggered.connect(self.duplicate_selected_jobs)
             move_to_front_action = menu.addAction("Move to Front")
             move_to_front_action.triggered.connect(self.move_selected_jobs_to_front)
+            raise_priority_action = menu.addAction("Raise Priority")
+            raise_priority_action.triggered.connect(
+                functools.partial(self.change_selected_jobs_priority, 1)
+            )
+            lower_priority_action = menu.addAction("Lower Priority")
+            lower_priority_action.triggered.connect(
+                functools.partial(self.change_selected_jobs_priority, -1)
+            )
 
         menu.addSeparator()
 
+        reorder_action = menu.addAction("Reorder for Cache")
+        reorder_action.triggered.connect(self.reorder_jobs_for_cache)
+
         refresh_action = menu.addAction("Refresh")
         refresh_action.triggered.connect(
             functools.partial(self.update_job_table, reset=True)
@@ -435,16 +587,32 @@ class TweakerApp(QtWidgets.QMainWindow):
         rows = sorted(set(index.row() for index in selected_indexes), reverse=True)
         for row in rows:
             job = self.jobTableModel.jobs[row]
-            self.job_queue.queue.remove(job)
-            self.job_queue.queue.insert(0, job)
+            if job in self.job_queue.queue:
+                self.job_queue.move_to_front(job.id)
+        self.update_job_table()
+
+    def reorder_jobs_for_cache(self):
+        before, after = self.job_queue.reorder_for_cache()
+        self.ui.statusbar.showMessage(
+            f"Expected node cache hits between jobs: {before:.0%} before, {after:.0%} after reordering.", 5000
+        )
+        self.update_job_table()
+
+    def change_selected_jobs_priority(self, change):
+        selected_indexes = self.ui.jobTable.selectionModel().selectedIndexes()
+        rows = set(index.row() for index in selected_indexes)
+        for row in rows:
+            job = self.jobTableModel.jobs[row]
+            if job in self.job_queue.queue:
+                self.job_queue.set_priority(job.id, job.priority + change)
         self.update_job_table()
 
     def duplicate_selected_jobs(self):
         selected_indexes = self.ui.jobTable.selectionModel().selectedIndexes()
         rows = set(index.row() for index in selected_indexes)
         for row in sorted(rows):
-            job = copy(self.jobTableModel.jobs[row])
-            self.job_queue.add(job.workflow, job.tweaks, job.amount, validate=False)
+            job = self.jobTableModel.jobs[row]
+            self.job_queue.add(job.original_workflow, job.tweaks, job.amount, validate=False)
         self.update_job_table(reset=True)
 
     def remove_selected_jobs(self):
@@ -510,7 +678,17 @@ class TweakerApp(QtWidgets.QMainWindow):
             )
             return
         self.update_environment_variables()
-        self.validate_comfyui_folder()
+        profile = self.profile or self.settings.get("profile_queue", False)
+        self.job_queue.profile_directory = get_logs_directory() if profile else None
+        if self.job_queue.router and not os.environ["OUTPUT_DOWNLOAD_FOLDER"]:
+            QMessageBox.critical(
+                self,
+                "No Output Download Folder",
+                "Running on several ComfyUI servers requires an output download folder, since outputs are downloaded from whichever server made them.",
+            )
+            return
+        if not os.environ["OUTPUT_DOWNLOAD_FOLDER"]:
+            self.validate_comfyui_folder()
         if not self.job_queue.queue:
             msg_box = QMessageBox(self)
             msg_box.setIcon(QMessageBox.Critical)
@@ -542,6 +720,7 @@ class TweakerApp(QtWidgets.QMainWindow):
 
     def update_environment_variables(self):
         logger.debug("Updating environment variables with UI settings...")
+        file_cache.resize(self.settings.get("file_cache_mb", 64) * 1024 * 1024)
         os.environ["MODELS_FOLDER"] = self.settings.get("models_directory", "")
         os.environ["WILDCARDS_DIRECTORY"] = self.settings.get("wildcards_directory", "")
         if self.settings.get("comfy_ui_folder"):
@@ -554,6 +733,10 @@ class TweakerApp(QtWidgets.QMainWindow):
         os.environ["COMFYUI_SERVER_ADDRESS"] = self.settings.get(
             "comfy_ui_server_address", ""
         )
+        # set for remote servers, whose outputs are downloaded instead of read from the comfyui folder
+        os.environ["OUTPUT_DOWNLOAD_FOLDER"] = self.settings.get("output_download_folder", "")
+        # as_image uploads to all of these when iterations run on several servers
+        os.environ["COMFYUI_SERVERS"] = ",".join(self.settings.get("comfyui_servers", []))
 
     def show_supporters(self):
         dialog = SupportersDialog(self)
@@ -586,22 +769,29 @@ class TweakerApp(QtWidgets.QMainWindow):
     def update_image_preview(self):
         file_path = self.ui.workflowLineEdit.text()
         if file_path:
+            try:
+                stat = os.stat(file_path)
+                preview_key = (file_path, stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                preview_key = None
+            if preview_key and preview_key == getattr(self, "_preview_key", None):
+                # the same unchanged image is already shown
+                return
             pixmap = QtGui.QPixmap(file_path).scaled(
                 250, 250, QtCore.Qt.KeepAspectRatio
             )
             self.ui.imagePreview.setPixmap(pixmap)
+            self._preview_key = preview_key
 
     def update_job_table(self, reset=False):
+        # all_jobs is already in run order, and the queue only sorts again after it changes
         jobs = self.job_queue.all_jobs
-        filtered_jobs = sorted(
-            [
-                job
-                for job in jobs
-                if self.ui.jobFilter.text()
-                in job.original_workflow.name + job.tweaks.name
-            ],
-            key=lambda job: self.job_queue.position_of(job.id) or float("inf"),
-        )
+        filtered_jobs = [
+            job
+            for job in jobs
+            if self.ui.jobFilter.text()
+            in job.original_workflow.name + job.tweaks.name
+        ]
         # Update the model data
         updates = []
         for row, job in enumerate(filtered_jobs):
@@ -620,22 +810,27 @@ class TweakerApp(QtWidgets.QMainWindow):
             updates.append((row, 3, job.tweaks.name))
         self.jobTableModel.updateData(updates)
 
-        if len(filtered_jobs) != self._last_length or reset:
+        if (
+            len(filtered_jobs) != self._last_length
+            or self.job_queue.queue.version != self._last_queue_version
+            or reset
+        ):
             self.jobTableModel.set_jobs(filtered_jobs)
             self._last_length = len(filtered_jobs)
+            self._last_queue_version = self.job_queue.queue.version
         self.update_progress_bar()
 
     def add_job(self):
         try:
             # we validate here once so adding a bunch of jobs is quick
-            self.job_queue.add(
+            job = self.job_queue.add(
                 self.current_workflow,
                 self.current_tweaks,
                 self.ui.amountSpinBox.value(),
             )
             self.update_job_table()
             logger.info(
-                f"{self.job_queue.queue[-1].workflow.name} with {self.job_queue.queue[-1].tweaks.name} added to the queue."
+                f"{job.workflow.name} with {job.tweaks.name} added to the queue."
             )
         except Exception as e:
             error_message = str(e)
@@ -650,6 +845,12 @@ class TweakerApp(QtWidgets.QMainWindow):
         path = self.ui.tweaksFileLineEdit.text()
         if path:
             self.current_tweaks = Tweaks.from_file(path, name=os.path.basename(path))
+            if self.render_pool:
+                # compile the tweaks and import their plugins in the workers before the queue renders them
+                executor.submit(self.render_pool.warm_up, self.current_tweaks._original_yaml)
+            if self.current_tweaks.amount:
+                # e.g. the number of combinations in a sweep
+                self.ui.amountSpinBox.setValue(self.current_tweaks.amount)
         else:
             self.current_tweaks = Tweaks(name="No Tweaks")
 
@@ -730,12 +931,17 @@ class TweakerApp(QtWidgets.QMainWindow):
         if reply == QMessageBox.Yes:
             # Save settings when the application is closed
             save_settings(self.settings)
+            if self.job_queue.validator:
+                self.job_queue.validator.stop()
+            if self.render_pool:
+                Tweaks.use_render_pool(None)
+                self.render_pool.shutdown()
             event.accept()
         else:
             event.ignore()
 
 
-async def main():
+async def main(profile=False):
     """Main entry point for the application."""
     app = QApplication(sys.argv)
 
@@ -746,7 +952,7 @@ async def main():
     app_close_event = asyncio.Event()
     app.aboutToQuit.connect(app_close_event.set)
 
-    window = TweakerApp()
+    window = TweakerApp(profile=profile)
     window.show()
 
     with loop:
@@ -754,19 +960,22 @@ async def main():
 
 
 def entry():
-    data_dir = user_data_dir("ComfyTweaker", "ComfyTweaker", roaming=True)
+    # required for the render pool's worker processes in the frozen executable
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(prog="comfy-tweaker")
+    parser.add_argument("--profile", action="store_true", help="write a profile of each queue run to the logs folder")
+    # anything else is left for Qt
+    args, _ = parser.parse_known_args()
     # File handler with DEBUG level
-    log_file_path = os.path.join(data_dir, "logs/comfytweaker_{time}.log")
+    log_file_path = os.path.join(get_logs_directory(), "comfytweaker_{time}.log")
     logger.add(log_file_path, level="DEBUG")
 
     try:
-        asyncio.run(main())
+        asyncio.run(main(profile=args.profile))
     except Exception as e:
         logger.critical(f"Exception occurred: {e}")
         logger.critical(traceback.format_exc())
 
 
-from appdirs import user_data_dir
-
 if __name__ == "__main__":
     entry()
@@ -0,0 +1,246 @@
+import contextlib
+import json
+import mmap
+import os
+import re
+import threading
+from collections import OrderedDict
+
+MAX_DOCUMENTS = 32
+# files larger than this are memory mapped and only the requested values are parsed
+LAZY_JSON_SIZE = 64 * 1024 * 1024
+MAX_LOOKUPS_PER_DOCUMENT = 4096
+
+_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+# strings, with escapes, and the brackets that change nesting depth
+_STRING_OR_BRACKET = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]', re.DOTALL)
+_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_SCALAR = re.compile(rb"[^,\]}\s]+")
+
+
+def parse_pointer(pointer):
+    """
+    Splits a JSON pointer like "/models/0/name" into its reference tokens, unescaping "~1" to "/" and "~0" to "~".
+
+    Raises:
+        ValueError: If the pointer isn't empty and doesn't start with "/"
+    """
+    if pointer == "":
+        return ()
+    if not pointer.startswith("/"):
+        raise ValueError(f"JSON pointers start with \"/\": {pointer}")
+    return tuple(token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/"))
+
+
+def _normalize_key(container, key):
+    # pointer tokens are strings and keys given to filters can be numbers, so lists get indexes and objects get strings
+    if container == "list":
+        return int(key)
+    return key if isinstance(key, str) else str(key)
+
+
+def _step(data, key):
+    if isinstance(data, list):
+        return data[_normalize_key("list", key)]
+    if isinstance(data, dict):
+        return data[_normalize_key("object", key)]
+    raise TypeError(f"Can't look up {key!r} in a JSON scalar")
+
+
+def _skip_whitespace(buffer, position):
+    return _WHITESPACE.match(buffer, position).end()
+
+
+def _skip_value(buffer, position):
+    """Returns the position just after the JSON value starting at position, without parsing it."""
+    first = buffer[position:position + 1]
+    if first == b'"':
+        return _STRING.match(buffer, position).end()
+    if first not in (b"{", b"["):
+        return _SCALAR.match(buffer, position).end()
+    depth = 0
+    for match in _STRING_OR_BRACKET.finditer(buffer, position):
+        token = match.group()
+        if token in (b"{", b"["):
+            depth += 1
+        elif token in (b"}", b"]"):
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    raise ValueError("Unterminated JSON value")
+
+
+def _find_member(buffer, position, key):
+    """Returns the position of the value of key in the object or array starting at position."""
+    opening = buffer[position:position + 1]
+    if opening == b"{":
+        key = _normalize_key("object", key)
+        position = _skip_whitespace(buffer, position + 1)
+        while buffer[position:position + 1] != b"}":
+            key_end = _STRING.match(buffer, position).end()
+            member = json.loads(buffer[position:key_end])
+            position = _skip_whitespace(buffer, _skip_whitespace(buffer, key_end) + 1)
+            if member == key:
+                return position
+            position = _skip_whitespace(buffer, _skip_value(buffer, position))
+            if buffer[position:position + 1] == b",":
+                position = _skip_whitespace(buffer, position + 1)
+        raise KeyError(key)
+    if opening == b"[":
+        index = _normalize_key("list", key)
+        position = _skip_whitespace(buffer, position + 1)
+        for _ in range(index):
+            if buffer[position:position + 1] == b"]":
+                raise IndexError(index)
+            position = _skip_whitespace(buffer, _skip_value(buffer, position))
+            if buffer[position:position + 1] == b",":
+                position = _skip_whitespace(buffer, position + 1)
+        if buffer[position:position + 1] == b"]":
+            raise IndexError(index)
+        return position
+    raise TypeError(f"Can't look up {key!r} in a JSON scalar")
+
+
+class JsonDocument:
+    """
+    A JSON file that has been loaded once. Small files are parsed up front, while large files are memory mapped and only the values that are looked up get parsed. Lookups are memoized either way, so repeating one costs a dictionary lookup.
+
+    Values are shared between lookups, so they shouldn't be modified.
+
+    A memory mapped file stays open, and locked on Windows, until the document is closed. JsonCache closes documents once they are evicted and no lookup is using them.
+    """
+
+    def __init__(self, path, lazy=False):
+        self.path = path
+        self.lazy = lazy
+        self._data = None
+        self._mmap = None
+        self._lookups = {}
+        self._lock = threading.Lock()
+        # lookups in progress, and whether the cache let go of the document
+        self._users = 0
+        self._retired = False
+        if lazy:
+            with open(path, "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    # mmap can't map an empty file, so fail the way json.load does
+                    raise json.JSONDecodeError("Expecting value", "", 0)
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            with open(path, "rb") as file:
+                self._data = json.load(file)
+
+    def _resolve(self, keys):
+        if not self.lazy:
+            data = self._data
+            for key in keys:
+                data = _step(data, key)
+            return data
+        position = _skip_whitespace(self._mmap, 0)
+        for key in keys:
+            position = _find_member(self._mmap, position, key)
+        return json.loads(self._mmap[position:_skip_value(self._mmap, position)])
+
+    def get(self, keys):
+        """Returns the value at a sequence of keys and indexes."""
+        keys = tuple(keys)
+        with self._lock:
+            if keys in self._lookups:
+                return self._lookups[keys]
+        value = self._resolve(keys)
+        with self._lock:
+            if len(self._lookups) >= MAX_LOOKUPS_PER_DOCUMENT:
+                self._lookups.clear()
+            self._lookups[keys] = value
+        return value
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _acquire(self):
+        with self._lock:
+            self._users += 1
+
+    def _release(self):
+        with self._lock:
+            self._users -= 1
+            close = self._retired and self._users == 0
+        if close:
+            self.close()
+
+    def _retire(self):
+        """Closes the document once the lookups using it finish."""
+        with self._lock:
+            self._retired = True
+            close = self._users == 0
+        if close:
+            self.close()
+
+
+class JsonCache:
+    """
+    Keeps the most recently used JSON documents, keyed by path, modification time and size so a changed file is loaded again.
+
+    Args:
+        max_documents (int, optional): how many documents to keep. Defaults to MAX_DOCUMENTS.
+        lazy_size (int, optional): files at least this many bytes are loaded lazily. Defaults to LAZY_JSON_SIZE.
+    """
+
+    def __init__(self, max_documents=MAX_DOCUMENTS, lazy_size=LAZY_JSON_SIZE):
+        self.max_documents = max_documents
+        self.lazy_size = lazy_size
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def document(self, path, lazy=None):
+        """
+        Loads the document for a file, or reuses the cached one, for the duration of the context. The document isn't closed while the context is active, even if it is evicted.
+
+        Args:
+            path (str): the path of the JSON file
+            lazy (bool, optional): memory map the file and parse only what is looked up. Defaults to doing so for files of at least lazy_size bytes.
+        """
+        stat = os.stat(path)
+        if lazy is None:
+            lazy = stat.st_size >= self.lazy_size
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, lazy)
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+                document._acquire()
+        if document is None:
+            document = JsonDocument(path, lazy=lazy)
+            document._acquire()
+            with self._lock:
+                # drop older versions of the same file along with the least recently used documents
+                evicted = [self._documents.pop(cached) for cached in list(self._documents) if cached[0] == key[0]]
+                previous = self._documents.pop(key, None)
+                if previous is not None:
+                    evicted.append(previous)
+                self._documents[key] = document
+                while len(self._documents) > self.max_documents:
+                    evicted.append(self._documents.popitem(last=False)[1])
+            for stale in evicted:
+                stale._retire()
+        try:
+            yield document
+        finally:
+            document._release()
+
+    def get(self, path, keys, lazy=None):
+        """Returns the value at keys in a JSON file. A single key starting with "/" is read as a JSON pointer."""
+        if len(keys) == 1 and isinstance(keys[0], str) and keys[0].startswith("/"):
+            keys = parse_pointer(keys[0])
+        with self.document(path, lazy) as document:
+            return document.get(keys)
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._documents.values())
+            self._documents.clear()
+        for document in evicted:
+            document._retire()
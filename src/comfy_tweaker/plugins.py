@@ -1,9 +1,31 @@
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
 from enum import Enum
+import ast
 import importlib.util
+import json
+import os
 import sys
+import threading
+
+import jinja2
+from appdirs import user_data_dir
+from loguru import logger
+
+# module name -> path of every plugin imported so far, so worker processes can import them too
+imported_plugins = {}
+_import_lock = threading.RLock()
+
+MANIFEST_VERSION = 2
+# jinja decorators that change how a plugin is called, which lazy plugins have to copy
+PASS_DECORATORS = {
+    "pass_context": jinja2.pass_context,
+    "pass_eval_context": jinja2.pass_eval_context,
+    "pass_environment": jinja2.pass_environment,
+}
+
 
 def import_plugin(module_name, plugin_path):
+    imported_plugins[module_name] = str(plugin_path)
     spec = importlib.util.spec_from_file_location(module_name, plugin_path)
     plugin = importlib.util.module_from_spec(spec)
     sys.modules[module_name] = plugin
@@ -11,6 +33,13 @@ def import_plugin(module_name, plugin_path):
     return plugin
 
 
+def tweaks_plugin(func):
+    """Registers a function for use in tweaks files, the same as `Tweaks.register()`."""
+    # comfy_tweaker imports this module, so Tweaks can only be imported once it is needed
+    from comfy_tweaker import Tweaks
+    return Tweaks.register()(func)
+
+
 class PluginType(Enum):
     GLOBALS = "globals"
     FILTERS = "filters"
@@ -21,3 +50,150 @@ class Plugin:
     name: str
     func: callable
     plugin_type: PluginType = field(default=PluginType.GLOBALS.value)
+    # keeps state between renders, like the position of a cycle, so templates using it aren't sent to worker processes
+    stateful: bool = False
+
+
+def get_plugins_directory():
+    return os.path.join(user_data_dir("ComfyTweaker", "ComfyTweaker", roaming=True), "plugins")
+
+
+def get_manifest_path():
+    return os.path.join(user_data_dir("ComfyTweaker", "ComfyTweaker", roaming=True), "plugin_manifest.json")
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    """Where to find a plugin without importing it."""
+    name: str
+    module: str
+    path: str
+    function: str
+    plugin_type: str = PluginType.GLOBALS.value
+    # the name of a jinja pass_ decorator on the function, if it has one
+    pass_arg: str = None
+    stateful: bool = False
+
+
+def _decorator_name(decorator):
+    if isinstance(decorator, ast.Call):
+        decorator = decorator.func
+    if isinstance(decorator, ast.Attribute):
+        return decorator.attr
+    if isinstance(decorator, ast.Name):
+        return decorator.id
+    return None
+
+
+def scan_plugin(plugin_path, module_name):
+    """
+    Finds the plugins a .py file registers by reading its source, without running it. Functions decorated with `Tweaks.register(...)` or `tweaks_plugin` are found, along with their plugin name, type and whether they are stateful.
+
+    Returns:
+        list[ManifestEntry]: the plugins in the file
+    """
+    with open(plugin_path, encoding="utf-8") as file:
+        tree = ast.parse(file.read(), filename=str(plugin_path))
+    entries = []
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        names = [_decorator_name(decorator) for decorator in node.decorator_list]
+        register = next(
+            (decorator for decorator, name in zip(node.decorator_list, names) if name in ("register", "tweaks_plugin")),
+            None,
+        )
+        if register is None:
+            continue
+        plugin_name = node.name
+        plugin_type = PluginType.GLOBALS.value
+        stateful = False
+        if isinstance(register, ast.Call):
+            arguments = list(register.args[:2])
+            keywords = {keyword.arg: keyword.value for keyword in register.keywords}
+            name_node = keywords.get("plugin_name", arguments[0] if arguments else None)
+            type_node = keywords.get("plugin_type", arguments[1] if len(arguments) > 1 else None)
+            if isinstance(name_node, ast.Constant) and isinstance(name_node.value, str):
+                plugin_name = name_node.value
+            if isinstance(type_node, ast.Attribute) and type_node.attr in PluginType.__members__:
+                plugin_type = PluginType[type_node.attr].value
+            stateful_node = keywords.get("stateful")
+            stateful = isinstance(stateful_node, ast.Constant) and stateful_node.value is True
+        pass_arg = next((name for name in names if name in PASS_DECORATORS), None)
+        entries.append(ManifestEntry(plugin_name, module_name, str(plugin_path), node.name, plugin_type, pass_arg, stateful))
+    return entries
+
+
+def _directory_signature(directory):
+    signature = []
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if entry.name.endswith(".py") and entry.is_file():
+            stat = entry.stat()
+            signature.append([entry.name, stat.st_mtime_ns, stat.st_size])
+    return signature
+
+
+def load_manifest(directory=None, manifest_path=None):
+    """
+    Returns the plugins in a plugin directory, by name. The manifest is cached in a json file and only rebuilt when a .py file in the directory is added, removed or changed.
+
+    Args:
+        directory (str, optional): the plugin directory. Defaults to the plugins folder in the user data directory.
+        manifest_path (str, optional): where to cache the manifest. Defaults to the user data directory.
+
+    Returns:
+        dict[str, ManifestEntry]: the plugins found in the directory
+    """
+    directory = directory or get_plugins_directory()
+    manifest_path = manifest_path or get_manifest_path()
+    if not os.path.isdir(directory):
+        return {}
+    signature = _directory_signature(directory)
+    try:
+        with open(manifest_path) as file:
+            cached = json.load(file)
+        if cached["version"] == MANIFEST_VERSION and cached["directory"] == str(directory) and cached["signature"] == signature:
+            return {entry["name"]: ManifestEntry(**entry) for entry in cached["plugins"]}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    logger.info(f"Scanning plugins in {directory}...")
+    plugins = {}
+    for file_name, _mtime, _size in signature:
+        module_name = f"comfy_tweaker_plugin_{file_name[:-3]}"
+        try:
+            entries = scan_plugin(os.path.join(directory, file_name), module_name)
+        except (OSError, SyntaxError, UnicodeDecodeError) as e:
+            logger.warning(f"Skipping plugin {file_name}: {e}")
+            continue
+        for entry in entries:
+            plugins[entry.name] = entry
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w") as file:
+        json.dump({
+            "version": MANIFEST_VERSION,
+            "directory": str(directory),
+            "signature": signature,
+            "plugins": [asdict(entry) for entry in plugins.values()],
+        }, file)
+    return plugins
+
+
+class LazyPlugin:
+    """Stands in for a plugin function until it is first called, then imports the plugin's module and calls the real function."""
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.__name__ = entry.name
+        if entry.pass_arg:
+            PASS_DECORATORS[entry.pass_arg](self)
+
+    def load(self):
+        with _import_lock:
+            module = sys.modules.get(self.entry.module)
+            if module is None:
+                logger.info(f"Loading plugin {self.entry.name} from {self.entry.path}...")
+                module = import_plugin(self.entry.module, self.entry.path)
+        return getattr(module, self.entry.function)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
@@ -0,0 +1,139 @@
+import struct
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TEXT_CHUNK_TYPES = (b"tEXt", b"zTXt", b"iTXt")
+
+
+class InvalidPngError(Exception):
+    pass
+
+
+def _decode_text_chunk(chunk_type, data):
+    key, _, rest = data.partition(b"\x00")
+    key = key.decode("latin-1")
+    if chunk_type == b"tEXt":
+        return key, rest.decode("latin-1")
+    if chunk_type == b"zTXt":
+        # the first byte is the compression method, zlib is the only one defined
+        return key, zlib.decompress(rest[1:]).decode("latin-1")
+    compressed, rest = rest[0], rest[2:]
+    _language, _, rest = rest.partition(b"\x00")
+    _translated_key, _, text = rest.partition(b"\x00")
+    if compressed:
+        text = zlib.decompress(text)
+    return key, text.decode("utf-8")
+
+
+def read_png_text(path, keys=None):
+    """
+    Reads the text chunks of a PNG without decoding the image. Image data chunks are skipped with a seek, so the cost does not depend on the size of the image.
+
+    Args:
+        path (str): path to the PNG file
+        keys (Iterable[str], optional): only return these keys, and stop reading once all of them are found. Defaults to every text chunk.
+
+    Raises:
+        InvalidPngError: if the file is not a PNG
+
+    Returns:
+        dict[str, str]: the text chunks by key, handling tEXt, zTXt and iTXt chunks
+    """
+    wanted = set(keys) if keys is not None else None
+    text = {}
+    with open(path, "rb") as file:
+        if file.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            raise InvalidPngError(f"Not a PNG file: {path}")
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type == b"IEND":
+                break
+            if chunk_type not in TEXT_CHUNK_TYPES:
+                # skip the data and the crc
+                file.seek(length + 4, 1)
+                continue
+            data = file.read(length)
+            file.seek(4, 1)
+            key_end = data.find(b"\x00")
+            if wanted is not None and data[:key_end].decode("latin-1") not in wanted:
+                continue
+            key, value = _decode_text_chunk(chunk_type, data)
+            # keys are written once in practice, letting the first one win means we can stop early
+            text.setdefault(key, value)
+            if wanted is not None and wanted <= text.keys():
+                break
+    return text
+
+
+def make_text_chunk(key, value):
+    """Builds a tEXt chunk, or an uncompressed iTXt chunk if the value can't be encoded as latin-1."""
+    try:
+        chunk_type, data = b"tEXt", key.encode("latin-1") + b"\x00" + value.encode("latin-1")
+    except UnicodeEncodeError:
+        chunk_type, data = b"iTXt", key.encode("latin-1") + b"\x00\x00\x00\x00\x00" + value.encode("utf-8")
+    crc = zlib.crc32(chunk_type + data)
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+class PngTextInjector:
+    """
+    Rewrites a PNG while it streams past, inserting text chunks before the image data and dropping any existing text chunks with the same keys. Only text chunks are buffered, so memory use does not depend on the size of the image. Data that is not a PNG is passed through unchanged.
+
+    Feed it the stream piece by piece and write out whatever it returns.
+    """
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.is_png = None
+        self._buffer = b""
+        # bytes of the current chunk left to copy unchanged
+        self._passthrough = 0
+        self._injected = False
+
+    def feed(self, data):
+        self._buffer += data
+        output = []
+        while self._buffer:
+            if self._passthrough:
+                passed = self._buffer[:self._passthrough]
+                output.append(passed)
+                self._buffer = self._buffer[len(passed):]
+                self._passthrough -= len(passed)
+                continue
+            if self.is_png is None:
+                if len(self._buffer) < len(PNG_SIGNATURE):
+                    break
+                self.is_png = self._buffer.startswith(PNG_SIGNATURE)
+                if self.is_png:
+                    output.append(PNG_SIGNATURE)
+                    self._buffer = self._buffer[len(PNG_SIGNATURE):]
+                continue
+            if not self.is_png:
+                output.append(self._buffer)
+                self._buffer = b""
+                break
+            if len(self._buffer) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", self._buffer[:8])
+            if chunk_type in TEXT_CHUNK_TYPES:
+                if len(self._buffer) < length + 12:
+                    break
+                chunk, self._buffer = self._buffer[:length + 12], self._buffer[length + 12:]
+                key = chunk[8:8 + length].partition(b"\x00")[0].decode("latin-1")
+                if key not in self.texts:
+                    output.append(chunk)
+                continue
+            if chunk_type in (b"IDAT", b"IEND") and not self._injected:
+                output.extend(make_text_chunk(key, value) for key, value in self.texts.items())
+                self._injected = True
+            # the chunk header, data and crc
+            self._passthrough = length + 12
+        return b"".join(output)
+
+    def close(self):
+        """Returns anything left in the buffer, which only happens if the stream was truncated."""
+        remaining, self._buffer = self._buffer, b""
+        return remaining
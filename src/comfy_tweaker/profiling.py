@@ -0,0 +1,98 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from appdirs import user_data_dir
+
+# seconds between samples, often enough to catch anything that takes a few milliseconds per iteration
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+def get_logs_directory():
+    return os.path.join(user_data_dir("ComfyTweaker", "ComfyTweaker", roaming=True), "logs")
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    # semicolons separate frames in collapsed stacks
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+def collapse_stack(thread_name, frame):
+    """Returns a stack in the collapsed format flamegraph tools read: the thread name, then each frame from the outermost in, separated by semicolons."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.append(str(thread_name).replace(";", ":"))
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread from a background thread and counts how often each stack was seen. The counts can be written as collapsed stacks, which flamegraph.pl, speedscope and inferno turn into flamegraphs.
+
+    Sampling doesn't slow down the profiled code the way cProfile's tracing does, so the time taken by an iteration stays comparable to an unprofiled run. Threads that are waiting still get sampled, so an idle event loop shows up as time spent in select.
+
+    Args:
+        interval (float, optional): seconds between samples. Defaults to DEFAULT_SAMPLE_INTERVAL.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.samples[collapse_stack(thread_names.get(thread_id, thread_id), frame)] += 1
+
+    def write(self, file_path):
+        """Writes the samples as collapsed stacks, one "stack count" line per stack."""
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as file:
+            for stack, count in sorted(self.samples.items()):
+                file.write(f"{stack} {count}\n")
+
+    def hotspots(self, limit=5):
+        """Returns the functions most often found at the top of a stack, which is where the time was spent.
+
+        Returns:
+            list[tuple[str, int]]: the innermost frame of the stacks and how many samples they were in, most first
+        """
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(limit)
+
+
+def profile_path(directory):
+    """Returns a file name for a new profile in directory, named after the current time like the log files."""
+    now = time.time()
+    timestamp = f"{time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(now))}_{int(now * 1000) % 1000:03d}"
+    return os.path.join(directory, f"queue_profile_{timestamp}.folded")
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import shutil
+from enum import Enum
+
+from appdirs import user_data_dir
+from loguru import logger
+
+
+class ReuseMode(Enum):
+    OFF = "off"
+    SKIP = "skip"
+    HARDLINK = "hardlink"
+    COPY = "copy"
+
+
+def canonicalize(value):
+    """Returns a copy of a json value with every key turned into a string and tuples turned into lists, so it can be dumped with sorted keys."""
+    # api workflows can hold both int and str node ids, which json can't sort together
+    if isinstance(value, dict):
+        return {str(key): canonicalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(item) for item in value]
+    return value
+
+
+def hash_workflow(api_workflow):
+    """
+    Returns a hash of an API workflow that is the same for any two workflows ComfyUI would execute identically, regardless of key order.
+
+    Args:
+        api_workflow (dict): the API workflow after tweaks have been applied
+
+    Returns:
+        str: the sha256 hex digest of the canonical json of the workflow
+    """
+    canonical = json.dumps(canonicalize(api_workflow), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_result_index_path():
+    data_dir = user_data_dir("ComfyTweaker", "ComfyTweaker", roaming=True)
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, "result_index.jsonl")
+
+
+class ResultIndex:
+    """
+    A local index from workflow hashes to the output images they produced. Entries are appended to a json lines file so recording a result never rewrites the whole index.
+
+    Attributes:
+        hits (int): lookups that found outputs which still exist
+        misses (int): lookups that found nothing
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_result_index_path()
+        self.hits = 0
+        self.misses = 0
+        self._index = {}
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a crash mid write can leave a partial last line
+                        continue
+                    self._index[entry["hash"]] = entry["outputs"]
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, workflow_hash):
+        """Returns the output paths previously recorded for the hash, or an empty list if there are none or they have since been deleted."""
+        outputs = [path for path in self._index.get(workflow_hash, []) if os.path.exists(path)]
+        if outputs:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return outputs
+
+    def record(self, workflow_hash, outputs):
+        """Records the output paths generated for a workflow hash."""
+        if not outputs:
+            return
+        self._index[workflow_hash] = list(outputs)
+        with open(self.path, "a") as file:
+            file.write(json.dumps({"hash": workflow_hash, "outputs": list(outputs)}) + "\n")
+
+    def summary(self):
+        return f"Result reuse: {self.hits} hits, {self.misses} misses."
+
+
+def _free_path(path):
+    root, extension = os.path.splitext(path)
+    counter = 1
+    while os.path.exists(f"{root}_reused_{counter:05}{extension}"):
+        counter += 1
+    return f"{root}_reused_{counter:05}{extension}"
+
+
+def reuse_outputs(outputs, mode):
+    """
+    Reuses previously generated outputs instead of generating them again.
+
+    Args:
+        outputs (list[str]): paths to the previous outputs
+        mode (ReuseMode): SKIP returns the previous paths, HARDLINK and COPY create new files next to them
+
+    Returns:
+        list[str]: the paths of the reused outputs
+    """
+    if mode == ReuseMode.SKIP:
+        return list(outputs)
+    reused = []
+    for path in outputs:
+        new_path = _free_path(path)
+        if mode == ReuseMode.HARDLINK:
+            try:
+                os.link(path, new_path)
+            except OSError:
+                logger.warning(f"Could not hardlink {path}, copying it instead...")
+                shutil.copy2(path, new_path)
+        else:
+            shutil.copy2(path, new_path)
+        reused.append(new_path)
+    return reused
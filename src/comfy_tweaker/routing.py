@@ -0,0 +1,88 @@
+import asyncio
+
+# inputs of loader nodes whose values name a model that has to be in VRAM
+MODEL_INPUT_NAMES = ("ckpt_name", "lora_name")
+
+
+def model_inputs(api_workflow, input_names=MODEL_INPUT_NAMES):
+    """
+    Returns the models an API workflow loads, as the (input name, value) pairs of its loader inputs.
+
+    Args:
+        api_workflow (dict): the API workflow after tweaks have been applied
+        input_names (Iterable[str], optional): the inputs that name models. Defaults to MODEL_INPUT_NAMES.
+
+    Returns:
+        frozenset[tuple[str, str]]: the models the workflow needs
+    """
+    return frozenset(
+        (name, value)
+        for node in api_workflow.values()
+        for name, value in node.get("inputs", {}).items()
+        if name in input_names and isinstance(value, str)
+    )
+
+
+class ServerRouter:
+    """
+    Chooses which ComfyUI server runs each prompt. Each server remembers the models of the last prompt it ran, and prompts prefer servers that already have their models loaded.
+
+    Servers are scored by `affinity_weight * share of the prompt's models already loaded - load_weight * prompts running`. A prompt waits for the best server if it is busy, so raising affinity_weight above load_weight makes prompts wait for a server with their models instead of reloading them on an idle one.
+
+    Args:
+        servers (list[str]): the addresses of the servers, e.g. "127.0.0.1:8188"
+        affinity_weight (float, optional): how much loaded models count. Defaults to 1.0.
+        load_weight (float, optional): how much running prompts count. Defaults to 1.0.
+        max_in_flight (int, optional): prompts each server runs at once. Defaults to 1, since ComfyUI runs prompts one at a time.
+    """
+
+    def __init__(self, servers, affinity_weight=1.0, load_weight=1.0, max_in_flight=1):
+        if not servers:
+            raise ValueError("A server router needs at least one server")
+        self.servers = list(servers)
+        self.affinity_weight = affinity_weight
+        self.load_weight = load_weight
+        self.max_in_flight = max_in_flight
+        self.loaded = {server: frozenset() for server in self.servers}
+        self.in_flight = {server: 0 for server in self.servers}
+        self._condition = None
+        self._loop = None
+
+    def _get_condition(self):
+        # conditions belong to the event loop that first uses them, and the queue can be started from different loops
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+
+    def score(self, server, models):
+        affinity = len(models & self.loaded[server]) / len(models) if models else 0.0
+        return self.affinity_weight * affinity - self.load_weight * self.in_flight[server]
+
+    def choose(self, models):
+        """Returns the best server for a prompt with the given models, busy or not. Ties go to the least busy server, then the first one listed."""
+        return max(
+            self.servers,
+            key=lambda server: (self.score(server, models), -self.in_flight[server], -self.servers.index(server)),
+        )
+
+    async def reserve(self, models):
+        """Waits until the best server for the models can take another prompt, and returns it."""
+        condition = self._get_condition()
+        async with condition:
+            while True:
+                server = self.choose(models)
+                if self.in_flight[server] < self.max_in_flight:
+                    self.in_flight[server] += 1
+                    return server
+                await condition.wait()
+
+    async def release(self, server, models=None):
+        """Marks a prompt as finished on a server. Pass the prompt's models if it succeeded, so the server is known to have them loaded. A failed prompt leaves what the server has loaded unchanged."""
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight[server] -= 1
+            if models is not None:
+                self.loaded[server] = models
+            condition.notify_all()
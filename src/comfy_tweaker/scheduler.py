@@ -0,0 +1,188 @@
+import heapq
+import itertools
+import threading
+import time
+
+# priority gained per second of waiting, one level every ten minutes
+DEFAULT_AGING_RATE = 1 / 600
+
+
+class JobScheduler:
+    """
+    A priority queue of jobs backed by a heap. Jobs with a higher priority run first, and jobs with the same priority run in the order they were added.
+
+    Waiting jobs gain aging_rate priority per second, so low priority work can't be starved by a steady stream of urgent jobs. Every job ages at the same rate, so a job's effective priority is `priority + aging_rate * (now - enqueued_at)` and the order between two jobs never changes while they wait. That lets the heap key be computed once when a job is added or reprioritized instead of on every comparison.
+
+    Reprioritizing or removing a job marks its heap entry as removed and pushes a new one, so both are O(log n). Iterating gives the jobs in effective order, which is sorted once and cached until the queue changes.
+
+    Moving a job to the front or reordering jobs gives each moved job a boost, a priority offset that puts it exactly where it was placed. The boost is part of the job's effective priority and is kept when the job is reprioritized, so the heap key, effective_priority and later reprioritizing always agree.
+
+    It supports the parts of the list interface the job queue relies on: len, iteration, indexing, `in`, append and remove.
+
+    Args:
+        jobs (Iterable[Job], optional): jobs to add, in order
+        aging_rate (float, optional): priority gained per second of waiting. Defaults to DEFAULT_AGING_RATE.
+        clock (Callable[[], float], optional): returns the current time in seconds. Defaults to time.monotonic.
+    """
+
+    def __init__(self, jobs=(), aging_rate=DEFAULT_AGING_RATE, clock=time.monotonic):
+        self.aging_rate = aging_rate
+        self.clock = clock
+        self.version = 0
+        self._heap = []
+        # job id -> [key, sequence, job, enqueued_at, removed, boost]
+        self._entries = {}
+        self._counter = itertools.count()
+        self._ordered = None
+        self._ordered_version = None
+        self._positions = None
+        self._lock = threading.RLock()
+        for job in jobs:
+            self.append(job)
+
+    def _key(self, priority, enqueued_at):
+        # larger effective priorities have to sort first in a min heap
+        return -(priority - self.aging_rate * enqueued_at)
+
+    def _boost_for(self, key, priority, enqueued_at):
+        # the boost that makes _key(priority + boost, enqueued_at) equal key
+        return -key - priority + self.aging_rate * enqueued_at
+
+    def _push(self, job, key, enqueued_at, boost=0.0, sequence=None):
+        if sequence is None:
+            sequence = next(self._counter)
+        entry = [key, sequence, job, enqueued_at, False, boost]
+        self._entries[job.id] = entry
+        heapq.heappush(self._heap, entry)
+        self.version += 1
+
+    def _discard_removed(self):
+        while self._heap and self._heap[0][4]:
+            heapq.heappop(self._heap)
+
+    def append(self, job):
+        """Adds a job, using its priority."""
+        with self._lock:
+            if job.id in self._entries:
+                raise ValueError(f"Job is already in the queue: id {job.id}")
+            enqueued_at = self.clock()
+            self._push(job, self._key(job.priority, enqueued_at), enqueued_at)
+
+    def remove(self, job):
+        """Removes a job.
+
+        Raises:
+            ValueError: If the job is not in the queue
+        """
+        with self._lock:
+            entry = self._entries.pop(job.id, None)
+            if entry is None:
+                raise ValueError(f"Job not in queue: id {job.id}")
+            entry[4] = True
+            self.version += 1
+            self._discard_removed()
+
+    def reprioritize(self, job, priority):
+        """Changes the priority of a job that is waiting. The time it has already waited, and any boost from moving it, still count."""
+        with self._lock:
+            entry = self._entries[job.id]
+            entry[4] = True
+            job.priority = priority
+            self._push(job, self._key(priority + entry[5], entry[3]), entry[3], entry[5])
+            self._discard_removed()
+
+    def move_to_front(self, job):
+        """Moves a job ahead of every other job without changing its priority."""
+        with self._lock:
+            entry = self._entries[job.id]
+            self._discard_removed()
+            front_key = self._heap[0][0]
+            if self._heap[0] is entry:
+                return
+            entry[4] = True
+            key = front_key - 1
+            self._push(job, key, entry[3], self._boost_for(key, job.priority, entry[3]))
+            self._discard_removed()
+
+    def reorder(self, jobs):
+        """
+        Puts jobs in the given order within the positions they already take up, leaving every other job where it is.
+
+        Each job takes over its new position whole: its key, sequence and enqueue time. Its boost is set so its effective priority is the one the position had, which keeps aging and later reprioritizing consistent with the new order.
+        """
+        with self._lock:
+            # jobs can be removed while a new order is worked out
+            jobs = [job for job in jobs if job.id in self._entries]
+            entries = [self._entries[job.id] for job in jobs]
+            slots = sorted((entry[0], entry[1], entry[3]) for entry in entries)
+            for entry in entries:
+                entry[4] = True
+            # the slots are reused exactly, so the old entries have to leave the heap first
+            self._heap = [entry for entry in self._heap if not entry[4]]
+            heapq.heapify(self._heap)
+            for job, (key, sequence, enqueued_at) in zip(jobs, slots):
+                self._push(job, key, enqueued_at, self._boost_for(key, job.priority, enqueued_at), sequence)
+
+    def peek(self):
+        """Returns the job that runs next without removing it.
+
+        Raises:
+            IndexError: If the queue is empty
+        """
+        with self._lock:
+            self._discard_removed()
+            if not self._heap:
+                raise IndexError("peek from an empty job queue")
+            return self._heap[0][2]
+
+    def pop(self):
+        """Removes and returns the job that runs next.
+
+        Raises:
+            IndexError: If the queue is empty
+        """
+        with self._lock:
+            job = self.peek()
+            self.remove(job)
+            return job
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+            self._entries = {}
+            self.version += 1
+
+    def effective_priority(self, job):
+        """Returns the priority of a job including the priority it gained by waiting."""
+        with self._lock:
+            entry = self._entries[job.id]
+            return job.priority + entry[5] + self.aging_rate * (self.clock() - entry[3])
+
+    def ordered(self):
+        """Returns the jobs in the order they will run. The order is cached until the queue changes."""
+        with self._lock:
+            if self._ordered_version != self.version:
+                self._ordered = [entry[2] for entry in sorted(self._entries.values())]
+                self._positions = {job.id: i for i, job in enumerate(self._ordered)}
+                self._ordered_version = self.version
+            return self._ordered
+
+    def position_of(self, job_id):
+        """Returns the zero based position of a job in the effective order, or None if it isn't queued."""
+        with self._lock:
+            self.ordered()
+            return self._positions.get(job_id)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self.ordered())
+
+    def __contains__(self, job):
+        return job.id in self._entries
+
+    def __getitem__(self, index):
+        if index == 0:
+            return self.peek()
+        return self.ordered()[index]
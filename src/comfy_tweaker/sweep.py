@@ -0,0 +1,49 @@
+import math
+
+
+class SweepPoint(dict):
+    """One combination of a sweep. The values are available by axis name, along with the index of the combination and the total amount of combinations."""
+
+    def __init__(self, values, index, total):
+        super().__init__(values)
+        self.index = index
+        self.total = total
+
+
+class Sweep:
+    """
+    A grid over named axes, like checkpoints × loras × cfg values. Combinations are computed from their index on demand, so the size of the grid has no effect on memory use. The last axis changes fastest, the same order as `itertools.product`.
+
+    Args:
+        axes (dict[str, Sequence]): the values of each axis, in order
+    """
+
+    def __init__(self, axes):
+        self.axes = {name: list(values) for name, values in axes.items()}
+        for name, values in self.axes.items():
+            if not values:
+                raise ValueError(f"Sweep axis \"{name}\" has no values")
+
+    def __len__(self):
+        return math.prod(len(values) for values in self.axes.values())
+
+    def __getitem__(self, index):
+        total = len(self)
+        if not -total <= index < total:
+            raise IndexError(f"Sweep index {index} out of range for {total} combinations")
+        index %= total
+        values = {}
+        remainder = index
+        for name, axis in reversed(self.axes.items()):
+            remainder, position = divmod(remainder, len(axis))
+            values[name] = axis[position]
+        # restore the declared axis order
+        return SweepPoint({name: values[name] for name in self.axes}, index, total)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def at(self, iteration):
+        """Returns the combination for an iteration, starting over once every combination has been used."""
+        return self[iteration % len(self)]
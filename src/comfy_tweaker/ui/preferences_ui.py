@@ -15,7 +15,7 @@ from PySide6.QtGui import (QBrush, QColor, QConicalGradient, QCursor,
     QFont, QFontDatabase, QGradient, QIcon,
     QImage, QKeySequence, QLinearGradient, QPainter,
     QPalette, QPixmap, QRadialGradient, QTransform)
-from PySide6.QtWidgets import (QApplication, QDialog, QFormLayout, QFrame,
+from PySide6.QtWidgets import (QApplication, QCheckBox, QDialog, QFormLayout, QFrame,
     QHBoxLayout, QLabel, QLayout, QLineEdit,
     QPushButton, QSizePolicy, QToolButton, QVBoxLayout,
     QWidget)
@@ -125,6 +125,16 @@ class Ui_PreferencesDialog(object):
 
         self.formLayout.setWidget(3, QFormLayout.LabelRole, self.label_4)
 
+        self.label_5 = QLabel(self.frame)
+        self.label_5.setObjectName(u"label_5")
+
+        self.formLayout.setWidget(4, QFormLayout.LabelRole, self.label_5)
+
+        self.profileQueueRunsCheckBox = QCheckBox(self.frame)
+        self.profileQueueRunsCheckBox.setObjectName(u"profileQueueRunsCheckBox")
+
+        self.formLayout.setWidget(4, QFormLayout.FieldRole, self.profileQueueRunsCheckBox)
+
 
         self.verticalLayout.addLayout(self.formLayout)
 
@@ -177,6 +187,11 @@ class Ui_PreferencesDialog(object):
         self.label_4.setToolTip(QCoreApplication.translate("PreferencesDialog", u"The root directory containing wildcards in the form of new line separated text files", None))
 #endif // QT_CONFIG(tooltip)
         self.label_4.setText(QCoreApplication.translate("PreferencesDialog", u"ComfyUI Server Address", None))
+#if QT_CONFIG(tooltip)
+        self.label_5.setToolTip(QCoreApplication.translate("PreferencesDialog", u"Write a profile of each queue run to the logs folder, for finding out why runs are slow", None))
+#endif // QT_CONFIG(tooltip)
+        self.label_5.setText(QCoreApplication.translate("PreferencesDialog", u"Profile Queue Runs", None))
+        self.profileQueueRunsCheckBox.setText("")
         self.closeButton.setText(QCoreApplication.translate("PreferencesDialog", u"Close", None))
     # retranslateUi
 
@@ -0,0 +1,176 @@
+import hashlib
+import http.client
+import json
+import mimetypes
+import os
+import threading
+import urllib.parse
+import uuid
+
+from appdirs import user_data_dir
+from loguru import logger
+
+CHUNK_SIZE = 64 * 1024
+
+# (path, size, mtime) -> hash, so unchanged images are only read once per session
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def hash_file(file_path):
+    """Returns the sha256 hex digest of a file's bytes, reading it in chunks. Hashes are remembered until the file changes."""
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if key in _file_hashes:
+            return _file_hashes[key]
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    with _file_hashes_lock:
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+def get_upload_record_path():
+    data_dir = user_data_dir("ComfyTweaker", "ComfyTweaker", roaming=True)
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, "uploads.jsonl")
+
+
+class UploadRecord:
+    """
+    A local record of the images already uploaded to each ComfyUI server, by the hash of their bytes. Entries are appended to a json lines file.
+
+    Input folders get cleaned out and servers get reinstalled, so an entry is only trusted after upload_image has seen the image is still on the server once this session.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_upload_record_path()
+        self._uploads = {}
+        self._confirmed = set()
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a crash mid write can leave a partial last line
+                        continue
+                    self._uploads[(entry["server"], entry["hash"])] = entry["name"]
+
+    def get(self, server_address, image_hash):
+        """Returns the server side name of an uploaded image, or None if it hasn't been uploaded to that server."""
+        with self._lock:
+            return self._uploads.get((server_address, image_hash))
+
+    def is_confirmed(self, server_address, image_hash):
+        with self._lock:
+            return (server_address, image_hash) in self._confirmed
+
+    def confirm(self, server_address, image_hash):
+        with self._lock:
+            self._confirmed.add((server_address, image_hash))
+
+    def add(self, server_address, image_hash, name):
+        with self._lock:
+            self._uploads[(server_address, image_hash)] = name
+            self._confirmed.add((server_address, image_hash))
+            with open(self.path, "a") as file:
+                file.write(json.dumps({"server": server_address, "hash": image_hash, "name": name}) + "\n")
+
+
+_default_record = None
+
+
+def default_upload_record():
+    global _default_record
+    if _default_record is None:
+        _default_record = UploadRecord()
+    return _default_record
+
+
+def image_exists(server_address, name):
+    """Returns whether an image is in the input folder of a ComfyUI server, asking its /view endpoint for the headers only."""
+    subfolder, _, filename = name.rpartition("/")
+    query = urllib.parse.urlencode({"filename": filename, "subfolder": subfolder, "type": "input"})
+    connection = http.client.HTTPConnection(server_address)
+    try:
+        connection.request("HEAD", f"/view?{query}")
+        return connection.getresponse().status == 200
+    finally:
+        connection.close()
+
+
+def post_image(server_address, image_path, upload_name):
+    """
+    Uploads an image to ComfyUI's /upload/image endpoint as multipart form data, streaming the file instead of loading it into memory.
+
+    Returns:
+        str: the name of the image on the server, relative to its input folder
+    """
+    boundary = uuid.uuid4().hex
+    content_type = mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+    upload_name = upload_name.replace('"', "_")
+    head = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="overwrite"\r\n\r\n'
+        "true\r\n"
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="{upload_name}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    connection = http.client.HTTPConnection(server_address)
+    try:
+        connection.putrequest("POST", "/upload/image")
+        connection.putheader("Content-Type", f"multipart/form-data; boundary={boundary}")
+        connection.putheader("Content-Length", str(len(head) + os.path.getsize(image_path) + len(tail)))
+        connection.endheaders()
+        connection.send(head)
+        with open(image_path, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                connection.send(chunk)
+        connection.send(tail)
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise ValueError(f"Uploading {image_path} failed with status {response.status}: {body[:200]!r}")
+        result = json.loads(body)
+    finally:
+        connection.close()
+    if result.get("subfolder"):
+        return f"{result['subfolder']}/{result['name']}"
+    return result["name"]
+
+
+def upload_image(server_address, image_path, record=None):
+    """
+    Uploads an image to a ComfyUI server unless the same bytes were uploaded to it before.
+
+    Args:
+        server_address (str): the address of the ComfyUI server, e.g. "127.0.0.1:8188"
+        image_path (str): the path of the image to upload
+        record (UploadRecord, optional): the record of previous uploads. Defaults to the one in the user data directory.
+
+    Returns:
+        str: the name of the image on the server, which can be used as a LoadImage input
+    """
+    record = record or default_upload_record()
+    image_hash = hash_file(image_path)
+    name = record.get(server_address, image_hash)
+    if name:
+        if record.is_confirmed(server_address, image_hash):
+            return name
+        if image_exists(server_address, name):
+            record.confirm(server_address, image_hash)
+            return name
+        logger.info(f"{name} is no longer on {server_address}, uploading it again...")
+    stem, extension = os.path.splitext(os.path.basename(image_path))
+    logger.info(f"Uploading {image_path} to {server_address}...")
+    name = post_image(server_address, image_path, f"{stem}-{image_hash[:16]}{extension}")
+    record.add(server_address, image_hash, name)
+    return name
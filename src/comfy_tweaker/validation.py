@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+
+from loguru import logger
+
+from comfy_tweaker import JobStatus, Tweaks
+
+# the folders inside MODELS_FOLDER that each loader input reads from
+MODEL_FOLDERS = {
+    "ckpt_name": ("checkpoints",),
+    "lora_name": ("loras", "lora"),
+}
+
+
+class ModelIndex:
+    """
+    A cached listing of the files in each folder of MODELS_FOLDER, so checking whether a model exists doesn't walk the disk every time. Listings are refreshed once they are older than ttl seconds.
+
+    Args:
+        ttl (float, optional): seconds a listing is trusted for. Defaults to 30.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        # (models folder, folder) -> (time listed, relative paths or None if the folder doesn't exist)
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def files(self, folder):
+        """Returns the relative paths of the files in a folder of MODELS_FOLDER with forward slashes, or None if the folder doesn't exist."""
+        models_folder = os.getenv("MODELS_FOLDER")
+        key = (models_folder, folder)
+        with self._lock:
+            listed = self._listings.get(key)
+            if listed and time.monotonic() - listed[0] < self.ttl:
+                return listed[1]
+        path = os.path.join(models_folder, folder)
+        files = None
+        if os.path.isdir(path):
+            files = frozenset(
+                os.path.relpath(os.path.join(root, name), path).replace(os.sep, "/")
+                for root, _dirs, names in os.walk(path)
+                for name in names
+            )
+        with self._lock:
+            self._listings[key] = (time.monotonic(), files)
+        return files
+
+    def exists(self, input_name, value):
+        """Returns False if a model named by a loader input is missing. Models that can't be checked, because MODELS_FOLDER is unset or the folder doesn't exist, count as existing."""
+        if not os.getenv("MODELS_FOLDER"):
+            return True
+        listings = [self.files(folder) for folder in MODEL_FOLDERS.get(input_name, ())]
+        listings = [files for files in listings if files is not None]
+        if not listings:
+            return True
+        value = value.replace("\\", "/")
+        return any(value in files for files in listings)
+
+
+def find_problem(job, model_index):
+    """
+    Renders the next iteration of a job without side effects, applies it to the workflow and checks that its models exist.
+
+    Args:
+        job (Job): the job to check
+        model_index (ModelIndex): the listing of the models folder
+
+    Returns:
+        str | None: a description of the problem, or None if the job looks fine
+    """
+    try:
+        with Tweaks.dry_run():
+            tweaks = Tweaks.from_yaml(job.tweaks._original_yaml, name=job.tweaks.name, iteration=job.tweaks._iteration)
+        api_workflow = job.original_workflow.apply_tweaks(tweaks).api_workflow
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    for node_id, node in api_workflow.items():
+        for input_name, value in node.get("inputs", {}).items():
+            if input_name in MODEL_FOLDERS and isinstance(value, str) and not model_index.exists(input_name, value):
+                return f"Model not found for node {node_id} {input_name}: {value}"
+    return None
+
+
+class BackgroundValidator:
+    """
+    Checks upcoming jobs in a background thread, so problems caused by changes after a job was added, like a deleted model or a moved wildcard folder, are found before the job reaches the front of the queue. Problems are stored in job.problem.
+
+    The thread only looks at the first lookahead waiting jobs, pauses between jobs, and waits interval seconds between passes, so it stays out of the way of the queue.
+
+    Args:
+        job_queue (JobQueue): the queue whose jobs are checked
+        interval (float, optional): seconds between passes. Defaults to 30.
+        lookahead (int, optional): how many waiting jobs are checked each pass. Defaults to 20.
+        model_index (ModelIndex, optional): the listing of the models folder. Defaults to a new one.
+    """
+
+    def __init__(self, job_queue, interval=30, lookahead=20, model_index=None):
+        self.job_queue = job_queue
+        self.interval = interval
+        self.lookahead = lookahead
+        self.model_index = model_index or ModelIndex(ttl=interval)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def check(self, job):
+        """Checks a job now and updates its problem. Returns the problem, or None."""
+        problem = find_problem(job, self.model_index)
+        if problem and problem != job.problem:
+            logger.warning(f"{job.original_workflow.name} with {job.tweaks.name} will fail: {problem}")
+        elif job.problem and not problem:
+            logger.info(f"{job.original_workflow.name} with {job.tweaks.name} is valid again.")
+        job.problem = problem
+        return problem
+
+    def validate_upcoming(self):
+        """Checks the first lookahead jobs that are waiting."""
+        for job in list(self.job_queue.queue)[:self.lookahead]:
+            if self._stop_event.is_set():
+                return
+            if job.status == JobStatus.IN_PROGRESS:
+                continue
+            self.check(job)
+            # give the queue and the GUI the interpreter between jobs
+            time.sleep(0.01)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.validate_upcoming()
+            except Exception as e:
+                logger.error(f"Background validation failed: {e}")
+            self._stop_event.wait(self.interval)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Starts checking jobs in the background. Does nothing if it is already running."""
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="BackgroundValidator")
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
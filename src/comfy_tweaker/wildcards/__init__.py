@@ -4,6 +4,8 @@ import random
 import attrs
 import regex as re
 
+from comfy_tweaker.file_cache import file_cache
+
 from .exceptions import (EmptyWildcardFile, InvalidWildcardFormat,
                          WildcardNotFound)
 
@@ -105,8 +107,7 @@ class WildcardProcessor:
         if not os.path.exists(file_path):
             raise WildcardNotFound(f"Wildcard file not found: {file_path}")
 
-        with open(file_path, "r") as file:
-            lines = file.read().splitlines()
+        lines = file_cache.read_text(file_path).splitlines()
 
         if not lines:
             raise EmptyWildcardFile(f"No lines found in file: {file_path}")
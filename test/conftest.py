@@ -3,6 +3,16 @@ import shutil
 
 import pytest
 
+from comfy_tweaker import Job, Tweaks, Workflow
+
+
+@pytest.fixture(autouse=True, scope="session")
+def template_cache_directory(tmp_path_factory):
+    # compiled templates would otherwise be cached in the real user data directory
+    Tweaks.bytecode_cache_directory = str(tmp_path_factory.mktemp("template_cache"))
+    Tweaks.invalidate_environment()
+    return Tweaks.bytecode_cache_directory
+
 
 @pytest.fixture
 def wildcards_directory(tmpdir):
@@ -26,3 +36,12 @@ def models_directory(tmpdir):
     dest = tmpdir.mkdir("models")
     shutil.copytree(src, str(dest), dirs_exist_ok=True)
     return dest
+
+
+@pytest.fixture
+def workflow_job(tweaks_directory):
+    workflow = Workflow.from_image(tweaks_directory / "valid_workflow_image.png")
+    tweaks = Tweaks.from_file(tweaks_directory / "tweaks_file.yaml")
+    job = Job(workflow, tweaks)
+    job.workflow = workflow.apply_tweaks(tweaks)
+    return job
@@ -0,0 +1,249 @@
+import asyncio
+import io
+import json
+import threading
+import time
+
+import pytest
+import websockets
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from PIL import Image
+
+from comfy_tweaker import Tweaks
+from comfy_tweaker.comfyui import (OutputDownloader, OutputProcessor, OutputRecord, generate_images,
+                                   wait_for_complete_file, write_image_metadata)
+from comfy_tweaker.png import read_png_text
+from comfy_tweaker.uploads import UploadRecord, upload_image
+
+
+def make_output_images(tmpdir, amount):
+    image_paths = []
+    for i in range(amount):
+        image_path = str(tmpdir / f"ComfyUI_{i:05}_.png")
+        Image.new("RGB", (32, 32)).save(image_path)
+        image_paths.append(image_path)
+    return image_paths
+
+
+def test_output_processor_writes_metadata_in_the_background(tmpdir, workflow_job):
+    image_paths = make_output_images(tmpdir, 6)
+    processor = OutputProcessor(workers=2, max_pending=2)
+    for image_path in image_paths:
+        processor.submit(OutputRecord.from_job(workflow_job, [image_path]))
+    processor.shutdown()
+    for image_path in image_paths:
+        metadata = read_png_text(image_path)
+        assert json.loads(metadata["workflow"]) == workflow_job.workflow.gui_workflow
+        assert json.loads(metadata["tweaks"]) == workflow_job.tweaks._original_yaml
+
+
+def test_output_record_keeps_the_iteration_it_was_made_for(workflow_job):
+    record = OutputRecord.from_job(workflow_job, [])
+    workflow_job.tweaks = Tweaks(_original_yaml="next iteration")
+    assert record.tweaks_yaml != "next iteration"
+
+
+def png_bytes(size=256):
+    buffer = io.BytesIO()
+    Image.effect_noise((size, size), 64).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def slow_write(image_path, data, chunks=10, delay=0.05):
+    with open(image_path, "wb") as file:
+        for i in range(chunks):
+            file.write(data[i * len(data) // chunks:(i + 1) * len(data) // chunks])
+            file.flush()
+            time.sleep(delay)
+
+
+def test_waits_for_a_slow_writer_to_finish(tmpdir):
+    image_path = str(tmpdir / "slow.png")
+    data = png_bytes()
+    writer = threading.Thread(target=slow_write, args=(image_path, data))
+    writer.start()
+    assert wait_for_complete_file(image_path, timeout=5, interval=0.02)
+    with open(image_path, "rb") as file:
+        assert file.read() == data
+    writer.join()
+
+
+def test_gives_up_on_a_file_that_never_completes(tmpdir):
+    image_path = str(tmpdir / "truncated.png")
+    with open(image_path, "wb") as file:
+        file.write(png_bytes()[:-20])
+    assert not wait_for_complete_file(image_path, timeout=0.3, interval=0.02)
+
+
+def test_metadata_is_written_after_a_slow_writer_finishes(tmpdir):
+    image_path = str(tmpdir / "slow.png")
+    writer = threading.Thread(target=slow_write, args=(image_path, png_bytes()))
+    writer.start()
+    time.sleep(0.01)
+    assert write_image_metadata(image_path, {"nodes": []}, "tweaks: []", timeout=5)
+    writer.join()
+    assert read_png_text(image_path)["workflow"] == json.dumps({"nodes": []})
+    assert not tmpdir.join("slow.png.lock").exists()
+
+
+class FakeWebSocket:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.closed = False
+
+    async def recv(self):
+        message = self.messages.pop(0)
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    async def close(self):
+        self.closed = True
+
+
+def executed(node, filename, prompt_id="prompt"):
+    return json.dumps({
+        "type": "executed",
+        "data": {"node": node, "prompt_id": prompt_id, "output": {"images": [{"filename": filename, "subfolder": "", "type": "output"}]}},
+    })
+
+
+def executing(node, prompt_id="prompt"):
+    return json.dumps({"type": "executing", "data": {"node": node, "prompt_id": prompt_id}})
+
+
+@pytest.fixture
+def comfyui_output_folder(tmpdir, monkeypatch, mocker):
+    monkeypatch.setenv("COMFYUI_OUTPUT_FOLDER", str(tmpdir))
+    mocker.patch("comfy_tweaker.comfyui.queue_prompt", return_value={"prompt_id": "prompt"})
+    for filename in ["first.png", "second.png"]:
+        Image.new("RGB", (16, 16)).save(str(tmpdir / filename))
+    return tmpdir
+
+
+@pytest.mark.asyncio
+async def test_outputs_are_collected_from_executed_messages(comfyui_output_folder, workflow_job, mocker):
+    get_history = mocker.patch("comfy_tweaker.comfyui.get_history")
+    ws = FakeWebSocket([
+        executing("7"),
+        executed("7", "first.png"),
+        executed("9", "other.png", prompt_id="someone else"),
+        b"\x00" * 8 + b"preview",
+        executed("8", "second.png"),
+        executing(None),
+    ])
+    outputs = await generate_images(ws, workflow_job)
+    assert outputs == [str(comfyui_output_folder / "first.png"), str(comfyui_output_folder / "second.png")]
+    assert workflow_job.preview_image == b"preview"
+    assert "workflow" in read_png_text(outputs[0])
+    get_history.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_metadata_is_written_off_the_event_loop(comfyui_output_folder, workflow_job, mocker):
+    mocker.patch("comfy_tweaker.comfyui.get_history")
+    threads = []
+    mocker.patch("comfy_tweaker.comfyui.process_output_record", side_effect=lambda record: threads.append(threading.get_ident()))
+    ws = FakeWebSocket([executed("7", "first.png"), executing(None)])
+    await generate_images(ws, workflow_job)
+    assert threads and threads[0] != threading.get_ident()
+
+
+@pytest.mark.asyncio
+async def test_history_is_used_after_reconnecting(comfyui_output_folder, workflow_job, mocker):
+    history = {"prompt": {"outputs": {
+        "7": {"images": [{"filename": "first.png", "subfolder": "", "type": "output"}]},
+        "8": {"images": [{"filename": "second.png", "subfolder": "", "type": "output"}]},
+    }}}
+    mocker.patch("comfy_tweaker.comfyui.get_history", return_value=history)
+    reconnected = FakeWebSocket([])
+    mocker.patch("comfy_tweaker.comfyui.websockets.connect", mocker.AsyncMock(return_value=reconnected))
+    ws = FakeWebSocket([executed("7", "first.png"), websockets.ConnectionClosedError(None, None)])
+    outputs = await generate_images(ws, workflow_job)
+    assert outputs == [str(comfyui_output_folder / "first.png"), str(comfyui_output_folder / "second.png")]
+    assert reconnected.closed
+
+
+@pytest.mark.asyncio
+async def test_downloads_outputs_from_a_remote_server(tmpdir):
+    data = png_bytes()
+    active = 0
+    most_active = 0
+
+    async def view(request):
+        nonlocal active, most_active
+        active += 1
+        most_active = max(most_active, active)
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for i in range(0, len(data), 4096):
+            await response.write(data[i:i + 4096])
+            await asyncio.sleep(0.001)
+        active -= 1
+        return response
+
+    app = web.Application()
+    app.router.add_get("/view", view)
+    server = TestServer(app)
+    await server.start_server()
+    downloader = OutputDownloader(f"{server.host}:{server.port}", str(tmpdir), max_parallel=2)
+    try:
+        images = [{"filename": f"ComfyUI_{i:05}_.png", "subfolder": "remote", "type": "output"} for i in range(5)]
+        paths = await asyncio.gather(*(downloader.download(image, {"workflow": "{}"}) for image in images))
+    finally:
+        await downloader.close()
+        await server.close()
+
+    assert paths == [str(tmpdir / "remote" / image["filename"]) for image in images]
+    assert most_active <= 2
+    for path in paths:
+        assert read_png_text(path)["workflow"] == "{}"
+        with Image.open(path) as image:
+            assert image.tobytes() == Image.open(io.BytesIO(data)).tobytes()
+
+
+@pytest.mark.asyncio
+async def test_uploads_each_image_once_per_server(tmpdir):
+    uploads = []
+    views = []
+
+    async def upload(request):
+        form = await request.post()
+        uploads.append((form["image"].filename, form["image"].file.read()))
+        return web.json_response({"name": form["image"].filename, "subfolder": "", "type": "input"})
+
+    async def view(request):
+        views.append(request.query["filename"])
+        if request.query["type"] == "input" and any(name == request.query["filename"] for name, _ in uploads):
+            return web.Response(body=b"")
+        raise web.HTTPNotFound()
+
+    app = web.Application()
+    app.router.add_post("/upload/image", upload)
+    app.router.add_get("/view", view)
+    server = TestServer(app)
+    await server.start_server()
+    image_path = str(tmpdir / "depth.png")
+    with open(image_path, "wb") as file:
+        file.write(png_bytes())
+    record = UploadRecord(str(tmpdir / "uploads.jsonl"))
+    try:
+        address = f"{server.host}:{server.port}"
+        first = await asyncio.to_thread(upload_image, address, image_path, record)
+        assert await asyncio.to_thread(upload_image, address, image_path, record) == first
+        assert not views
+        second = await asyncio.to_thread(upload_image, address, image_path, UploadRecord(record.path))
+        assert views == [first]
+        assert len(uploads) == 1
+        # the server lost its input folder since the last session
+        uploads.clear()
+        assert await asyncio.to_thread(upload_image, address, image_path, UploadRecord(record.path)) == first
+    finally:
+        await server.close()
+
+    assert first == second
+    assert first.startswith("depth-") and first.endswith(".png")
+    assert len(uploads) == 1
+    with open(image_path, "rb") as file:
+        assert uploads[0][1] == file.read()
@@ -0,0 +1,69 @@
+import io
+import json
+
+import pytest
+from PIL import Image, PngImagePlugin
+
+from comfy_tweaker import Workflow
+from comfy_tweaker.png import InvalidPngError, PngTextInjector, read_png_text
+
+
+@pytest.fixture
+def text_chunk_image(tmpdir):
+    metadata = PngImagePlugin.PngInfo()
+    metadata.add_text("plain", "tEXt value")
+    metadata.add_text("compressed", "zTXt value " * 50, zip=True)
+    metadata.add_itxt("international", "iTXt välue", zip=False)
+    metadata.add_itxt("international_compressed", "compressed iTXt välue " * 50, zip=True)
+    image_path = str(tmpdir / "text_chunks.png")
+    Image.new("RGB", (64, 64)).save(image_path, pnginfo=metadata)
+    return image_path
+
+
+def test_reads_all_text_chunk_types(text_chunk_image):
+    with Image.open(text_chunk_image) as image:
+        expected = dict(image.text)
+    assert read_png_text(text_chunk_image) == expected
+
+
+def test_reads_only_requested_keys(text_chunk_image):
+    assert read_png_text(text_chunk_image, keys=["compressed"]) == {"compressed": "zTXt value " * 50}
+
+
+def test_rejects_non_png_files(tmpdir):
+    image_path = str(tmpdir / "image.jpg")
+    Image.new("RGB", (8, 8)).save(image_path)
+    with pytest.raises(InvalidPngError):
+        read_png_text(image_path)
+
+
+def test_workflow_from_image_matches_pil_metadata(tweaks_directory):
+    image_path = tweaks_directory / "valid_workflow_image.png"
+    with Image.open(image_path) as image:
+        expected_api_workflow = json.loads(image.info["prompt"])
+    assert Workflow.from_image(image_path).api_workflow == expected_api_workflow
+
+
+def test_workflow_from_folder_skips_images_without_workflows(tweaks_directory):
+    workflows = Workflow.from_folder(str(tweaks_directory))
+    assert list(workflows) == [str(tweaks_directory / "valid_workflow_image.png")]
+    assert workflows[str(tweaks_directory / "valid_workflow_image.png")].name == "valid_workflow_image.png"
+
+
+def test_injects_text_chunks_into_a_streamed_png(text_chunk_image):
+    with open(text_chunk_image, "rb") as file:
+        data = file.read()
+    injector = PngTextInjector({"plain": "replaced", "workflow": json.dumps({"nodes": []})})
+    output = b"".join(injector.feed(data[i:i + 7]) for i in range(0, len(data), 7)) + injector.close()
+
+    with Image.open(io.BytesIO(output)) as image:
+        image.load()
+        assert image.text["plain"] == "replaced"
+        assert image.text["workflow"] == json.dumps({"nodes": []})
+        assert image.text["compressed"] == "zTXt value " * 50
+    assert output.count(b"plain\x00") == 1
+
+
+def test_passes_other_data_through_unchanged():
+    injector = PngTextInjector({"workflow": "{}"})
+    assert injector.feed(b"not a png at all") + injector.close() == b"not a png at all"
@@ -1,13 +1,34 @@
 import asyncio
+import builtins
+import collections
+import itertools
+import json
+import multiprocessing
 import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import jinja2
 import pytest
 
-from comfy_tweaker.plugins import import_plugin
+from comfy_tweaker import plugins
+from comfy_tweaker.plugins import PluginType, import_plugin
+from comfy_tweaker.cache_order import expected_cache_hit_rate, node_signatures, order_for_cache
+from comfy_tweaker.cycles import CycleStore
+from comfy_tweaker.file_cache import FileCache
+from comfy_tweaker.filters import as_image, cycle_store
+from comfy_tweaker.json_cache import JsonCache
+from comfy_tweaker.profiling import SamplingProfiler
+from comfy_tweaker.routing import ServerRouter, model_inputs
+from comfy_tweaker.scheduler import JobScheduler
+from comfy_tweaker.results import ResultIndex, ReuseMode, hash_workflow
+from comfy_tweaker.sweep import Sweep
 import comfy_tweaker as tweaker
 from comfy_tweaker import Tweak, Tweaks, Workflow
 from comfy_tweaker.exceptions import (IncompleteImageWorkflowError,
-                                      InvalidSelectorError)
+                                      InvalidSelectorError, NodeFieldNotFound)
 
 
 @pytest.fixture
@@ -332,6 +353,74 @@ def test_tweaks_file_supports_folder_cycle(models_directory):
         assert tweaks.tweaks[0].changes["lora_name"] == expected_value
 
 
+def test_cycle_store_forgets_least_recently_used_cycles():
+    store = CycleStore(max_size=2)
+    items = ["a", "b", "c"]
+    assert [store.next("first", items) for _ in range(4)] == ["a", "b", "c", "a"]
+    store.next("second", items)
+    store.next("first", items)
+    store.next("third", items)
+    assert len(store) == 2
+    # "second" was forgotten, so it starts over
+    assert store.peek("second", items) == "a"
+    assert store.peek("first", items) == "c"
+
+
+def test_cycle_store_shuffles_without_replacement():
+    store = CycleStore()
+    items = list(range(10))
+    for _ in range(3):
+        assert sorted(store.next("shuffled", items, shuffle=True) for _ in items) == items
+
+
+def test_cycle_store_peeks_at_the_shuffled_item_next_returns():
+    items = list(range(10))
+    for _ in range(20):
+        store = CycleStore()
+        peeked = [store.peek("new", items, shuffle=True)]
+        assert store.next("new", items, shuffle=True) == peeked[0]
+        for _ in range(9):
+            store.next("new", items, shuffle=True)
+        # a new pass draws a new order, which the peek has to keep as well
+        peeked = store.peek("new", items, shuffle=True)
+        assert store.next("new", items, shuffle=True) == peeked
+
+
+def test_cycle_store_is_thread_safe():
+    store = CycleStore()
+    items = list(range(7))
+    results = []
+
+    def take():
+        results.extend(store.next("shared", items) for _ in range(700))
+
+    threads = [threading.Thread(target=take) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert collections.Counter(results) == {item: 800 for item in items}
+
+
+def test_tweaks_file_supports_shuffled_folder_cycle(models_directory):
+    os.environ["MODELS_FOLDER"] = str(models_directory)
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 346
+          changes:
+            lora_name: {{ from_models_folder("lora", cycle="shuffle") }}
+    """
+    # other tests cycle through the same folder
+    cycle_store.clear()
+    tweaks = tweaker.Tweaks.from_yaml(tweaks_yaml)
+    names = [tweaks.tweaks[0].changes["lora_name"]]
+    for _ in range(3):
+        tweaks = tweaks.regenerate()
+        names.append(tweaks.tweaks[0].changes["lora_name"])
+    assert sorted(names[:2]) == sorted(names[2:]) == ["test1.safetensors", "test2.safetensors"]
+
+
 def test_empty_tweaks_wont_change_workflow(workflow):
     tweaks = Tweaks()
     result = workflow.apply_tweaks(tweaks)
@@ -425,6 +514,206 @@ async def test_job_queue_pause(workflow, tweaks, mock_send_workflow_to_server):
     assert len(queue.queue) == 1
     assert mock_send_workflow_to_server.call_count == 5
 
+def test_job_scheduler_orders_by_priority_then_age(workflow, tweaks):
+    now = [0]
+    scheduler = JobScheduler(aging_rate=0.1, clock=lambda: now[0])
+    low = tweaker.Job(workflow, tweaks)
+    also_low = tweaker.Job(workflow, tweaks)
+    high = tweaker.Job(workflow, tweaks, priority=5)
+    for job in (low, also_low, high):
+        scheduler.append(job)
+        now[0] += 1
+    assert list(scheduler) == [high, low, also_low]
+    # after waiting long enough, old low priority jobs overtake a new high priority one
+    now[0] = 100
+    newer_high = tweaker.Job(workflow, tweaks, priority=5)
+    scheduler.append(newer_high)
+    assert list(scheduler) == [high, low, also_low, newer_high]
+    assert scheduler.effective_priority(low) == pytest.approx(10)
+
+
+def test_job_scheduler_reprioritizes_and_removes(workflow, tweaks):
+    jobs = [tweaker.Job(workflow, tweaks) for _ in range(4)]
+    scheduler = JobScheduler(jobs, aging_rate=0)
+    ordered = scheduler.ordered()
+    assert scheduler.ordered() is ordered
+    scheduler.reprioritize(jobs[2], 1)
+    assert list(scheduler) == [jobs[2], jobs[0], jobs[1], jobs[3]]
+    scheduler.move_to_front(jobs[3])
+    assert scheduler[0] is jobs[3]
+    assert jobs[3].priority == 0
+    scheduler.remove(jobs[3])
+    assert scheduler.pop() is jobs[2]
+    assert list(scheduler) == [jobs[0], jobs[1]]
+    assert scheduler.position_of(jobs[1].id) == 1
+    assert jobs[3] not in scheduler
+    with pytest.raises(ValueError):
+        scheduler.remove(jobs[3])
+
+
+def test_job_scheduler_keeps_moved_jobs_consistent(workflow, tweaks):
+    now = [0]
+    scheduler = JobScheduler(aging_rate=0.1, clock=lambda: now[0])
+    jobs = [tweaker.Job(workflow, tweaks) for _ in range(4)]
+    for job in jobs:
+        scheduler.append(job)
+        now[0] += 10
+    priorities = [scheduler.effective_priority(job) for job in jobs]
+    scheduler.reorder([jobs[2], jobs[0], jobs[1]])
+    assert list(scheduler) == [jobs[2], jobs[0], jobs[1], jobs[3]]
+    # each job took over the effective priority of the position it moved to
+    assert [scheduler.effective_priority(job) for job in scheduler] == pytest.approx(priorities)
+    now[0] += 100
+    # the order still holds after more aging and a priority change that keeps the job's place
+    scheduler.reprioritize(jobs[0], 0)
+    assert list(scheduler) == [jobs[2], jobs[0], jobs[1], jobs[3]]
+    scheduler.move_to_front(jobs[3])
+    assert scheduler.effective_priority(jobs[3]) > scheduler.effective_priority(jobs[2])
+    scheduler.reprioritize(jobs[3], 0)
+    assert scheduler[0] is jobs[3]
+
+
+def test_job_queue_defaults_to_an_empty_scheduler_with_its_aging_rate():
+    queue = tweaker.JobQueue(aging_rate=0.5)
+    assert isinstance(queue.queue, JobScheduler) and not queue.queue
+    assert queue.queue.aging_rate == 0.5
+
+
+@pytest.mark.asyncio
+async def test_job_queue_runs_urgent_jobs_between_iterations(workflow, mocker):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 2
+          changes:
+            seed: {{ iteration }}
+    """
+    seeds = []
+    queue = tweaker.JobQueue(aging_rate=0)
+    bulk = queue.add(workflow, Tweaks.from_yaml(tweaks_yaml), amount=3, validate=False)
+
+    async def fake_run_job_on_server(job, **kwargs):
+        seeds.append(job.workflow.api_workflow["2"]["inputs"]["seed"])
+        if len(seeds) == 1:
+            queue.add(workflow, Tweaks.from_yaml(tweaks_yaml, iteration=100), validate=False, priority=10)
+
+    mocker.patch("comfy_tweaker.run_job_on_server", side_effect=fake_run_job_on_server)
+    await queue.start()
+    assert seeds == [0, 100, 1, 2]
+    assert bulk.progress == 3
+    assert len(queue.queue) == 0
+
+def test_node_signatures_include_upstream_nodes(workflow):
+    signatures = node_signatures(workflow.api_workflow)
+    changed = workflow.api_workflow.copy()
+    changed["1"] = {**changed["1"], "inputs": {**changed["1"]["inputs"], "ckpt_name": "other.safetensors"}}
+    changed_signatures = node_signatures(changed)
+    # the latent doesn't depend on the checkpoint, everything else does
+    assert [node_id for node_id in signatures if signatures[node_id] == changed_signatures[node_id]] == ["6"]
+
+
+def test_order_for_cache_groups_matching_graphs():
+    signature_sets = [{"a", "x"}, {"b", "y"}, {"a", "x"}, {"b", "z"}, {"a", "w"}]
+    order = order_for_cache(signature_sets)
+    assert order == [0, 2, 4, 1, 3]
+    assert expected_cache_hit_rate([signature_sets[i] for i in order]) > expected_cache_hit_rate(signature_sets)
+
+
+def test_job_queue_reorders_jobs_for_cache_within_priorities(workflow):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 1
+          changes:
+            ckpt_name: {checkpoint}
+    """
+    queue = tweaker.JobQueue(aging_rate=0)
+    jobs = [
+        queue.add(workflow, Tweaks.from_yaml(tweaks_yaml.format(checkpoint=checkpoint)), validate=False, priority=priority)
+        for checkpoint, priority in [("a", 1), ("b", 0), ("a", 0), ("b", 0), ("a", 0)]
+    ]
+    before, after = queue.reorder_for_cache()
+    assert list(queue.queue) == [jobs[0], jobs[1], jobs[3], jobs[2], jobs[4]]
+    assert before < after
+
+def test_server_router_trades_affinity_against_load():
+    router = ServerRouter(["a", "b"])
+    models = frozenset({("ckpt_name", "x.safetensors")})
+    router.loaded["a"] = models
+    assert router.choose(models) == "a"
+    router.in_flight["a"] = 1
+    assert router.choose(models) == "b"
+    router.affinity_weight = 2
+    assert router.choose(models) == "a"
+
+
+@pytest.mark.asyncio
+async def test_server_router_only_learns_models_from_successful_prompts():
+    router = ServerRouter(["a"])
+    models = frozenset({("ckpt_name", "x.safetensors")})
+    assert await router.reserve(models) == "a"
+    await router.release("a")
+    assert router.loaded["a"] == frozenset() and router.in_flight["a"] == 0
+    await router.reserve(models)
+    await router.release("a", models)
+    assert router.loaded["a"] == models
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("affinity_weight, expected_servers", [(2, ["s2", "s2"]), (0.5, ["s2", "s1"])])
+async def test_job_queue_routes_iterations_to_servers_with_loaded_models(workflow, mocker, monkeypatch, tmpdir, affinity_weight, expected_servers):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 2
+          changes:
+            seed: {{ iteration }}
+    """
+    servers = []
+
+    runs = []
+
+    async def fake_run_job_on_server(job, server_address=None, **kwargs):
+        servers.append(server_address)
+        runs.append(job)
+        await asyncio.sleep(0.01)
+        return [f"{server_address}/{job.workflow.api_workflow['2']['inputs']['seed']}.png"]
+
+    mocker.patch("comfy_tweaker.run_job_on_server", side_effect=fake_run_job_on_server)
+    monkeypatch.setenv("OUTPUT_DOWNLOAD_FOLDER", str(tmpdir))
+    monkeypatch.setenv("COMFYUI_SERVERS", "s1,s2")
+    queue = tweaker.JobQueue(servers=["s1", "s2"], affinity_weight=affinity_weight)
+    queue.router.loaded["s2"] = model_inputs(workflow.api_workflow)
+    job = queue.add(workflow, Tweaks.from_yaml(tweaks_yaml), amount=2, validate=False)
+    await queue.start()
+    assert servers == expected_servers
+    assert job.status == tweaker.JobStatus.COMPLETED
+    assert job.results == {0: [f"{expected_servers[0]}/0.png"], 1: [f"{expected_servers[1]}/1.png"]}
+    assert queue.router.in_flight == {"s1": 0, "s2": 0}
+    # each iteration ran from its own state rather than the job, which had moved on
+    assert runs[0] is not runs[1] and job not in runs
+
+@pytest.mark.asyncio
+async def test_job_queue_needs_downloads_and_uploads_for_every_server(workflow, monkeypatch, tmpdir):
+    queue = tweaker.JobQueue(servers=["s1:8188", "s2:8188"])
+    queue.add(workflow, Tweaks(), validate=False)
+    monkeypatch.delenv("OUTPUT_DOWNLOAD_FOLDER", raising=False)
+    with pytest.raises(ValueError, match="OUTPUT_DOWNLOAD_FOLDER"):
+        await queue.start()
+    monkeypatch.setenv("OUTPUT_DOWNLOAD_FOLDER", str(tmpdir))
+    monkeypatch.setenv("COMFYUI_SERVERS", "s1:8188")
+    with pytest.raises(ValueError, match="COMFYUI_SERVERS"):
+        await queue.start()
+
+
+def test_as_image_uploads_to_every_server(tweaks_directory, monkeypatch, mocker):
+    upload_image = mocker.patch("comfy_tweaker.filters.upload_image", return_value="image-1234.png")
+    monkeypatch.setenv("COMFYUI_SERVERS", "s1:8188,s2:8188")
+    image_path = str(tweaks_directory / "valid_workflow_image.png")
+    assert as_image(image_path) == "image-1234.png"
+    assert [call.args for call in upload_image.call_args_list] == [("s1:8188", image_path), ("s2:8188", image_path)]
+
+
 def test_can_use_plugins_in_tweaks_file(tweaks_directory):
     plugin_path = os.path.join(tweaks_directory, "greet_plugin.py")
     import_plugin("greet_plugin", plugin_path)
@@ -440,6 +729,121 @@ def test_can_use_plugins_in_tweaks_file(tweaks_directory):
     tweaks = tweaker.Tweaks.from_yaml(tweaks_yaml)
     assert tweaks.tweaks[0].changes["greeting"] == "Hello, world!"
 
+LAZY_PLUGIN = """
+from jinja2 import pass_context
+
+from comfy_tweaker import Tweaks
+from comfy_tweaker.plugins import PluginType
+
+
+@Tweaks.register("shout", plugin_type=PluginType.FILTERS)
+def make_loud(text):
+    return text.upper() + "!"
+
+
+@Tweaks.register()
+@pass_context
+def which_iteration(context):
+    return context["iteration"]
+"""
+
+
+@pytest.fixture
+def lazy_plugins_directory(tmpdir):
+    directory = tmpdir.mkdir("plugins")
+    (directory / "lazy_plugin.py").write_text(LAZY_PLUGIN, encoding="utf-8")
+    yield directory
+    Tweaks.lazy_plugins = {}
+
+
+def test_plugin_manifest_is_only_rebuilt_when_plugins_change(lazy_plugins_directory, tmpdir, mocker):
+    manifest_path = str(tmpdir / "manifest.json")
+    scan_plugin = mocker.spy(plugins, "scan_plugin")
+    manifest = plugins.load_manifest(str(lazy_plugins_directory), manifest_path)
+    assert manifest["shout"] == plugins.ManifestEntry(
+        "shout", "comfy_tweaker_plugin_lazy_plugin", str(lazy_plugins_directory / "lazy_plugin.py"), "make_loud", "filters"
+    )
+    assert manifest["which_iteration"].pass_arg == "pass_context"
+    assert plugins.load_manifest(str(lazy_plugins_directory), manifest_path) == manifest
+    assert scan_plugin.call_count == 1
+    (lazy_plugins_directory / "other_plugin.py").write_text("", encoding="utf-8")
+    assert plugins.load_manifest(str(lazy_plugins_directory), manifest_path) == manifest
+    assert scan_plugin.call_count == 3
+
+
+def test_plugins_are_imported_when_first_used(lazy_plugins_directory, tmpdir, mocker):
+    mocker.patch("comfy_tweaker.plugins.get_manifest_path", return_value=str(tmpdir / "manifest.json"))
+    Tweaks.discover_plugins(str(lazy_plugins_directory))
+    assert "comfy_tweaker_plugin_lazy_plugin" not in sys.modules
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 346
+          changes:
+            greeting: {{ "hello" | shout }}
+            iteration: {{ which_iteration() }}
+    """
+    tweaks = Tweaks.from_yaml(tweaks_yaml, iteration=4)
+    assert tweaks.tweaks[0].changes == {"greeting": "HELLO!", "iteration": 4}
+    assert "comfy_tweaker_plugin_lazy_plugin" in sys.modules
+
+
+def test_environment_is_shared_until_plugins_change():
+    env = Tweaks.environment()
+    assert Tweaks.environment() is env
+
+    @Tweaks.register("temporary_plugin")
+    def temporary_plugin():
+        return "registered"
+
+    try:
+        assert Tweaks.environment() is not env
+        assert Tweaks.from_yaml("tweaks: [{selector: {id: 1}, changes: {value: {{ temporary_plugin() }}}}]").tweaks[0].changes == {"value": "registered"}
+    finally:
+        Tweaks.plugins = [plugin for plugin in Tweaks.plugins if plugin.name != "temporary_plugin"]
+    assert "temporary_plugin" not in Tweaks.environment().globals
+
+    # swapping a plugin for another with the same count still rebuilds the environment
+    plugins_before = Tweaks.plugins
+    env = Tweaks.environment()
+    try:
+        Tweaks.plugins = plugins_before[:-1] + [tweaker.Plugin("swapped_plugin", lambda: "swapped", PluginType.GLOBALS)]
+        assert "swapped_plugin" in Tweaks.environment().globals
+        Tweaks.plugins[-1] = tweaker.Plugin("replaced_plugin", lambda: "replaced", PluginType.GLOBALS)
+        assert "replaced_plugin" in Tweaks.environment().globals
+    finally:
+        Tweaks.plugins = plugins_before
+    assert Tweaks.environment() is not env
+
+
+def test_compiled_templates_are_cached_on_disk(tmpdir, monkeypatch, mocker):
+    monkeypatch.setattr(Tweaks, "bytecode_cache_directory", str(tmpdir / "template_cache"))
+    Tweaks.invalidate_environment()
+    tweaks_yaml = "tweaks: [{selector: {id: 1}, changes: {value: {{ iteration * 2 }}}}]"
+    assert Tweaks.from_yaml(tweaks_yaml, iteration=2).tweaks[0].changes == {"value": 4}
+    assert len((tmpdir / "template_cache").listdir()) == 1
+    # a new environment, like after a restart, loads the template instead of compiling it
+    Tweaks.invalidate_environment()
+    compile = mocker.spy(jinja2.Environment, "compile")
+    assert Tweaks.from_yaml(tweaks_yaml, iteration=3).tweaks[0].changes == {"value": 6}
+    compile.assert_not_called()
+    Tweaks.invalidate_environment()
+
+
+def test_templates_can_be_rendered_from_many_threads():
+    tweaks_yaml = "tweaks: [{selector: {id: 1}, changes: {value: {{ iteration }}, seed: {{ range(iteration + 1) | list | length }}}}]"
+
+    def render(iteration):
+        if iteration % 10 == 0:
+            # renders in other threads keep the environment they started with
+            Tweaks.invalidate_environment()
+        return Tweaks.from_yaml(tweaks_yaml, iteration=iteration).tweaks[0].changes
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(render, range(200)))
+    assert results == [{"value": iteration, "seed": iteration + 1} for iteration in range(200)]
+
+
 def test_as_json_property(tweaks_directory):
     tweaks_yaml = f"""
     tweaks:
@@ -449,4 +853,461 @@ def test_as_json_property(tweaks_directory):
             value: {{{{ from_folder_absolute("{str(tweaks_directory).replace(os.sep, "/")}", file_glob="*.json") | as_json_property("foo", "bar") }}}}
     """
     tweaks = tweaker.Tweaks.from_yaml(tweaks_yaml)
-    assert tweaks.tweaks[0].changes["value"] == "baz"
\ No newline at end of file
+    assert tweaks.tweaks[0].changes["value"] == "baz"
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_json_cache_follows_pointers(tmpdir, lazy):
+    catalog = tmpdir / "catalog.json"
+    catalog.write_text(json.dumps({
+        "skip": {"nested": ["}", "\\\"", {"a": [1, 2]}]},
+        "styles": [{"name": "first"}, {"name": "sec/ond", "weights": [0.5, 1e-3, None, True]}],
+        "a/b": {"~c": "escaped"},
+    }, indent=1), encoding="utf-8")
+    cache = JsonCache()
+    assert cache.get(str(catalog), ("/styles/1/name",), lazy=lazy) == "sec/ond"
+    assert cache.get(str(catalog), ("styles", 1, "weights"), lazy=lazy) == [0.5, 1e-3, None, True]
+    assert cache.get(str(catalog), ("/a~1b/~0c",), lazy=lazy) == "escaped"
+    with pytest.raises(KeyError):
+        cache.get(str(catalog), ("/missing",), lazy=lazy)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_json_cache_normalizes_keys_and_rejects_empty_files(tmpdir, lazy):
+    catalog = tmpdir / "catalog.json"
+    catalog.write_text(json.dumps({"1": ["zero", {"2": "found"}]}), encoding="utf-8")
+    cache = JsonCache()
+    assert cache.get(str(catalog), (1, "1", 2), lazy=lazy) == "found"
+    empty = tmpdir / "empty.json"
+    empty.write_text("", encoding="utf-8")
+    with pytest.raises(json.JSONDecodeError):
+        cache.get(str(empty), ("value",), lazy=lazy)
+
+
+def test_json_cache_closes_evicted_memory_maps(tmpdir):
+    cache = JsonCache(max_documents=1)
+    paths = []
+    for name in ("a", "b"):
+        path = tmpdir / f"{name}.json"
+        path.write_text(json.dumps({"name": name}), encoding="utf-8")
+        paths.append(str(path))
+    with cache.document(paths[0], lazy=True) as first:
+        assert cache.get(paths[1], ("name",), lazy=True) == "b"
+        # evicted, but still open while it is being used
+        assert first._mmap is not None and first.get(("name",)) == "a"
+    assert first._mmap is None
+    with cache.document(paths[1], lazy=True) as second:
+        pass
+    cache.clear()
+    assert second._mmap is None
+
+
+def test_json_cache_reloads_changed_files(tmpdir, mocker):
+    catalog = tmpdir / "catalog.json"
+    catalog.write_text('{"value": 1}', encoding="utf-8")
+    cache = JsonCache()
+    load = mocker.spy(json, "load")
+    assert cache.get(str(catalog), ("value",)) == 1
+    assert cache.get(str(catalog), ("/value",)) == 1
+    assert load.call_count == 1
+    catalog.write_text('{"value": 22}', encoding="utf-8")
+    assert cache.get(str(catalog), ("value",)) == 22
+    assert load.call_count == 2
+
+
+def test_file_cache_stays_within_budget(tmpdir):
+    cache = FileCache(max_bytes=10)
+    paths = []
+    for name in ("a", "b", "c"):
+        path = tmpdir / f"{name}.txt"
+        path.write_text(name * 4, encoding="utf-8")
+        paths.append(str(path))
+    for path in paths:
+        cache.read_text(path)
+    assert cache.read_text(paths[2]) == "cccc"
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.evictions, stats.entries, stats.bytes) == (1, 3, 1, 2, 8)
+    cache.resize(4)
+    assert cache.stats().entries == 1
+
+
+def test_file_cache_reads_changed_files_again(tmpdir, mocker):
+    path = tmpdir / "prompt.txt"
+    path.write_text("first", encoding="utf-8")
+    cache = FileCache()
+    assert cache.read_text(str(path)) == "first"
+    opened = mocker.spy(builtins, "open")
+    assert cache.read_text(str(path)) == "first"
+    assert opened.call_count == 0
+    path.write_text("second version", encoding="utf-8")
+    assert cache.read_text(str(path)) == "second version"
+    assert cache.stats().invalidations == 1
+
+
+def test_render_ahead_renders_iterations_in_order(workflow):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 2
+          changes:
+            seed: {{ iteration }}
+    """
+    job = tweaker.Job(workflow, Tweaks.from_yaml(tweaks_yaml), amount=5)
+    renderer = tweaker.RenderAhead(job, depth=2)
+
+    async def consume():
+        return [await renderer.next() for _ in range(job.amount)]
+
+    rendered = asyncio.run(consume())
+    renderer.cancel()
+    assert [r.iteration for r in rendered] == [0, 1, 2, 3, 4]
+    assert [r.workflow.api_workflow["2"]["inputs"]["seed"] for r in rendered] == [0, 1, 2, 3, 4]
+    assert rendered[-1].next_tweaks._iteration == 5
+
+
+def test_render_ahead_does_not_mutate_original_workflow(workflow):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 2
+          changes:
+            seed: {{ iteration }}
+    """
+    original_seed = workflow.api_workflow["2"]["inputs"]["seed"]
+    job = tweaker.Job(workflow, Tweaks.from_yaml(tweaks_yaml), amount=3)
+    renderer = tweaker.RenderAhead(job, depth=3)
+    first = asyncio.run(renderer.next())
+    renderer._thread.join(timeout=5)
+    renderer.cancel()
+    assert first.workflow.api_workflow["2"]["inputs"]["seed"] == 0
+    assert job.original_workflow.api_workflow["2"]["inputs"]["seed"] == original_seed
+
+
+def test_cycle_store_rewinds_journaled_moves():
+    store = CycleStore()
+    items = ["a", "b", "c"]
+    store.next("kept", items)
+    journal = []
+    assert [store.next("kept", items, journal=journal) for _ in range(2)] == ["b", "c"]
+    store.rewind(journal)
+    assert journal == [] and store.next("kept", items) == "b"
+    shuffled = [store.next("shuffled", items, shuffle=True) for _ in range(2)]
+    journal = []
+    last = store.next("shuffled", items, shuffle=True, journal=journal)
+    store.rewind(journal)
+    # the move finished the pass, and rewinding brings back the order it came from
+    assert store.next("shuffled", items, shuffle=True) == last
+    assert sorted(shuffled + [last]) == items
+    # the thrown away moves cross into a new pass, which drew a new order
+    items = list(range(10))
+    for _ in range(20):
+        store.clear()
+        for _ in range(8):
+            store.next("crossing", items, shuffle=True)
+        journal = []
+        discarded = [store.next("crossing", items, shuffle=True, journal=journal) for _ in range(4)]
+        store.rewind(journal)
+        assert [store.next("crossing", items, shuffle=True) for _ in range(2)] == discarded[:2]
+
+
+def test_render_ahead_rewinds_cycles_of_thrown_away_renders(workflow, models_directory, monkeypatch):
+    monkeypatch.setenv("MODELS_FOLDER", str(models_directory))
+    (models_directory / "lora" / "test3.safetensors").write("")
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 8
+          changes:
+            lora_name: {{ from_models_folder("lora", cycle=True) }}
+    """
+    cycle_store.clear()
+    job = tweaker.Job(workflow, Tweaks.from_yaml(tweaks_yaml), amount=5)
+    renderer = tweaker.RenderAhead(job, depth=3)
+    first = asyncio.run(renderer.next())
+    for _ in range(100):
+        if renderer._rendered.full():
+            break
+        time.sleep(0.01)
+    renderer.cancel()
+    renderer._thread.join(timeout=5)
+    assert first.next_tweaks.tweaks[0].changes["lora_name"] == "test2.safetensors"
+    # the renders after the first were thrown away, so the cycle carries on from the first
+    assert first.next_tweaks.regenerate().tweaks[0].changes["lora_name"] == "test3.safetensors"
+
+
+@pytest.mark.asyncio
+async def test_job_queue_start_with_render_ahead(workflow, mocker):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 2
+          changes:
+            seed: {{ iteration }}
+    """
+    seeds = []
+
+    async def fake_run_job_on_server(job, **kwargs):
+        seeds.append(job.workflow.api_workflow["2"]["inputs"]["seed"])
+
+    mocker.patch("comfy_tweaker.run_job_on_server", side_effect=fake_run_job_on_server)
+    job = tweaker.Job(workflow, Tweaks.from_yaml(tweaks_yaml), amount=4)
+    queue = tweaker.JobQueue(queue=[job], render_ahead=2)
+    await queue.start()
+    assert seeds == [0, 1, 2, 3]
+    assert job.status == tweaker.JobStatus.COMPLETED
+    assert queue.history == [job]
+
+
+def test_render_pool_renders_tweaks_in_worker_processes(tweaks_directory):
+    import_plugin("greet_plugin", os.path.join(tweaks_directory, "greet_plugin.py"))
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 346
+          changes:
+            greeting: {{ greet("world") }}
+            value: {{ iteration }}
+    """
+    render_pool = tweaker.RenderPool(max_workers=2, mp_context=multiprocessing.get_context("spawn"))
+    Tweaks.use_render_pool(render_pool)
+    try:
+        render_pool.warm_up(tweaks_yaml)
+        tweaks = Tweaks.from_yaml(tweaks_yaml, iteration=3)
+        assert tweaks.tweaks[0].changes == {"greeting": "Hello, world!", "value": 3}
+        assert type(render_pool.render(tweaks_yaml)) is dict
+        assert tweaks.regenerate().tweaks[0].changes["value"] == 4
+    finally:
+        Tweaks.use_render_pool(None)
+        render_pool.shutdown()
+
+
+def test_render_pool_leaves_cycles_to_the_calling_process(models_directory, monkeypatch, mocker):
+    monkeypatch.setenv("MODELS_FOLDER", str(models_directory))
+    cycle_store.clear()
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 8
+          changes:
+            lora_name: {{ from_models_folder("lora", cycle=True) }}
+    """
+    serial = [Tweaks.from_yaml(tweaks_yaml, iteration=iteration).tweaks[0].changes for iteration in range(4)]
+    cycle_store.clear()
+    render_pool = mocker.Mock()
+    Tweaks.use_render_pool(render_pool)
+    try:
+        assert Tweaks.is_stateful(tweaks_yaml)
+        assert not Tweaks.is_stateful("tweaks: [{selector: {id: 1}, changes: {value: {{ random_int(1, 2) }}}}]")
+        pooled = [Tweaks.from_yaml(tweaks_yaml, iteration=iteration).tweaks[0].changes for iteration in range(4)]
+    finally:
+        Tweaks.use_render_pool(None)
+    render_pool.render.assert_not_called()
+    assert pooled == serial
+
+
+def test_workflow_hash_ignores_key_order():
+    first = {"1": {"inputs": {"seed": 1, "steps": 20}}, 2: {"inputs": {"text": "a"}}}
+    second = {2: {"inputs": {"text": "a"}}, "1": {"inputs": {"steps": 20, "seed": 1}}}
+    assert hash_workflow(first) == hash_workflow(second)
+    assert hash_workflow(first) != hash_workflow({"1": {"inputs": {"seed": 2, "steps": 20}}})
+
+
+def test_result_index_persists_and_counts_hits(tmpdir):
+    output = tmpdir / "output.png"
+    output.write_binary(b"png")
+    index = ResultIndex(str(tmpdir / "index.jsonl"))
+    assert index.lookup("abc") == []
+    index.record("abc", [str(output)])
+
+    index = ResultIndex(str(tmpdir / "index.jsonl"))
+    assert index.lookup("abc") == [str(output)]
+    output.remove()
+    assert index.lookup("abc") == []
+    assert (index.hits, index.misses) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_job_queue_reuses_results_for_duplicate_workflows(workflow, tmpdir, mocker):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 2
+          changes:
+            seed: {{ iteration % 2 }}
+    """
+    outputs = []
+
+    async def fake_run_job_on_server(job, **kwargs):
+        output = tmpdir / f"output_{len(outputs)}.png"
+        output.write_binary(b"png")
+        outputs.append(str(output))
+        return [str(output)]
+
+    mocker.patch("comfy_tweaker.run_job_on_server", side_effect=fake_run_job_on_server)
+    job = tweaker.Job(workflow, Tweaks.from_yaml(tweaks_yaml), amount=4)
+    queue = tweaker.JobQueue(
+        queue=[job],
+        reuse_results=ReuseMode.HARDLINK,
+        result_index=ResultIndex(str(tmpdir / "index.jsonl")),
+    )
+    await queue.start()
+    assert len(outputs) == 2
+    assert (queue.result_index.hits, queue.result_index.misses) == (2, 2)
+    assert os.path.exists(job.output_location)
+    assert job.output_location not in outputs
+
+
+@pytest.mark.asyncio
+async def test_job_records_outputs_by_iteration(workflow, mocker, tmpdir):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 2
+          changes:
+            seed: {{ iteration }}
+    """
+
+    async def fake_run_job_on_server(job, **kwargs):
+        seed = job.workflow.api_workflow["2"]["inputs"]["seed"]
+        if seed % 2:
+            return []
+        output = tmpdir / f"output_{seed}.png"
+        output.write_binary(b"png")
+        return [str(output)]
+
+    mocker.patch("comfy_tweaker.run_job_on_server", side_effect=fake_run_job_on_server)
+    job = tweaker.Job(workflow, Tweaks.from_yaml(tweaks_yaml, iteration=10), amount=4)
+    assert job.iterations == range(10, 14)
+    await tweaker.JobQueue(queue=[job]).start()
+    assert job.progress == 4
+    assert sorted(job.results) == [10, 12]
+    assert job.results[12] == [str(tmpdir / "output_12.png")]
+    assert job.output_location == job.results[12][-1]
+
+
+def test_validation_is_cached_by_tweaks_structure(workflow, mocker):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 2
+          changes:
+            seed: {{ iteration }}
+    """
+    tweaks = Tweaks.from_yaml(tweaks_yaml)
+    apply_tweaks = mocker.spy(workflow, "apply_tweaks")
+    tweaker._validation_cache.clear()
+    workflow.validate(tweaks)
+    workflow.validate(tweaks.regenerate())
+    assert apply_tweaks.call_count == 1
+
+    queue = tweaker.JobQueue()
+    for _ in range(1000):
+        queue.add(workflow, tweaks)
+    assert apply_tweaks.call_count == 1
+
+
+def test_cached_validation_still_rejects_different_structure(workflow):
+    tweaker._validation_cache.clear()
+    workflow.validate(Tweaks([Tweak({"id": "2"}, {"seed": 1})]))
+    with pytest.raises(NodeFieldNotFound):
+        workflow.validate(Tweaks([Tweak({"id": "2"}, {"not_a_field": 1})]))
+
+
+def test_workflow_from_image_is_cached_until_the_image_changes(tweaks_directory):
+    image_path = tweaks_directory / "valid_workflow_image.png"
+    first = Workflow.from_image(image_path, name="first")
+    second = Workflow.from_image(str(image_path), name="second")
+    assert first.api_workflow is second.api_workflow
+    assert (first.name, second.name) == ("first", "second")
+
+    stat = os.stat(image_path)
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    third = Workflow.from_image(image_path, name="first")
+    assert third.api_workflow is not first.api_workflow
+    assert third == first
+
+
+def test_jobs_share_their_source_workflow(workflow, tweaks):
+    first = tweaker.Job(workflow, tweaks)
+    second = tweaker.Job(workflow, tweaks)
+    assert first.original_workflow is second.original_workflow
+
+
+def test_sweep_matches_itertools_product():
+    axes = {"checkpoint": ["a", "b"], "lora": ["x", "y", "z"], "cfg": [4, 6]}
+    sweep = Sweep(axes)
+    assert len(sweep) == 12
+    assert [tuple(point.values()) for point in sweep] == list(itertools.product(*axes.values()))
+
+
+def test_sweep_indexes_huge_grids_without_materializing():
+    sweep = Sweep({"a": range(1000), "b": range(1000), "c": range(1000)})
+    assert len(sweep) == 1_000_000_000
+    assert sweep[123_456_789] == {"a": 123, "b": 456, "c": 789}
+    assert sweep.at(1_000_000_001) == {"a": 0, "b": 0, "c": 1}
+
+
+def test_tweaks_file_can_sweep_over_axes():
+    tweaks_yaml = """
+    {% set grid = sweep(lora=["test1.safetensors", "test2.safetensors"], strength=[0.5, 1.0]) %}
+    amount: {{ grid.total }}
+    tweaks:
+        - selector:
+            id: 346
+          changes:
+            lora_name: {{ grid.lora }}
+            strength: {{ grid.strength }}
+    """
+    tweaks = tweaker.Tweaks.from_yaml(tweaks_yaml)
+    assert tweaks.amount == 4
+    combinations = []
+    for _ in range(tweaks.amount):
+        combinations.append((tweaks.tweaks[0].changes["lora_name"], tweaks.tweaks[0].changes["strength"]))
+        tweaks = tweaks.regenerate()
+    assert combinations == [
+        ("test1.safetensors", 0.5),
+        ("test1.safetensors", 1.0),
+        ("test2.safetensors", 0.5),
+        ("test2.safetensors", 1.0),
+    ]
+
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_sampling_profiler_writes_collapsed_stacks(tmpdir):
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    busy_loop(0.2)
+    profiler.stop()
+    profile = tmpdir / "profile.folded"
+    profiler.write(str(profile))
+    lines = profile.read_text("utf-8").splitlines()
+    busy = [line for line in lines if "busy_loop (test_tweaker.py" in line]
+    assert busy and all(line.startswith("MainThread;") for line in busy)
+    stack, count = busy[0].rsplit(" ", 1)
+    assert int(count) > 0
+    # outermost frames come first
+    functions = [frame.split(" (")[0] for frame in stack.split(";")]
+    assert functions.index("test_sampling_profiler_writes_collapsed_stacks") < functions.index("busy_loop")
+
+
+@pytest.mark.asyncio
+async def test_job_queue_is_only_profiled_when_asked(workflow_job, tmpdir, mocker):
+    async def fake_run_job_on_server(job, **kwargs):
+        busy_loop(0.02)
+
+    mocker.patch("comfy_tweaker.run_job_on_server", side_effect=fake_run_job_on_server)
+    start = mocker.spy(SamplingProfiler, "start")
+    queue = tweaker.JobQueue()
+    queue.add(workflow_job.original_workflow, workflow_job.tweaks, amount=2)
+    await queue.start()
+    start.assert_not_called()
+    queue.profile_directory = str(tmpdir / "logs")
+    queue.add(workflow_job.original_workflow, workflow_job.tweaks, amount=2)
+    await queue.start()
+    profiles = (tmpdir / "logs").listdir()
+    assert len(profiles) == 1 and profiles[0].basename.endswith(".folded")
+    assert "fake_run_job_on_server" in profiles[0].read_text("utf-8")
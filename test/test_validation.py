@@ -0,0 +1,79 @@
+import pytest
+
+import comfy_tweaker as tweaker
+from comfy_tweaker import Tweaks, Workflow
+from comfy_tweaker.validation import ModelIndex, find_problem
+
+LORA_TWEAKS = """
+tweaks:
+    - selector:
+        id: 8
+      changes:
+        lora_name: {lora}
+"""
+
+
+@pytest.fixture
+def workflow(tweaks_directory):
+    return Workflow.from_image(tweaks_directory / "valid_workflow_image.png")
+
+
+@pytest.fixture
+def models_folder(models_directory, monkeypatch):
+    monkeypatch.setenv("MODELS_FOLDER", str(models_directory))
+    return models_directory
+
+
+def test_finds_missing_models(workflow, models_folder):
+    model_index = ModelIndex()
+    missing = tweaker.Job(workflow, Tweaks.from_yaml(LORA_TWEAKS.format(lora="deleted.safetensors")))
+    present = tweaker.Job(workflow, Tweaks.from_yaml(LORA_TWEAKS.format(lora="test1.safetensors")))
+    assert find_problem(missing, model_index) == "Model not found for node 8 lora_name: deleted.safetensors"
+    # there is no checkpoints folder in the fixtures, so the checkpoint can't be checked
+    assert find_problem(present, model_index) is None
+
+
+def test_model_index_is_cached(models_folder):
+    model_index = ModelIndex(ttl=60)
+    assert model_index.exists("lora_name", "test1.safetensors")
+    (models_folder / "lora" / "test1.safetensors").remove()
+    assert model_index.exists("lora_name", "test1.safetensors")
+    assert not ModelIndex().exists("lora_name", "test1.safetensors")
+
+
+def test_finds_tweaks_that_no_longer_render(workflow, models_folder):
+    tweaks_yaml = """
+    tweaks:
+        - selector:
+            id: 8
+          changes:
+            lora_name: {{ from_models_folder("lora", cycle=True) }}
+    """
+    job = tweaker.Job(workflow, Tweaks.from_yaml(tweaks_yaml))
+    model_index = ModelIndex()
+    first = job.tweaks.tweaks[0].changes["lora_name"]
+    assert find_problem(job, model_index) is None
+    # checking a job doesn't move its cycles along
+    assert job.tweaks.regenerate().tweaks[0].changes["lora_name"] != first
+    for lora in (models_folder / "lora").listdir():
+        lora.remove()
+    assert find_problem(job, model_index).startswith("ValueError: No files in lora")
+
+
+@pytest.mark.asyncio
+async def test_job_queue_skips_jobs_with_problems(workflow, models_folder, mocker):
+    ran = []
+
+    async def fake_run_job_on_server(job, **kwargs):
+        ran.append(job.workflow.api_workflow["8"]["inputs"]["lora_name"])
+
+    mocker.patch("comfy_tweaker.run_job_on_server", side_effect=fake_run_job_on_server)
+    queue = tweaker.JobQueue(validate_ahead=True, aging_rate=0)
+    broken = queue.add(workflow, Tweaks.from_yaml(LORA_TWEAKS.format(lora="deleted.safetensors")), validate=False)
+    working = queue.add(workflow, Tweaks.from_yaml(LORA_TWEAKS.format(lora="test2.safetensors")), validate=False)
+    queue.validator.validate_upcoming()
+    assert broken.problem and not working.problem
+    await queue.start()
+    assert ran == ["test2.safetensors"]
+    assert broken.status == tweaker.JobStatus.FAILED
+    assert working.status == tweaker.JobStatus.COMPLETED